@@ -0,0 +1,409 @@
+"""
+Benchmarks for the query result pipeline: parsing query results into metrics,
+merging them into stored metrics, and rendering them for scrapes.
+
+MySQL is replaced with an in-process fake connection returning synthetic
+result sets, so only the exporter's own code is measured. Each case runs a
+query end to end via run_query(), then scrapes /metrics via the exporter app:
+* an initial run, storing all series,
+* a second run, with changed values and some series missing, merged as per
+  the case's policy (used as both QueryOnMissing and QueryOnError),
+* scrapes of the resulting metrics, uncompressed and gzip-compressed,
+* a failed run, handled as per the same policy.
+
+Query runs include rendering the exposition text of changed metrics, as that
+happens when metrics are stored, rather than on scrape.
+
+Run from the repository root:
+
+    python -m benchmarks.pipeline --rows 1000,100000,1000000
+
+Timings are taken first, as the best of --repeat runs. Peak memory and
+retained allocations are then measured in a separate run under tracemalloc,
+which slows execution considerably.
+
+Results are saved as JSON (by default under benchmarks/results/), and can be
+compared against a previous results file with --compare, which reports
+timings that have regressed by more than --threshold percent.
+"""
+
+import argparse
+import datetime
+import gc
+import itertools
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from pymysql.constants import FIELD_TYPE
+
+import prometheus_mysql_exporter as exporter
+
+from prometheus_client.core import REGISTRY
+from prometheus_mysql_exporter.pool import ConnectionPool
+from prometheus_mysql_exporter.server import make_exporter_app
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+POLICIES = ('preserve', 'drop', 'zero')
+STEPS = ('initial', 'merge', 'scrape', 'scrape_gzip', 'error')
+
+
+class FakeError(Exception):
+    """Raised by FakeCursor to simulate a failed query."""
+
+
+class FakeCursor(object):
+    """
+    Enough of a pymysql cursor for run_query(), returning preset rows.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.description = None
+        self.rownumber = 0
+        self._rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def execute(self, query):
+        if self.conn.result is None:
+            raise FakeError('Simulated query failure.')
+        self.description, self._rows = self.conn.result
+        return len(self._rows)
+
+    def fetchall(self):
+        self.rownumber = len(self._rows)
+        return self._rows
+
+    def __iter__(self):
+        for row in self._rows:
+            self.rownumber += 1
+            yield row
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    """
+    Enough of a pymysql connection for run_query() and ConnectionPool.
+    The result returned by its cursors is shared via the result attribute of
+    the class, as a (description, rows) tuple, or None to fail queries.
+    """
+
+    result = None
+
+    def __init__(self, **kwargs):
+        self.open = True
+
+    def cursor(self, cursor_class=None):
+        return FakeCursor(self)
+
+    def thread_id(self):
+        return 1
+
+    def ping(self, reconnect=False):
+        pass
+
+    def close(self):
+        self.open = False
+
+
+def make_result(rows, label_columns, cardinality, value_columns, seed=0):
+    """
+    Build a synthetic query result, as a (description, value column names,
+    rows) tuple.
+
+    Each label column but the last has `cardinality` distinct values. The last
+    label column makes each row's label values unique. Values are floats,
+    varying with seed.
+    """
+
+    label_names = ['label{}'.format(i) for i in range(label_columns)]
+    value_names = ['value{}'.format(i) for i in range(value_columns)]
+    description = tuple((name, FIELD_TYPE.VAR_STRING, None, None, None, None, True)
+                        for name in label_names)
+    description += tuple((name, FIELD_TYPE.DOUBLE, None, None, None, None, True)
+                         for name in value_names)
+
+    result_rows = []
+    for i in range(rows):
+        labels = ['v{}'.format((i // cardinality ** j) % cardinality)
+                  for j in range(label_columns - 1)]
+        labels.append('r{}'.format(i // cardinality ** (label_columns - 1)))
+        values = [float((i * (k + 1) + seed) % 1000) for k in range(value_columns)]
+        result_rows.append(tuple(labels + values))
+
+    return description, value_names, result_rows
+
+
+def drop_rows(result_rows, fraction):
+    """Remove an evenly spread fraction of rows, to simulate missing series."""
+
+    if not fraction:
+        return result_rows
+    step = max(int(1 / fraction), 1)
+    return [row for i, row in enumerate(result_rows) if i % step]
+
+
+def scrape(app, compress):
+    environ = {
+        'PATH_INFO': '/metrics',
+        'QUERY_STRING': '',
+        'HTTP_ACCEPT_ENCODING': 'gzip' if compress else '',
+    }
+    chunks = app(environ, lambda status, headers: None)
+    return sum(len(chunk) for chunk in chunks)
+
+
+def reset_state(metrics_key):
+    with exporter.METRICS_BY_QUERY_LOCK:
+        exporter.METRICS_BY_QUERY.pop(metrics_key, None)
+    exporter.EXPOSITION_CACHE.remove(metrics_key)
+    exporter.SERIES_BUDGET.update(metrics_key, 0)
+
+
+def run_case(case, measure):
+    """
+    Run each step of a benchmark case once, calling measure(step, func) to
+    run and measure each step. Returns the size of the uncompressed scrape.
+    """
+
+    rows, label_columns, cardinality, value_columns, policy, stream = case
+    description, value_names, first_rows = make_result(rows, label_columns,
+                                                       cardinality, value_columns)
+    _, _, second_rows = make_result(rows, label_columns, cardinality, value_columns, seed=1)
+    second_rows = drop_rows(second_rows, 0.1)
+
+    pool = ConnectionPool(FakeConnection, 'bench', max_size=1)
+    query_name = 'bench'
+    metrics_key = (None, query_name)
+    reset_state(metrics_key)
+
+    def run():
+        exporter.run_query(pool, None, query_name, 'bench', 'SELECT', value_names,
+                           on_error=policy, on_missing=policy, stream=stream)
+
+    app = make_exporter_app(REGISTRY, exporter.EXPOSITION_CACHE)
+    exporter.EXPOSITION_CACHE.compress = True
+
+    FakeConnection.result = (description, first_rows)
+    measure('initial', run)
+    FakeConnection.result = (description, second_rows)
+    measure('merge', run)
+
+    scrape_size = measure('scrape', lambda: scrape(app, compress=False))
+    measure('scrape_gzip', lambda: scrape(app, compress=True))
+
+    FakeConnection.result = None
+    measure('error', run)
+
+    reset_state(metrics_key)
+    return scrape_size
+
+
+def time_case(case, repeat):
+    """Return the best time, in seconds, of each step of a case."""
+
+    best = {}
+    scrape_size = None
+    for _ in range(repeat):
+        def measure(step, func):
+            gc.collect()
+            start_time = time.perf_counter()
+            result = func()
+            duration = time.perf_counter() - start_time
+            best[step] = min(best.get(step, duration), duration)
+            return result
+
+        scrape_size = run_case(case, measure)
+
+    return best, scrape_size
+
+
+def trace_case(case):
+    """
+    Return the peak traced memory, in bytes, and the number of allocated memory
+    blocks retained afterwards, for each step of a case.
+    """
+
+    memory = {}
+
+    def measure(step, func):
+        gc.collect()
+        tracemalloc.start()
+        before_blocks = sum(stat.count for stat in
+                            tracemalloc.take_snapshot().statistics('filename'))
+        tracemalloc.reset_peak()
+        result = func()
+        _, peak = tracemalloc.get_traced_memory()
+        after_blocks = sum(stat.count for stat in
+                           tracemalloc.take_snapshot().statistics('filename'))
+        tracemalloc.stop()
+        memory[step] = {'peak_bytes': peak, 'retained_blocks': after_blocks - before_blocks}
+        return result
+
+    run_case(case, measure)
+    return memory
+
+
+def case_name(case):
+    rows, label_columns, cardinality, value_columns, policy, stream = case
+    return 'rows={} labels={}x{} values={} policy={}{}'.format(
+        rows, label_columns, cardinality, value_columns, policy, ' stream' if stream else '')
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the change in each step's time against a baseline results file.
+    Returns the number of regressions beyond the threshold percentage.
+    """
+
+    baseline_cases = {case['name']: case for case in baseline['cases']}
+    regressions = 0
+    print()
+    print('Compared to {} ({}):'.format(baseline.get('commit'), baseline.get('timestamp')))
+    for case in results['cases']:
+        baseline_case = baseline_cases.get(case['name'])
+        if baseline_case is None:
+            continue
+
+        changes = []
+        for step in STEPS:
+            old = baseline_case['seconds'].get(step)
+            new = case['seconds'].get(step)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            flag = ''
+            if change > threshold:
+                flag = '!'
+                regressions += 1
+            changes.append('{} {:+.1f}%{}'.format(step, change, flag))
+        print('  {}: {}'.format(case['name'], ', '.join(changes)))
+
+    if regressions:
+        print('{} step(s) regressed by more than {}%.'.format(regressions, threshold))
+    return regressions
+
+
+def parse_int_list(value):
+    return [int(v) for v in value.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the query result pipeline, from run_query() to /metrics.')
+    parser.add_argument('--rows', type=parse_int_list, default=[1000, 10000, 100000],
+                        help='Comma separated result set sizes. (default: 1000,10000,100000)')
+    parser.add_argument('--label-columns', type=parse_int_list, default=[3],
+                        help='Comma separated numbers of label columns. (default: 3)')
+    parser.add_argument('--cardinality', type=parse_int_list, default=[10],
+                        help='Comma separated numbers of distinct values per label column, '
+                             'other than the last. (default: 10)')
+    parser.add_argument('--value-columns', type=parse_int_list, default=[1, 4],
+                        help='Comma separated numbers of value columns. (default: 1,4)')
+    parser.add_argument('--policies', type=lambda value: value.split(','),
+                        default=list(POLICIES),
+                        help='Comma separated QueryOnMissing/QueryOnError policies. '
+                             '(default: preserve,drop,zero)')
+    parser.add_argument('--stream', action='store_true',
+                        help='Stream query results, as per QueryStreamResults.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of timed runs of each case. The best is reported. '
+                             '(default: 3)')
+    parser.add_argument('--no-memory', action='store_true',
+                        help="Don't measure memory use, which is slow.")
+    parser.add_argument('--output',
+                        help='Path to save results to. '
+                             '(default: benchmarks/results/pipeline-<timestamp>.json)')
+    parser.add_argument('--compare',
+                        help='Path of previous results to compare against.')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='Percentage slowdown reported as a regression when comparing. '
+                             'Exits with status 1 if any step regresses. (default: 10)')
+    args = parser.parse_args(argv)
+
+    # Failed query runs are simulated, so don't log them.
+    logging.disable(logging.ERROR)
+
+    timestamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    results = {
+        'timestamp': timestamp,
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cases': [],
+    }
+
+    cases = itertools.product(args.rows, args.label_columns, args.cardinality,
+                              args.value_columns, args.policies, [args.stream])
+    for case in cases:
+        name = case_name(case)
+        rows, _, _, value_columns, _, _ = case
+        seconds, scrape_size = time_case(case, args.repeat)
+        memory = None if args.no_memory else trace_case(case)
+
+        # Each series is a row and value column combination.
+        series = rows * value_columns
+        results['cases'].append({
+            'name': name,
+            'rows': rows,
+            'series': series,
+            'scrape_bytes': scrape_size,
+            'seconds': seconds,
+            'rows_per_second': {step: rows / seconds[step]
+                                for step in ('initial', 'merge') if seconds[step]},
+            'memory': memory,
+        })
+
+        print(name)
+        for step in STEPS:
+            line = '  {:<12} {:>9.4f}s'.format(step, seconds[step])
+            if step in ('initial', 'merge') and seconds[step]:
+                line += ' {:>12,.0f} rows/s'.format(rows / seconds[step])
+            elif step.startswith('scrape') and seconds[step]:
+                line += ' {:>12,.0f} series/s'.format(series / seconds[step])
+            if memory is not None:
+                line += '  peak {:>8.1f}MiB  retained blocks {:>+9,}'.format(
+                    memory[step]['peak_bytes'] / 2**20, memory[step]['retained_blocks'])
+            print(line)
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, 'pipeline-{}.json'.format(timestamp))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print()
+    print('Results saved to {}'.format(output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+"""
+Benchmarks for how stored query metrics are kept in memory: as plain dicts,
+in compact form (see store.CompactValueDict), or as chosen by
+compact_metric_dict(), which is what the exporter stores.
+
+Each case builds a metric dict as parsed from a synthetic query result (label
+values tuples are shared between the metrics of a row, as by ParsePlan), then
+measures:
+* the memory retained by the stored metric dict, excluding the label values
+  themselves, which are the same however they're stored,
+* the time taken to merge a second result, with changed values, into it in
+  place, as per update_metric_dict().
+
+Run from the repository root:
+
+    python -m benchmarks.storage --series 10000,100000 --value-columns 1,2,4
+"""
+
+import argparse
+import gc
+import itertools
+import time
+import tracemalloc
+
+from prometheus_mysql_exporter.metrics import update_metric_dict
+from prometheus_mysql_exporter.store import compact_metric_dict, CompactValueDict, SeriesIndex
+
+MODES = ('plain', 'compact', 'auto')
+
+
+def make_label_values(series, label_columns):
+    return [tuple(['v{}'.format(i % 10) for _ in range(label_columns - 1)] + ['r{}'.format(i)])
+            for i in range(series)]
+
+
+def make_metric_dict(label_values, value_columns, seed=0):
+    label_keys = tuple('label{}'.format(i) for i in range(len(label_values[0])))
+    return {'bench_value{}'.format(k): ('Doc.', label_keys,
+                                        {values: float((i * (k + 1) + seed) % 1000)
+                                         for i, values in enumerate(label_values)})
+            for k in range(value_columns)}
+
+
+def store(metric_dict, mode):
+    if mode == 'compact':
+        index = SeriesIndex()
+        for metric_name, (metric_doc, label_keys, value_dict) in metric_dict.items():
+            metric_dict[metric_name] = (metric_doc, label_keys,
+                                        CompactValueDict(index, value_dict))
+    elif mode == 'auto':
+        compact_metric_dict(metric_dict)
+    return metric_dict
+
+
+def measure_memory(label_values, value_columns, mode):
+    """
+    Return the memory, in bytes, retained by a stored metric dict.
+    """
+
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    metric_dict = store(make_metric_dict(label_values, value_columns), mode)
+    gc.collect()
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del metric_dict
+    return after - before
+
+
+def measure_merge(label_values, value_columns, mode, repeat):
+    """
+    Return the best time, in seconds, taken to merge a new result into a
+    stored metric dict.
+    """
+
+    best = None
+    for _ in range(repeat):
+        metric_dict = store(make_metric_dict(label_values, value_columns), mode)
+        new_metric_dict = make_metric_dict(label_values, value_columns, seed=1)
+        gc.collect()
+        start_time = time.perf_counter()
+        update_metric_dict(metric_dict, new_metric_dict, on_missing='drop')
+        duration = time.perf_counter() - start_time
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def parse_int_list(value):
+    return [int(v) for v in value.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the memory use and merge time of stored query metrics.')
+    parser.add_argument('--series', type=parse_int_list, default=[100000],
+                        help='Comma separated numbers of rows (series per value column). '
+                             '(default: 100000)')
+    parser.add_argument('--label-columns', type=parse_int_list, default=[3],
+                        help='Comma separated numbers of label columns. (default: 3)')
+    parser.add_argument('--value-columns', type=parse_int_list, default=[1, 2, 4],
+                        help='Comma separated numbers of value columns. (default: 1,2,4)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of timed merges of each case. The best is reported. '
+                             '(default: 3)')
+    args = parser.parse_args(argv)
+
+    cases = itertools.product(args.series, args.label_columns, args.value_columns)
+    for series, label_columns, value_columns in cases:
+        label_values = make_label_values(series, label_columns)
+        print('series={} labels={} values={}'.format(series, label_columns, value_columns))
+        plain_bytes = None
+        for mode in MODES:
+            retained_bytes = measure_memory(label_values, value_columns, mode)
+            merge_seconds = measure_merge(label_values, value_columns, mode, args.repeat)
+            if plain_bytes is None:
+                plain_bytes = retained_bytes
+            print('  {:<8} {:>8.2f}MiB ({:>4.0%} of plain)  merge {:>8.4f}s'.format(
+                mode, retained_bytes / 2**20, retained_bytes / plain_bytes, merge_seconds))
+
+
+if __name__ == '__main__':
+    main()
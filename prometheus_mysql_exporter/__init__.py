@@ -1,21 +1,41 @@
+import asyncio
 import click
 import click_config_file
 import configparser
+import functools
 import glob
 import logging
 import os
 import pymysql
 import pytz
 import sched
+import signal
+import threading
+import time
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-from dbutils.persistent_db import PersistentDB
 from jog import JogFormatter
-from prometheus_client import start_http_server
 from prometheus_client.core import REGISTRY
 
-from .metrics import gauge_generator, group_metrics, merge_metric_dicts
-from .parser import parse_response
-from .scheduler import schedule_job
+from .exposition import ExpositionCache
+from .governor import QueryGovernor
+from .instrumentation import (QUERY_LAST_SUCCESS, QUERY_PHASE_SECONDS, QUERY_ROWS,
+                              QUERY_SERIES, SERIES_LIMIT_HITS)
+from .metrics import accumulate_metric_dict, update_metric_dict
+from .parser import limit_rows, ParsePlan, RowLimitError, SeriesLimitError
+from .pool import ConnectionPool
+from .profiling import make_debug_app, ProfileRequests
+from .routing import is_connection_error, ReplicaSet, RoutedPool
+from .scheduler import calc_cron_delay, calc_cron_elapsed, schedule_job, StaggerPlanner
+from .scrape import ScrapeTrigger
+from .server import make_exporter_app, start_http_server
+from .sharding import query_shard, QueryShards, ShardExpositionCache, exit_with_main_process
+from .state import StateStore
+from .store import compact_metric_dict, SeriesBudget
+from .timeout import query_timeout
 from .utils import log_exceptions, nice_shutdown
 
 log = logging.getLogger(__name__)
@@ -24,100 +44,744 @@ CONTEXT_SETTINGS = {
     'help_option_names': ['-h', '--help']
 }
 
+# Keyed by (target name, query name) tuples. The target name is None if not
+# running in multi-target mode.
+# NOTE: Metric dicts are updated in place by runs of their query, so must only
+#       be read by the thread running the query. Scrapes read the exposition
+#       cache instead, which is replaced wholesale, so always sees a consistent
+#       snapshot of a query's metrics.
 METRICS_BY_QUERY = {}
+# Guards METRICS_BY_QUERY, as queries may be run on multiple worker threads.
+METRICS_BY_QUERY_LOCK = threading.Lock()
+# The exposition text for the metrics in METRICS_BY_QUERY, rendered whenever
+# they're updated, rather than on every scrape.
+EXPOSITION_CACHE = ExpositionCache()
+# The budget for series stored in METRICS_BY_QUERY, across all queries.
+# Unlimited unless configured in cli().
+SERIES_BUDGET = SeriesBudget()
+# The watermarks of incremental queries, i.e. the largest value of their
+# watermark column seen so far. Keyed like METRICS_BY_QUERY. Incremental
+# queries accumulate their results, so their metrics are counters.
+# NOTE: Each entry is only accessed by the thread running its query.
+WATERMARKS = {}
+# Pushes the metrics in METRICS_BY_QUERY to a remote write endpoint, if
+# configured in cli().
+REMOTE_WRITER = None
+# Saves snapshots of the metrics in METRICS_BY_QUERY (and WATERMARKS) to disk,
+# to be restored after a restart, if configured in cli().
+STATE_STORE = None
+# The index of the shard of queries run by this process, if it's a worker
+# process started by QueryShards (see run_query_shard()). None in the main
+# process.
+QUERY_SHARD = None
+# Requests to profile the next run of a query, made via the debug endpoints,
+# if enabled in cli().
+PROFILE_REQUESTS = None
 
 
-class QueryMetricCollector(object):
+def series_counts():
+    """
+    Return the number of series stored for each query, keyed like
+    METRICS_BY_QUERY.
+    """
 
-    def collect(self):
-        # Copy METRICS_BY_QUERY before iterating over it
-        # as it may be updated by other threads.
-        # (only first level - lower levels are replaced
-        # wholesale, so don't worry about them)
-        query_metrics = METRICS_BY_QUERY.copy()
-        for metric_dict in query_metrics.values():
-            yield from gauge_generator(metric_dict)
+    # NOTE: Metric dicts may be updated by their query while being counted,
+    #       but copying a dict's values, and taking the length of a value
+    #       dict, are atomic.
+    with METRICS_BY_QUERY_LOCK:
+        metric_dicts = list(METRICS_BY_QUERY.items())
+    return {metrics_key: sum(len(value_dict) for _, _, value_dict in list(metric_dict.values()))
+            for metrics_key, metric_dict in metric_dicts}
 
 
-def run_query(mysql_client, query_name, db_name, query, value_columns,
-              on_error, on_missing):
+def store_metrics(metrics_key, metric_dict, changed, bytes_per_series=None, changes=None,
+                  persist=True):
+    """
+    Store the metric dict for a query, and render its exposition text if any
+    series have changed.
 
-    log.debug('Running query %(query_name)s.', {'query_name': query_name})
-    try:
-        conn = mysql_client.connection()
+    The series are counted against the series budget, using the estimated
+    memory use per series, if provided.
+
+    If remote write is configured, the changed series are pushed, as per the
+    changes list, if provided (see update_metric_dict()), or all series
+    otherwise.
+
+    If a state store is configured, and persist is set, a snapshot of the
+    metric dict is saved.
+    """
+
+    log.debug('Storing metrics for query %(query_name)s. %(changed)s series changed.',
+              {'query_name': metrics_key[1], 'changed': changed})
+
+    # Metrics sharing label keys (i.e. multiple value columns) are stored in
+    # compact form, to reduce memory use.
+    compact_metric_dict(metric_dict)
+
+    with METRICS_BY_QUERY_LOCK:
+        METRICS_BY_QUERY[metrics_key] = metric_dict
+
+    target_name, query_name = metrics_key
+    series = sum(len(value_dict) for _, _, value_dict in metric_dict.values())
+    SERIES_BUDGET.update(metrics_key, series, bytes_per_series)
+    QUERY_SERIES.labels(target_name or '', query_name).set(series)
+
+    if REMOTE_WRITER is not None:
+        REMOTE_WRITER.write(metrics_key, metric_dict, changes)
+
+    if STATE_STORE is not None and persist:
+        STATE_STORE.save(metrics_key, metric_dict, changed, WATERMARKS.get(metrics_key))
+
+    if changed and EXPOSITION_CACHE.enabled:
+        start_time = time.perf_counter()
+        metric_type = 'counter' if metrics_key in WATERMARKS else 'gauge'
+        EXPOSITION_CACHE.update(metrics_key, metric_dict, metric_type)
+        QUERY_PHASE_SECONDS.labels(query_name, 'render').observe(time.perf_counter() - start_time)
+
+
+def observe_query_phase(metrics_key, phase, start_time):
+    """
+    Record the duration of a phase of a query run, from start_time until now.
+    Returns the end time, so it can be used as the start time of the next phase.
+    """
+
+    end_time = time.perf_counter()
+    _, query_name = metrics_key
+    QUERY_PHASE_SECONDS.labels(query_name, phase).observe(end_time - start_time)
+    return end_time
+
+
+def parse_query_rows(metrics_key, parse_plan, rows, max_rows=None, max_series=None,
+                     on_missing='drop', metric_suffix=''):
+    """
+    Build a metric dict from query result rows using a parse plan, enforcing
+    the query's row and series limits, and the global series budget.
+
+    Unless on_missing is drop, series missing from the rows are kept when the
+    metric dict is merged into the query's stored metrics, so the stored
+    series count towards the limits too. The stored metric names have the
+    metric suffix, if any, appended to those from the parse plan.
+    """
+
+    # Limit series to the query's own limit, and what's left of the global
+    # budget, whichever is smaller.
+    budget_series, budget_bytes = SERIES_BUDGET.available(metrics_key)
+    if max_series is None or (budget_series is not None and budget_series < max_series):
+        limit_series = budget_series
+    else:
+        limit_series = max_series
+
+    stored_metric_dict = None
+    stored_bytes = 0
+    if on_missing != 'drop' and (limit_series is not None or budget_bytes is not None):
+        # NOTE: Only this thread updates the query's stored metrics.
+        with METRICS_BY_QUERY_LOCK:
+            stored_metric_dict = METRICS_BY_QUERY.get(metrics_key)
+        if stored_metric_dict is not None:
+            stored_metric_dict = {metric_name[:len(metric_name) - len(metric_suffix)]: metric
+                                  for metric_name, metric in stored_metric_dict.items()
+                                  if metric_name.endswith(metric_suffix)}
+            _, stored_bytes = SERIES_BUDGET.usage(metrics_key)
+
+    return parse_plan.parse_rows(limit_rows(rows, max_rows),
+                                 max_series=limit_series, max_bytes=budget_bytes,
+                                 stored_metric_dict=stored_metric_dict, stored_bytes=stored_bytes)
+
+
+def handle_series_limit(metrics_key, error, on_series_limit):
+    """
+    Handle a query run exceeding its series limit, as per on_series_limit.
+    Returns the truncated metric dict, or re-raises the SeriesLimitError.
+    """
+
+    target_name, query_name = metrics_key
+    if on_series_limit != 'truncate':
+        SERIES_LIMIT_HITS.labels(target_name or '', query_name, 'rejected').inc()
+        raise error
+
+    SERIES_LIMIT_HITS.labels(target_name or '', query_name, 'truncated').inc()
+    log.warning('Query %(query_name)s truncated: %(error)s',
+                {'query_name': query_name, 'error': error})
+    return error.metric_dict
+
+
+def store_query_error(metrics_key, on_error):
+    """
+    Update the stored metrics of a query after a failed run, as per on_error.
+    """
+
+    # If this query has successfully run before, we need to handle any
+    # metrics produced by that previous run.
+    # NOTE: The scheduler never runs the same query concurrently, so only
+    #       this thread can update this query's entry between the read
+    #       and write of METRICS_BY_QUERY below.
+    with METRICS_BY_QUERY_LOCK:
+        old_metric_dict = METRICS_BY_QUERY.get(metrics_key)
+
+    if old_metric_dict is not None:
+        # Updating the old metric dict with an empty one, handling missing
+        # metrics as per on_error, preserves, drops, or zeros all the old
+        # metrics.
+        changes = [] if REMOTE_WRITER is not None else None
+        changed = update_metric_dict(old_metric_dict, {}, on_missing=on_error, changes=changes)
+        store_metrics(metrics_key, old_metric_dict, changed, changes=changes)
+
+
+def store_query_result(metrics_key, metric_dict, parse_plan, row_count, on_missing,
+                       accumulate=False):
+    """
+    Update the stored metrics of a query with the metric dict from a
+    successful run, handling missing metrics as per on_missing.
+
+    If accumulate is set, the values from the run are added to the stored
+    values instead (see accumulate_metric_dict()), and on_missing is ignored.
+    """
+
+    target_name, query_name = metrics_key
+    QUERY_LAST_SUCCESS.labels(target_name or '', query_name).set_to_current_time()
+    if row_count is not None:
+        QUERY_ROWS.labels(target_name or '', query_name).set(row_count)
+
+    bytes_per_series = None
+    if parse_plan.series and parse_plan.estimated_bytes is not None:
+        bytes_per_series = parse_plan.estimated_bytes / parse_plan.series
+
+    # If this query has successfully run before, we need to handle any
+    # missing metrics.
+    with METRICS_BY_QUERY_LOCK:
+        old_metric_dict = METRICS_BY_QUERY.get(metrics_key)
+
+    if old_metric_dict is not None:
+        # Apply the changes in place, rather than building a merged copy.
+        # Only collect the changed series if they're going to be pushed.
+        changes = [] if REMOTE_WRITER is not None else None
+        start_time = time.perf_counter()
+        if accumulate:
+            changed = accumulate_metric_dict(old_metric_dict, metric_dict, changes=changes)
+        else:
+            changed = update_metric_dict(old_metric_dict, metric_dict, on_missing=on_missing,
+                                         changes=changes)
+        observe_query_phase(metrics_key, 'merge', start_time)
+        store_metrics(metrics_key, old_metric_dict, changed, bytes_per_series, changes)
+
+    else:
+        changed = sum(len(value_dict) for _, _, value_dict in metric_dict.values())
+        store_metrics(metrics_key, metric_dict, changed, bytes_per_series)
 
+
+def handle_query_response(metrics_key, db_name, value_columns, description, rows,
+                          on_error, on_missing, max_rows=None, max_series=None,
+                          on_series_limit='reject'):
+    """
+    Parse a buffered query response, and update the query's stored metrics.
+
+    Used when a response is shared by several queries, so errors are handled
+    here as per on_error, rather than affecting the other queries.
+    """
+
+    target_name, query_name = metrics_key
+    try:
         try:
-            with conn.cursor() as cursor:
-                cursor.execute('USE `{}`;'.format(db_name))
-                cursor.execute(query)
-                raw_response = cursor.fetchall()
-                columns = [column[0] for column in cursor.description]
+            start_time = time.perf_counter()
+            parse_plan = ParsePlan(query_name, db_name, value_columns, description,
+                                   target_name=target_name)
+            metric_dict = parse_query_rows(metrics_key, parse_plan, rows, max_rows, max_series,
+                                           on_missing)
+            observe_query_phase(metrics_key, 'parse', start_time)
+        except SeriesLimitError as e:
+            metric_dict = handle_series_limit(metrics_key, e, on_series_limit)
+
+    except Exception:
+        log.exception('Error while handling results of query %(query_name)s.',
+                      {'query_name': query_name})
+        store_query_error(metrics_key, on_error)
+
+    else:
+        store_query_result(metrics_key, metric_dict, parse_plan, len(rows), on_missing)
+
+
+def find_shared_queries(queries, batch_size=1):
+    """
+    Group queries that can share a single run, i.e. that have the same
+    database, statement, schedule, timeout, and routing (QueryTarget).
+
+    Takes queries in the form returned by load_config(). Returns a list of
+    lists of query names, one list per group, in config order. Streamed queries aren't
+    grouped, as their results aren't buffered, so can't be shared. Incremental
+    queries aren't grouped either, as each has its own watermark.
+
+    On-scrape queries are grouped if they have the same cache TTL, rather than
+    the same schedule.
+
+    If batch_size is more than 1, groups with different statements, but the
+    same database, schedule, timeout, and routing, are also combined, up to
+    batch_size statements per group, so they can be run as a single batch (see
+    run_batched_queries()).
+    """
+
+    groups = {}
+    batch_keys = {}
+    for query_name, query_config in queries.items():
+        if query_config.mode == 'on_scrape':
+            schedule_key = (query_config.mode, query_config.cache_ttl)
+        else:
+            # Intervals are irrelevant to cron based queries.
+            schedule_key = (None if query_config.cron else query_config.interval,
+                            query_config.cron, str(query_config.cron_tz))
+
+        if query_config.stream or query_config.mode == 'incremental':
+            group_key = batch_key = query_name
+        else:
+            batch_key = (query_config.db_name, schedule_key, query_config.timeout,
+                         query_config.routing)
+            group_key = (query_config.query.strip(),) + batch_key
+        groups.setdefault(group_key, []).append(query_name)
+        batch_keys[group_key] = batch_key
+
+    if batch_size <= 1:
+        return list(groups.values())
+
+    batches = {}
+    for group_key, query_names in groups.items():
+        batches.setdefault(batch_keys[group_key], []).append(query_names)
+
+    query_groups = []
+    for statement_groups in batches.values():
+        for start in range(0, len(statement_groups), batch_size):
+            query_groups.append([query_name
+                                 for query_names in statement_groups[start:start + batch_size]
+                                 for query_name in query_names])
+    return query_groups
+
+
+def shard_queries(queries, shard_index, shard_count):
+    """
+    Select the queries run by a process, when queries are split between
+    shard_count worker processes.
+
+    Scheduled queries are run by the worker for their shard (see
+    query_shard()), so shard_index is the index of the worker's shard.
+    On-scrape queries are run by the main process (where shard_index is None),
+    as they're triggered by scrapes.
+    """
+
+    if shard_count <= 1:
+        return queries
+
+    if shard_index is None:
+        return {query_name: query_config for query_name, query_config in queries.items()
+                if query_config.mode == 'on_scrape'}
+
+    return {query_name: query_config for query_name, query_config in queries.items()
+            if query_config.mode != 'on_scrape'
+            and query_shard(query_name, shard_count) == shard_index}
+
+
+@contextmanager
+def result_cursor(conn, max_rows=None):
+    """
+    Open a cursor to fetch the full result of a query with fetch_rows().
+
+    Buffered cursors read the full result into memory as soon as the query is
+    executed. If rows are limited, an unbuffered cursor is used instead, so a
+    result with too many rows is abandoned as soon as the limit is passed,
+    rather than being read in full only to be rejected.
+    """
+
+    if max_rows is None:
+        with conn.cursor() as cursor:
+            yield cursor
+        return
+
+    cursor = conn.cursor(pymysql.cursors.SSCursor)
+    try:
+        yield cursor
+    except Exception:
+        # Closing an unbuffered cursor reads the rest of the result, which
+        # could be huge. Close the connection instead, abandoning the result.
+        conn.close()
+        raise
+    cursor.close()
+
+
+def fetch_rows(cursor, max_rows=None):
+    """
+    Fetch the rows of a query result from a cursor opened by result_cursor(),
+    raising a RowLimitError if there are more than max_rows of them.
+    """
+
+    if max_rows is None:
+        return cursor.fetchall()
+
+    rows = cursor.fetchmany(max_rows + 1)
+    if len(rows) > max_rows:
+        raise RowLimitError('Query response has more than {} rows.'.format(max_rows))
+    return rows
 
-        finally:
-            conn.close()
 
-        response = [{column: row[i] for i, column in enumerate(columns)}
-                    for row in raw_response]
-        metrics = parse_response(query_name, db_name, value_columns, response)
-        metric_dict = group_metrics(metrics)
+def run_shared_query(mysql_pool, target_name, db_name, query, timeout, dependents):
+    """
+    Run a query statement shared by several queries once, and update the
+    stored metrics of each query from the response.
+
+    Dependents are (query name, value columns, on_error, on_missing, max_rows,
+    max_series, on_series_limit) tuples.
+
+    Returns False if the query failed.
+    """
+
+    log.debug('Running shared query for queries %(query_names)s.',
+              {'query_names': ', '.join(query_name for query_name, *_ in dependents)})
+    # Each dependent checks its own row limit, so only the most rows any of
+    # them accepts need be fetched.
+    max_rows = None
+    if all(dependent[4] is not None for dependent in dependents):
+        max_rows = max(dependent[4] for dependent in dependents)
+
+    def execute_query(conn):
+        with query_timeout(mysql_pool.kill_connect(conn), conn.thread_id(), timeout):
+            with result_cursor(conn, max_rows) as cursor:
+                start_time = time.perf_counter()
+                cursor.execute(query)
+                execute_time = time.perf_counter()
+                raw_response = fetch_rows(cursor, max_rows)
+                fetch_time = time.perf_counter()
+                return (cursor.description, raw_response,
+                        execute_time - start_time, fetch_time - execute_time)
+
+    try:
+        response = mysql_pool.run(execute_query)
 
     except Exception:
         log.exception('Error while querying db %(db_name)s, query %(query)s.',
                       {'db_name': db_name, 'query': query})
+        for query_name, _, on_error, *_ in dependents:
+            store_query_error((target_name, query_name), on_error)
+        return False
+
+    description, raw_response, execute_duration, fetch_duration = response
+    for (query_name, value_columns, on_error, on_missing,
+         max_rows, max_series, on_series_limit) in dependents:
+        QUERY_PHASE_SECONDS.labels(query_name, 'execute').observe(execute_duration)
+        QUERY_PHASE_SECONDS.labels(query_name, 'fetch').observe(fetch_duration)
+        handle_query_response((target_name, query_name), db_name, value_columns,
+                              description, raw_response, on_error, on_missing,
+                              max_rows, max_series, on_series_limit)
+
+
+def batch_statement(queries):
+    """
+    Join query statements into a single multi-statement query.
+
+    Statements are separated by semicolons on their own line, in case a
+    statement ends with a comment.
+    """
+
+    return '\n;\n'.join(query.strip().rstrip(';') for query in queries)
+
+
+def run_batched_queries(mysql_pool, target_name, db_name, statements, timeout):
+    """
+    Run several query statements as a single multi-statement query, and
+    update the stored metrics of each query from its statement's result set.
+
+    Statements are (query statement, dependents) tuples, with dependents as per
+    run_shared_query(). The timeout applies to the batch as a whole.
+
+    MySQL stops running a multi-statement query at the first statement that
+    fails. That statement's queries are handled as per their on_error, and
+    the rest of the statements are re-run as a new batch, so errors only
+    affect the queries of the failed statement. Connection errors and timeouts
+    affect all queries not yet handled.
+
+    Returns False if the batch failed due to the connection (e.g. a lost
+    connection, or timeout). A failed statement only affects its own queries,
+    so doesn't count as the batch failing.
+    """
+
+    log.debug('Running batch of %(count)s statements on db %(db_name)s.',
+              {'count': len(statements), 'db_name': db_name})
+
+    def execute_batch(batch, responses, conn):
+        # Start afresh if the batch is run again on another server.
+        responses.clear()
+        with query_timeout(mysql_pool.kill_connect(conn), conn.thread_id(), timeout):
+            with conn.cursor() as cursor:
+                start_time = time.perf_counter()
+                cursor.execute(batch_statement(query for query, _ in batch))
+                while True:
+                    execute_time = time.perf_counter()
+                    raw_response = cursor.fetchall()
+                    fetch_time = time.perf_counter()
+                    responses.append((cursor.description, raw_response,
+                                      execute_time - start_time,
+                                      fetch_time - execute_time))
+                    if len(responses) == len(batch):
+                        break
+                    # Reading the next result set waits for its statement to
+                    # run, so counts as executing it.
+                    start_time = time.perf_counter()
+                    if not cursor.nextset():
+                        break
+
+    ok = None
+    remaining = statements
+    while remaining:
+        # (description, rows, execute duration, fetch duration) per statement
+        responses = []
+        error = None
+        try:
+            mysql_pool.run(functools.partial(execute_batch, remaining, responses))
+        except Exception as e:
+            error = e
+
+        for (query, dependents), (description, raw_response,
+                                  execute_duration, fetch_duration) in zip(remaining, responses):
+            for (query_name, value_columns, on_error, on_missing,
+                 max_rows, max_series, on_series_limit) in dependents:
+                QUERY_PHASE_SECONDS.labels(query_name, 'execute').observe(execute_duration)
+                QUERY_PHASE_SECONDS.labels(query_name, 'fetch').observe(fetch_duration)
+                handle_query_response((target_name, query_name), db_name, value_columns,
+                                      description, raw_response, on_error, on_missing,
+                                      max_rows, max_series, on_series_limit)
+
+        remaining = remaining[len(responses):]
+        if not remaining:
+            break
+
+        if error is None:
+            log.error('Batch on db %(db_name)s returned fewer result sets than statements. '
+                      'Does a statement contain multiple statements?',
+                      {'db_name': db_name})
+            failed, remaining = remaining, []
+
+        elif isinstance(error, pymysql.MySQLError) and not is_connection_error(error):
+            log.error('Error while querying db %(db_name)s, query %(query)s.',
+                      {'db_name': db_name, 'query': remaining[0][0]}, exc_info=error)
+            failed, remaining = remaining[:1], remaining[1:]
+
+        else:
+            log.error('Error while running batch on db %(db_name)s. '
+                      '%(count)s statements were not run.',
+                      {'db_name': db_name, 'count': len(remaining)}, exc_info=error)
+            failed, remaining = remaining, []
+            ok = False
+
+        for _, dependents in failed:
+            for query_name, _, on_error, *_ in dependents:
+                store_query_error((target_name, query_name), on_error)
+
+    return ok
 
-        # If this query has successfully run before, we need to handle any
-        # metrics produced by that previous run.
-        if query_name in METRICS_BY_QUERY:
-            old_metric_dict = METRICS_BY_QUERY[query_name]
 
-            if on_error == 'preserve':
-                metric_dict = old_metric_dict
+def run_query(mysql_pool, target_name, query_name, db_name, query, value_columns,
+              on_error, on_missing, timeout=None, stream=False, max_rows=None,
+              max_series=None, on_series_limit='reject'):
+    """
+    Run a query, and update its stored metrics. Returns False if the query
+    failed, other than by exceeding its series limit.
+    """
 
-            elif on_error == 'drop':
-                metric_dict = {}
+    log.debug('Running query %(query_name)s.', {'query_name': query_name})
+    metrics_key = (target_name, query_name)
+    parse_plan = None
+    row_count = None
+
+    def build_metric_dict(description, rows):
+        nonlocal parse_plan
+        # Metric names and label keys depend only on the response's columns,
+        # so work them out once, rather than for every row.
+        parse_plan = ParsePlan(query_name, db_name, value_columns, description,
+                               target_name=target_name)
+        return parse_query_rows(metrics_key, parse_plan, rows, max_rows, max_series,
+                                on_missing)
+
+    def execute_query(conn):
+        nonlocal row_count
+        # Pooled connections are already using the query's database, so no
+        # `USE` statement is needed.
+        with query_timeout(mysql_pool.kill_connect(conn), conn.thread_id(), timeout):
+            if stream:
+                # Use an unbuffered cursor, and build the metric dict as
+                # rows are received, so the full result is never held in
+                # memory.
+                cursor = conn.cursor(pymysql.cursors.SSCursor)
+                try:
+                    start_time = time.perf_counter()
+                    cursor.execute(query)
+                    start_time = observe_query_phase(metrics_key, 'execute', start_time)
+                    metric_dict = build_metric_dict(cursor.description, cursor)
+                    observe_query_phase(metrics_key, 'parse', start_time)
+                    row_count = cursor.rownumber
+                except Exception:
+                    # Closing an unbuffered cursor reads the rest of the
+                    # result, which could be huge. Close the connection
+                    # instead, abandoning the result.
+                    conn.close()
+                    raise
+                cursor.close()
+                return metric_dict
+
+            with result_cursor(conn, max_rows) as cursor:
+                start_time = time.perf_counter()
+                cursor.execute(query)
+                start_time = observe_query_phase(metrics_key, 'execute', start_time)
+                raw_response = fetch_rows(cursor, max_rows)
+                observe_query_phase(metrics_key, 'fetch', start_time)
+                return cursor.description, raw_response
 
-            elif on_error == 'zero':
-                # Merging the old metric dict with an empty one, and zeroing
-                # any missing metrics, produces a metric dict with the same
-                # metrics, but all zero values.
-                metric_dict = merge_metric_dicts(old_metric_dict, {},
-                                                 zero_missing=True)
+    def run_query_once():
+        nonlocal row_count
+        # Buffered results are parsed once the connection is released, so
+        # they're parsed only once, even if the query is run again on another
+        # server.
+        response = mysql_pool.run(execute_query)
+        if stream:
+            return response
+        description, raw_response = response
+        row_count = len(raw_response)
+        start_time = time.perf_counter()
+        metric_dict = build_metric_dict(description, raw_response)
+        observe_query_phase(metrics_key, 'parse', start_time)
+        return metric_dict
 
-            METRICS_BY_QUERY[query_name] = metric_dict
+    try:
+        try:
+            metric_dict = run_query_once()
+        except SeriesLimitError as e:
+            metric_dict = handle_series_limit(metrics_key, e, on_series_limit)
+
+    except Exception as e:
+        log.exception('Error while querying db %(db_name)s, query %(query)s.',
+                      {'db_name': db_name, 'query': query})
+        store_query_error(metrics_key, on_error)
+        # Exceeding a series limit is down to the query's results, rather than
+        # the database, so doesn't count as a failed run.
+        return isinstance(e, SeriesLimitError)
 
     else:
-        # If this query has successfully run before, we need to handle any
-        # missing metrics.
-        if query_name in METRICS_BY_QUERY:
-            old_metric_dict = METRICS_BY_QUERY[query_name]
+        store_query_result(metrics_key, metric_dict, parse_plan, row_count, on_missing)
 
-            if on_missing == 'preserve':
-                metric_dict = merge_metric_dicts(old_metric_dict, metric_dict,
-                                                 zero_missing=False)
 
-            elif on_missing == 'drop':
-                pass  # use new metric dict untouched
+def run_incremental_query(mysql_pool, target_name, query_name, db_name, query,
+                          value_columns, timeout=None, max_rows=None, max_series=None,
+                          watermark_column='watermark', watermark_start='0'):
+    """
+    Run an incremental query, which only reads rows added since its last run,
+    and add its results to its stored metrics, which are counters.
 
-            elif on_missing == 'zero':
-                metric_dict = merge_metric_dicts(old_metric_dict, metric_dict,
-                                                 zero_missing=True)
+    The query's watermark (initially watermark_start) is substituted into the
+    statement for {watermark}, escaped as a string literal. After each
+    successful run, it's advanced to the largest value of the watermark column
+    in the results. The watermark column isn't included in the metrics.
 
-        METRICS_BY_QUERY[query_name] = metric_dict
+    The stored metrics are always preserved after a failed run, as the
+    watermark is, so the counters stay consistent with it. Runs exceeding the
+    series limit always fail, rather than being truncated, as the rows not
+    parsed would be behind the new watermark, so never counted.
 
+    Returns False if the query failed, other than by exceeding its series
+    limit.
+    """
 
-def validate_server_address(ctx, param, address_string):
+    log.debug('Running incremental query %(query_name)s.', {'query_name': query_name})
+    metrics_key = (target_name, query_name)
+    watermark = WATERMARKS.setdefault(metrics_key, watermark_start)
+    parse_plan = None
+    new_watermark = None
+
+    def execute_query(conn):
+        with query_timeout(mysql_pool.kill_connect(conn), conn.thread_id(), timeout):
+            with result_cursor(conn, max_rows) as cursor:
+                start_time = time.perf_counter()
+                cursor.execute(query.replace('{watermark}', conn.escape(watermark)))
+                start_time = observe_query_phase(metrics_key, 'execute', start_time)
+                raw_response = fetch_rows(cursor, max_rows)
+                observe_query_phase(metrics_key, 'fetch', start_time)
+                return cursor.description, raw_response
+
+    try:
+        try:
+            description, raw_response = mysql_pool.run(execute_query)
+
+            start_time = time.perf_counter()
+            column_names = [column[0] for column in description]
+            if watermark_column not in column_names:
+                raise ValueError('Watermark column {} not in results of query {}.'.format(
+                    watermark_column, query_name))
+
+            # Remove the watermark column, so it isn't treated as a label.
+            i = column_names.index(watermark_column)
+            watermarks = [row[i] for row in raw_response if row[i] is not None]
+            if watermarks:
+                new_watermark = max(watermarks)
+            description = description[:i] + description[i + 1:]
+            rows = [row[:i] + row[i + 1:] for row in raw_response]
+
+            parse_plan = ParsePlan(query_name, db_name, value_columns, description,
+                                   target_name=target_name)
+            # Results are accumulated, so all the stored series are kept.
+            metric_dict = parse_query_rows(metrics_key, parse_plan, rows, max_rows, max_series,
+                                           on_missing='preserve', metric_suffix='_total')
+            observe_query_phase(metrics_key, 'parse', start_time)
+        except SeriesLimitError as e:
+            handle_series_limit(metrics_key, e, 'reject')
+
+    except Exception as e:
+        log.exception('Error while querying db %(db_name)s, query %(query)s.',
+                      {'db_name': db_name, 'query': query})
+        store_query_error(metrics_key, 'preserve')
+        # Exceeding a series limit is down to the query's results, rather than
+        # the database, so doesn't count as a failed run.
+        return isinstance(e, SeriesLimitError)
+
+    # Counter names end in _total, by convention.
+    metric_dict = {metric_name + '_total': metric for metric_name, metric in metric_dict.items()}
+    # Advance the watermark first, so it's saved along with the metrics.
+    if new_watermark is not None:
+        WATERMARKS[metrics_key] = new_watermark
+    store_query_result(metrics_key, metric_dict, parse_plan, len(raw_response), 'preserve',
+                       accumulate=True)
+
+
+def parse_server_address(address_string):
     if ':' in address_string:
         host, port_string = address_string.split(':', 1)
         try:
             port = int(port_string)
         except ValueError:
             msg = "port '{}' in address '{}' is not an integer".format(port_string, address_string)
-            raise click.BadParameter(msg)
+            raise ValueError(msg)
         return (host, port)
     else:
         return (address_string, 3306)
 
 
+def validate_server_address(ctx, param, address_string):
+    try:
+        return parse_server_address(address_string)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def validate_server_addresses(ctx, param, address_strings):
+    try:
+        return tuple(parse_server_address(address_string) for address_string in address_strings)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def validate_labels(ctx, param, label_strings):
+    labels = {}
+    for label_string in label_strings:
+        label_key, sep, label_value = label_string.partition('=')
+        if not sep or not label_key:
+            raise click.BadParameter('Label {} must be of the form name=value.'.format(
+                label_string))
+        labels[label_key] = label_value
+    return labels
+
+
 def configparser_enum_conv(enum):
     lower_enums = tuple(e.lower() for e in enum)
 
@@ -133,14 +797,628 @@ def configparser_enum_conv(enum):
 
 
 CONFIGPARSER_CONVERTERS = {
-    'enum': configparser_enum_conv(('preserve', 'drop', 'zero'))
+    'enum': configparser_enum_conv(('preserve', 'drop', 'zero')),
+    'limitaction': configparser_enum_conv(('reject', 'truncate')),
+    'querymode': configparser_enum_conv(('scheduled', 'on_scrape', 'incremental')),
+    'querypriority': configparser_enum_conv(('normal', 'low')),
+    'querytarget': configparser_enum_conv(('primary', 'replica', 'any')),
 }
 
 
+def config_files(config_file_path, config_dir):
+    """
+    Return the paths of the query config files, in merge order: the main config
+    file, then config directory files in filename order.
+    """
+
+    config_dir_file_pattern = os.path.join(config_dir, '*.cfg')
+    return [config_file_path] + sorted(glob.glob(config_dir_file_pattern))
+
+
+def config_signature(paths):
+    """
+    Return a signature of the config files at the given paths, which changes
+    if any of them are modified, added, or removed.
+    """
+
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        signature.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+# The config of a query, as loaded from its config file section.
+QueryConfig = namedtuple('QueryConfig', (
+    'interval', 'cron', 'cron_tz', 'db_name', 'query', 'value_columns',
+    'on_error', 'on_missing', 'timeout', 'stream', 'max_rows', 'max_series',
+    'on_series_limit', 'mode', 'cache_ttl', 'priority', 'watermark_column',
+    'watermark_start', 'state_max_age', 'routing'))
+
+
+def load_config(config_file_path, config_dir, default_target, default_timeout=None):
+    """
+    Parse the query config file and config directory files, returning
+    (queries, targets) dicts. Queries are keyed by name, with QueryConfig
+    values.
+
+    default_target is a (host, port, username, password, replicas) tuple for
+    the MySQL server from the options, where replicas is a tuple of
+    (host, port) tuples for its read replicas. Targets without their own user
+    and password use those from the options. If no targets are configured, the
+    server from the options is the only target, with the name None.
+
+    default_timeout is the timeout of queries that don't set QueryTimeoutSecs.
+    """
+
+    config_file_path, *config_dir_sorted_files = config_files(config_file_path, config_dir)
+    mysql_host, mysql_port, mysql_username, mysql_password, mysql_replicas = default_target
+
+    config = configparser.ConfigParser(converters=CONFIGPARSER_CONVERTERS)
+    with open(config_file_path) as config_file:
+        config.read_file(config_file)
+    config.read(config_dir_sorted_files)
+
+    query_prefix = 'query_'
+    queries = {}
+    for section in config.sections():
+        if section.startswith(query_prefix):
+            query_name = section[len(query_prefix):]
+            interval = config.getfloat(section, 'QueryIntervalSecs',
+                                       fallback=15)
+            cron = config.get(section, 'QueryCron',
+                              fallback=None)
+            cron_tz = config.get(section, 'QueryCronTimezone',
+                                 fallback=None)
+            if cron_tz is not None:
+                cron_tz = pytz.timezone(cron_tz)
+            db_name = config.get(section, 'QueryDatabase')
+            query = config.get(section, 'QueryStatement')
+            value_columns = config.get(section, 'QueryValueColumns').split(',')
+            on_error = config.getenum(section, 'QueryOnError',
+                                      fallback='drop')
+            on_missing = config.getenum(section, 'QueryOnMissing',
+                                        fallback='drop')
+            timeout = config.getfloat(section, 'QueryTimeoutSecs',
+                                      fallback=default_timeout)
+            stream = config.getboolean(section, 'QueryStreamResults',
+                                       fallback=False)
+            max_rows = config.getint(section, 'QueryMaxRows',
+                                     fallback=None)
+            max_series = config.getint(section, 'QueryMaxSeries',
+                                       fallback=None)
+            on_series_limit = config.getlimitaction(section, 'QueryOnSeriesLimit',
+                                                    fallback='reject')
+            mode = config.getquerymode(section, 'QueryMode',
+                                       fallback='scheduled')
+            cache_ttl = config.getfloat(section, 'QueryCacheTTLSecs',
+                                        fallback=interval)
+            priority = config.getquerypriority(section, 'QueryPriority',
+                                               fallback='normal')
+            watermark_column = None
+            watermark_start = None
+            if mode == 'incremental':
+                watermark_column = config.get(section, 'QueryWatermarkColumn')
+                watermark_start = config.get(section, 'QueryWatermarkStart',
+                                             fallback='0')
+                if on_series_limit == 'truncate':
+                    # Rows not parsed would be behind the new watermark, so
+                    # never counted.
+                    raise ValueError('Query {} has QueryMode = incremental, which does not '
+                                     'support QueryOnSeriesLimit = truncate.'.format(query_name))
+            state_max_age = config.getfloat(section, 'QueryStateMaxAgeSecs',
+                                            fallback=None)
+            routing = config.getquerytarget(section, 'QueryTarget',
+                                            fallback='primary')
+
+            queries[query_name] = QueryConfig(interval, cron, cron_tz,
+                                              db_name, query, value_columns,
+                                              on_error, on_missing, timeout,
+                                              stream, max_rows, max_series, on_series_limit,
+                                              mode, cache_ttl, priority,
+                                              watermark_column, watermark_start,
+                                              state_max_age, routing)
+
+    target_prefix = 'target_'
+    targets = {}
+    for section in config.sections():
+        if section.startswith(target_prefix):
+            target_name = section[len(target_prefix):]
+            target_host, target_port = parse_server_address(config.get(section, 'MysqlServer'))
+            target_username = config.get(section, 'MysqlUser',
+                                         fallback=mysql_username)
+            target_password = config.get(section, 'MysqlPassword',
+                                         fallback=mysql_password)
+            target_replicas = tuple(parse_server_address(address.strip())
+                                    for address in config.get(section, 'MysqlReplicas',
+                                                              fallback='').split(',')
+                                    if address.strip())
+
+            targets[target_name] = (target_host, target_port,
+                                    target_username, target_password,
+                                    target_replicas)
+
+    # If no targets are configured, run in single target mode, using the MySQL
+    # server from the options.
+    if not targets:
+        targets[None] = (mysql_host, mysql_port,
+                         mysql_username, mysql_password,
+                         mysql_replicas)
+
+    return queries, targets
+
+
+def restore_query(metrics_key, max_age=None):
+    """
+    Restore the stored metrics of a query (and its watermark, if incremental)
+    from its snapshot in the state store, if it's no older than max_age
+    seconds. Returns the age of the snapshot, or None if there wasn't one.
+    """
+
+    state = STATE_STORE.load(metrics_key, max_age)
+    if state is None:
+        return None
+
+    metric_dict, watermark, age = state
+    if watermark is not None:
+        WATERMARKS[metrics_key] = watermark
+    changed = sum(len(value_dict) for _, _, value_dict in metric_dict.values())
+    # The snapshot is already saved, and saving it again would make it look
+    # newer than it is.
+    store_metrics(metrics_key, metric_dict, changed, persist=False)
+
+    log.info('Restored %(series)s series for query %(query_name)s from a %(age).0fs old '
+             'snapshot.', {'series': changed, 'query_name': metrics_key[1], 'age': age})
+    return age
+
+
+def target_servers(target, routing):
+    """
+    Return the servers of a target that queries with the given routing policy
+    (QueryTarget) may run on, as a list of (server name, server config) tuples,
+    starting with the primary, if included.
+
+    Server configs are (host, port, username, password) tuples. Replicas use
+    the same user and password as the primary.
+    """
+
+    host, port, username, password, replicas = target
+    servers = [('{}:{}'.format(host, port), (host, port, username, password))]
+    servers.extend(('{}:{}'.format(replica_host, replica_port),
+                    (replica_host, replica_port, username, password))
+                   for replica_host, replica_port in replicas)
+
+    if routing == 'primary' or not replicas:
+        return servers[:1]
+    if routing == 'replica':
+        return servers[1:]
+    return servers
+
+
+def forget_query(metrics_key):
+    """
+    Remove the stored metrics of a query that's no longer configured.
+    """
+
+    with METRICS_BY_QUERY_LOCK:
+        metric_dict = METRICS_BY_QUERY.pop(metrics_key, None)
+    WATERMARKS.pop(metrics_key, None)
+    EXPOSITION_CACHE.remove(metrics_key)
+    if STATE_STORE is not None:
+        STATE_STORE.remove(metrics_key)
+    if REMOTE_WRITER is not None and metric_dict is not None:
+        REMOTE_WRITER.forget(metrics_key, metric_dict)
+    SERIES_BUDGET.update(metrics_key, 0)
+
+    target_name, query_name = metrics_key
+    for gauge in (QUERY_ROWS, QUERY_SERIES, QUERY_LAST_SUCCESS):
+        try:
+            gauge.remove(target_name or '', query_name)
+        except KeyError:
+            # The query never got far enough to set the gauge.
+            pass
+
+
+class QueryJobs(object):
+    """
+    The jobs running each query (or group of shared queries) on each target,
+    and the connection pools they use.
+
+    Queries are routed to the read replicas of targets that have them, as per
+    their QueryTarget, and the replication lag of each replica is checked
+    every replica_check_interval seconds. Replicas lagging by more than
+    replica_max_lag seconds aren't used.
+
+    Jobs are configured via update(), which only cancels and starts the jobs
+    whose query or target config has changed since the last update. Other jobs
+    keep their schedules, and targets keep their connection pools. Stored
+    metrics are kept for every query that's still configured, so they carry
+    over to a changed query's new job.
+
+    Idle connections are evicted from the connection pools every
+    pool_sweep_interval seconds, so pools of queries that run less often than
+    the pool idle timeout don't keep connections open between runs.
+
+    Must be used from the scheduler's thread, as it cancels scheduled jobs.
+    """
+
+    def __init__(self, scheduler, scrape_trigger, mysql_kwargs, pool_kwargs,
+                 executor=None, planner=None, governor=None, jitter=0, batch_size=1,
+                 replica_max_lag=30, replica_check_interval=5, pool_sweep_interval=30):
+        self.scheduler = scheduler
+        self.scrape_trigger = scrape_trigger
+        self.mysql_kwargs = mysql_kwargs
+        self.pool_kwargs = pool_kwargs
+        self.executor = executor
+        self.planner = planner
+        self.governor = governor
+        self.jitter = jitter
+        self.batch_size = batch_size
+        self.replica_max_lag = replica_max_lag
+        self.replica_check_interval = replica_check_interval
+        # Names of the configured targets, other than None. Updated in place,
+        # so it can be shared with the exporter app.
+        self.target_names = set()
+        # (target name, query names tuple) -> (job config, cancel function)
+        self._jobs = {}
+        # (server config, db name) -> connection pool
+        self._pools = {}
+        # (target name, target config) -> (replica set, check pools, cancel function)
+        self._replica_sets = {}
+        self._scrape_workers = 0
+
+        schedule_job(self.scheduler, pool_sweep_interval, None, None, self._evict_idle,
+                     name='pool-sweep')
+
+    def update(self, targets, queries):
+        """
+        Apply the current targets and queries, in the form returned by
+        load_config().
+        """
+
+        query_groups = find_shared_queries(queries, self.batch_size)
+        job_configs = {}
+        for target_name, target in targets.items():
+            for query_names in query_groups:
+                job_configs[(target_name, tuple(query_names))] = (
+                    target, [queries[query_name] for query_name in query_names])
+        metrics_keys = {(target_name, query_name)
+                        for target_name, query_names in job_configs
+                        for query_name in query_names}
+
+        stopped = 0
+        # metrics key -> future of an in-progress run of a stopped job
+        running_runs = {}
+        for job_key, (job_config, cancel) in list(self._jobs.items()):
+            if job_configs.get(job_key) == job_config:
+                continue
+
+            del self._jobs[job_key]
+            running = cancel()
+            stopped += 1
+
+            target_name, query_names = job_key
+            if running is not None:
+                running_runs.update(((target_name, query_name), running)
+                                    for query_name in query_names)
+            # Forget the stored metrics (and watermarks) of removed queries,
+            # and of queries switched to or from incremental mode, as their
+            # metrics are of a different type.
+            removed_keys = [(target_name, query_name)
+                            for query_name, query_config in zip(query_names, job_config[1])
+                            if (target_name, query_name) not in metrics_keys
+                            or ((query_config.mode == 'incremental')
+                                != (queries[query_name].mode == 'incremental'))]
+            if removed_keys:
+                # Let an in-progress run finish storing its metrics first.
+                if running is None:
+                    self._forget(removed_keys)
+                else:
+                    running.add_done_callback(
+                        lambda _, removed_keys=removed_keys: self._forget(removed_keys))
+
+        started = 0
+        for job_key, job_config in job_configs.items():
+            if job_key not in self._jobs:
+                target_name, query_names = job_key
+                running = {running_runs[(target_name, query_name)]
+                           for query_name in query_names
+                           if (target_name, query_name) in running_runs}
+                if running:
+                    # Let in-progress runs of the jobs being replaced finish
+                    # first, so runs of the same query don't overlap, or record
+                    # their run times for the new job.
+                    cancel = self._start_job_after(job_key, job_config, running)
+                else:
+                    cancel = self._start_job(job_key, job_config)
+                self._jobs[job_key] = (job_config, cancel)
+                started += 1
+
+                if len({query_config.query.strip() for query_config in job_config[1]}) > 1:
+                    log.info('Queries %(query_names)s have the same database and schedule. '
+                             'Running them as a single batch.',
+                             {'query_names': ', '.join(query_names)})
+                elif len(query_names) > 1:
+                    log.info('Queries %(query_names)s have the same statement and schedule. '
+                             'Running them as a single shared query.',
+                             {'query_names': ', '.join(query_names)})
+
+        # Close the connection pools of removed or changed targets, and
+        # databases no longer queried, and stop checking replicas no longer
+        # queried.
+        pool_keys = set()
+        replica_set_keys = set()
+        for (target_name, _), (target, query_configs) in job_configs.items():
+            for query_config in query_configs:
+                pool_keys.update((server, query_config.db_name)
+                                 for _, server in target_servers(target, query_config.routing))
+                if target[4] and query_config.routing != 'primary':
+                    replica_set_keys.add((target_name, target))
+
+        for pool_key in list(self._pools):
+            if pool_key not in pool_keys:
+                self._pools.pop(pool_key).close()
+
+        for replica_set_key in list(self._replica_sets):
+            if replica_set_key not in replica_set_keys:
+                replica_set, check_pools, cancel = self._replica_sets.pop(replica_set_key)
+                cancel()
+                for check_pool in check_pools.values():
+                    check_pool.close()
+                replica_set.remove_metrics()
+
+        self.target_names.clear()
+        self.target_names.update(target_name for target_name in targets
+                                 if target_name is not None)
+
+        # On-scrape queries share the query worker threads, if any. Otherwise
+        # they each get a thread, so they can all run in parallel.
+        if self.executor is not None:
+            self.scrape_trigger.executor = self.executor
+        elif len(self.scrape_trigger) > self._scrape_workers:
+            old_executor = self.scrape_trigger.executor
+            self._scrape_workers = len(self.scrape_trigger)
+            self.scrape_trigger.executor = ThreadPoolExecutor(
+                max_workers=self._scrape_workers, thread_name_prefix='on-scrape')
+            if old_executor is not None:
+                old_executor.shutdown(wait=False)
+
+        return started, stopped
+
+    def _evict_idle(self):
+        for mysql_pool in list(self._pools.values()):
+            mysql_pool.evict_idle()
+
+    def _restore(self, target_name, query_names, query_configs):
+        """
+        Restore the stored metrics of a job's queries from the state store, if
+        configured, and they aren't already stored. Returns how long to delay
+        the job's first run for.
+
+        If all the queries were restored, the first run is delayed until the
+        next run would have been, had the exporter not restarted.
+        """
+
+        if STATE_STORE is None:
+            return 0
+
+        ages = []
+        for query_name, query_config in zip(query_names, query_configs):
+            metrics_key = (target_name, query_name)
+            with METRICS_BY_QUERY_LOCK:
+                stored = metrics_key in METRICS_BY_QUERY
+            if not stored:
+                ages.append(restore_query(metrics_key, max_age=query_config.state_max_age))
+            else:
+                # The job's config changed, so it should run straight away.
+                ages.append(None)
+
+        if None in ages:
+            return 0
+
+        query_config = query_configs[0]
+        cron, cron_tz = query_config.cron, query_config.cron_tz
+        age = max(ages)
+        if cron:
+            # Only skip the run if the snapshot was saved after the previous
+            # cron run time.
+            return calc_cron_delay(cron, cron_tz) if age < calc_cron_elapsed(cron, cron_tz) else 0
+        return max(query_config.interval - age, 0)
+
+    def _forget(self, metrics_keys):
+        for metrics_key in metrics_keys:
+            forget_query(metrics_key)
+
+    def _connect_func(self, server):
+        server_host, server_port, server_username, server_password = server
+        return functools.partial(pymysql.connect,
+                                 host=server_host,
+                                 port=server_port,
+                                 user=server_username,
+                                 password=server_password,
+                                 **self.mysql_kwargs)
+
+    def _server_pool(self, server, db_name):
+        pool_key = (server, db_name)
+        mysql_pool = self._pools.get(pool_key)
+        if mysql_pool is None:
+            mysql_pool = ConnectionPool(self._connect_func(server), db_name, **self.pool_kwargs)
+            mysql_pool.fill()
+            self._pools[pool_key] = mysql_pool
+        return mysql_pool
+
+    def _pool(self, target_name, target, db_name, routing):
+        """
+        Return the connection pool for queries on a target's database, routed
+        as per routing (QueryTarget).
+        """
+
+        servers = target_servers(target, routing)
+        if not target[4] or routing == 'primary':
+            (_, server), = servers
+            return self._server_pool(server, db_name)
+
+        return RoutedPool(self._replica_set(target_name, target),
+                          {server_name: self._server_pool(server, db_name)
+                           for server_name, server in servers},
+                          routing)
+
+    def _replica_set(self, target_name, target):
+        """
+        Return the replica set of a target, scheduling a job checking its
+        replicas if it's new.
+        """
+
+        replica_set_key = (target_name, target)
+        if replica_set_key not in self._replica_sets:
+            servers = target_servers(target, 'any')
+            replica_set = ReplicaSet(target_name, [server_name for server_name, _ in servers],
+                                     max_lag=self.replica_max_lag)
+            # Checks use a connection of their own, without a database, so
+            # they can run while the query connections are all in use.
+            check_pools = {server_name: ConnectionPool(self._connect_func(server), None,
+                                                       max_size=1)
+                           for server_name, server in servers[1:]}
+
+            job_name = 'replica-check'
+            if target_name is not None:
+                job_name = '{}/{}'.format(job_name, target_name)
+            cancel = schedule_job(self.scheduler, self.replica_check_interval, None, None,
+                                  replica_set.check, check_pools,
+                                  executor=self.executor,
+                                  name=job_name)
+            self._replica_sets[replica_set_key] = (replica_set, check_pools, cancel)
+
+        return self._replica_sets[replica_set_key][0]
+
+    def _start_job_after(self, job_key, job_config, running):
+        """
+        Start a job once the given futures (of in-progress runs) are done.
+        Returns a function cancelling the job, as per _start_job().
+        """
+
+        cancel_job = None
+        cancelled = False
+
+        def start():
+            nonlocal cancel_job
+            if cancelled:
+                return
+            pending = [future for future in running if not future.done()]
+            if pending:
+                # Jobs can only be started from the scheduler's thread.
+                pending[0].add_done_callback(
+                    lambda _: self.scheduler.enter(0, 1, start))
+            else:
+                cancel_job = self._start_job(job_key, job_config)
+
+        def cancel():
+            nonlocal cancelled
+            cancelled = True
+            if cancel_job is not None:
+                return cancel_job()
+            return next((future for future in running if not future.done()), None)
+
+        start()
+        return cancel
+
+    def _start_job(self, job_key, job_config):
+        """
+        Schedule a job, or add it to the scrape trigger if it's run on scrape.
+        Returns a function cancelling the job.
+        """
+
+        target_name, query_names = job_key
+        target, query_configs = job_config
+        # Grouped queries share the same database, schedule, timeout, and
+        # routing, so those of the first query apply to all.
+        query_config = query_configs[0]
+        db_name = query_config.db_name
+        mysql_pool = self._pool(target_name, target, db_name, query_config.routing)
+        delay = self._restore(target_name, query_names, query_configs)
+
+        if len(query_names) > 1:
+            # Queries with the same statement share a run of it.
+            statements = {}
+            for query_name, dependent_config in zip(query_names, query_configs):
+                statements.setdefault(dependent_config.query.strip(), []).append(
+                    (query_name, dependent_config.value_columns,
+                     dependent_config.on_error, dependent_config.on_missing,
+                     dependent_config.max_rows, dependent_config.max_series,
+                     dependent_config.on_series_limit))
+
+            if len(statements) > 1:
+                job_func = run_batched_queries
+                job_args = (mysql_pool, target_name, db_name, list(statements.items()),
+                            query_config.timeout)
+            else:
+                (query, dependents), = statements.items()
+                job_func = run_shared_query
+                job_args = (mysql_pool, target_name, db_name, query, query_config.timeout,
+                            dependents)
+
+        elif query_config.mode == 'incremental':
+            job_func = run_incremental_query
+            job_args = (mysql_pool, target_name, query_names[0],
+                        db_name, query_config.query, query_config.value_columns,
+                        query_config.timeout, query_config.max_rows, query_config.max_series,
+                        query_config.watermark_column, query_config.watermark_start)
+
+        else:
+            job_func = run_query
+            job_args = (mysql_pool, target_name, query_names[0],
+                        db_name, query_config.query, query_config.value_columns,
+                        query_config.on_error, query_config.on_missing,
+                        query_config.timeout, query_config.stream, query_config.max_rows,
+                        query_config.max_series, query_config.on_series_limit)
+
+        if PROFILE_REQUESTS is not None:
+            job_func = PROFILE_REQUESTS.wrap(job_func, [(target_name, query_name)
+                                                        for query_name in query_names])
+
+        if query_config.mode == 'on_scrape':
+            job = self.scrape_trigger.add(target_name, query_config.cache_ttl,
+                                          job_func, *job_args)
+            return functools.partial(self.scrape_trigger.remove, job)
+
+        job_name = ','.join(query_names)
+        if target_name is not None:
+            job_name = '{}/{}'.format(target_name, job_name)
+        if self.governor is not None:
+            # A job shared by several queries is only low priority if they all are.
+            priority = ('low' if all(dependent_config.priority == 'low'
+                                     for dependent_config in query_configs)
+                        else 'normal')
+            self.governor.add(job_name, None if query_config.cron else query_config.interval,
+                              group=target_name, priority=priority, queries=query_names)
+        return schedule_job(self.scheduler,
+                            query_config.interval, query_config.cron, query_config.cron_tz,
+                            job_func, *job_args,
+                            executor=self.executor,
+                            name=job_name,
+                            group=target_name,
+                            planner=self.planner,
+                            governor=self.governor,
+                            jitter=self.jitter,
+                            delay=delay)
+
+
 @click.command(context_settings=CONTEXT_SETTINGS)
 @click.option('--port', '-p', default=9207,
               help='Port to serve the metrics endpoint on. (default: 9207)')
-@click.option('--config-file', '-c', default='exporter.cfg', type=click.File(),
+@click.option('--debug-port', type=int,
+              help='Port to serve debug endpoints on, which profile the exporter on demand. '
+                   'Profiles can reveal queries and their results, so only serve them '
+                   'where they are not publicly reachable. '
+                   'Not supported by the asyncio engine. (default: disabled)')
+@click.option('--debug-address', default='127.0.0.1',
+              help='Address to serve the debug endpoints on. Use 0.0.0.0 to serve them on '
+                   'all interfaces, e.g. when running in a container. (default: 127.0.0.1)')
+@click.option('--config-file', '-c', default='exporter.cfg',
+              type=click.Path(exists=True, dir_okay=False),
               help='Path to query config file. '
                    'Can be absolute, or relative to the current working directory. '
                    '(default: exporter.cfg)')
@@ -152,16 +1430,155 @@ CONFIGPARSER_CONVERTERS = {
                    'in filename order. '
                    'Can be absolute, or relative to the current working directory. '
                    '(default: ./config)')
+@click.option('--watch-config', default=False, is_flag=True,
+              help='Reload the query config file(s) when they change. '
+                   'Config is also reloaded on SIGHUP. '
+                   'Only added, removed, or changed queries and targets are restarted.')
+@click.option('--engine', default='threads', type=click.Choice(['threads', 'asyncio']),
+              help='How to run queries and serve metrics. '
+                   '"threads" uses a scheduler thread, worker threads as per --query-workers, '
+                   'and a thread per HTTP request. '
+                   '"asyncio" runs queries and serves metrics on a single event loop, '
+                   'so many queries can be in flight at once without a thread each. '
+                   'It requires the optional aiomysql dependency, ignores --query-workers, '
+                   'and always buffers query results. (default: threads)')
+@click.option('--query-timeout', type=click.FloatRange(min=0),
+              help='Seconds a query may run before it is killed with KILL QUERY, and handled '
+                   'as per its QueryOnError. Queries can override this with QueryTimeoutSecs. '
+                   '(default: no timeout)')
+@click.option('--query-workers', default=0, type=click.IntRange(min=0),
+              help='Number of worker threads to run queries on. '
+                   'Limits how many queries can run at once. '
+                   'A query run is skipped if its previous run is still in progress. '
+                   'If 0, queries are run one at a time in the scheduler thread. '
+                   '(default: 0)')
+@click.option('--query-processes', default=1, type=click.IntRange(min=1),
+              help='Number of worker processes to split scheduled queries between, by a '
+                   'hash of their name, so parsing and rendering results can use more than '
+                   'one CPU core. Each process has its own scheduler, worker threads, and '
+                   'connection pools. On-scrape queries are run by the main process. '
+                   'Not supported by the asyncio engine. '
+                   'If 1, all queries are run by the main process. (default: 1)')
+@click.option('--query-batch-size', default=1, type=click.IntRange(min=1),
+              help='Maximum number of query statements to send to MySQL as a single '
+                   'multi-statement request, for queries with the same database, schedule, '
+                   'and timeout. Batching saves round trips to distant servers. '
+                   'An error in one statement only affects the queries using it. '
+                   'The query timeout applies to the batch as a whole. '
+                   'Not supported by the asyncio engine. '
+                   'If 1, queries are not batched. (default: 1)')
+@click.option('--query-stagger', default='none', type=click.Choice(['none', 'hash', 'plan']),
+              help='How to stagger the start times of interval based queries, to avoid '
+                   'running them all at once. '
+                   '"none" starts all queries immediately. '
+                   '"hash" offsets each query within its interval by a hash of its name, '
+                   'so the offsets are the same across restarts. '
+                   '"plan" starts from the hash offsets, then periodically re-plans them '
+                   'using recent query run times, to spread query load evenly. '
+                   '(default: none)')
+@click.option('--query-jitter', default=0, type=click.FloatRange(min=0),
+              help='Maximum random delay, in seconds, to add to each query run. '
+                   '(default: 0)')
+@click.option('--query-governor', default=False, is_flag=True,
+              help='Adapt how often scheduled queries run to the health of MySQL. '
+                   'Slow or failing queries back off exponentially, up to '
+                   '--query-max-backoff times their interval, and return to normal once '
+                   'they recover. Queries failing --query-breaker-failures times in a row '
+                   'are paused for --query-breaker-timeout seconds (a circuit breaker). '
+                   'Queries with QueryPriority = low are shed first.')
+@click.option('--query-slow-threshold', type=click.FloatRange(min=0),
+              help='Seconds after which a query run counts as slow, for --query-governor. '
+                   '(default: half the query\'s interval)')
+@click.option('--query-max-backoff', default=16, type=click.IntRange(min=1),
+              help='Maximum factor to stretch the interval of a slow or failing query by, '
+                   'for --query-governor. (default: 16)')
+@click.option('--query-breaker-failures', default=5, type=click.IntRange(min=1),
+              help='Number of failed runs in a row after which a query is paused, '
+                   'for --query-governor. (default: 5)')
+@click.option('--query-breaker-timeout', default=300, type=click.FloatRange(min=0),
+              help='Seconds to pause a failing query for, before trying it again, '
+                   'for --query-governor. (default: 300)')
+@click.option('--scrape-deadline', default=5, type=click.FloatRange(min=0),
+              help='Seconds a scrape waits for on-scrape queries (QueryMode = on_scrape) '
+                   'to finish, before serving their cached results. (default: 5)')
 @click.option('--mysql-server', '-s', callback=validate_server_address, default='localhost',
               help='Address of a MySQL server to run queries on. '
                    'A port can be provided if non-standard (3306) e.g. mysql:3333. '
+                   'Ignored if any targets are configured in the query config file(s). '
                    '(default: localhost)')
 @click.option('--mysql-user', '-u', default='root',
               help='MySQL user to run queries as. (default: root)')
 @click.option('--mysql-password', '-P', default='',
               help='Password for the MySQL user, if required. (default: no password)')
+@click.option('--mysql-replica', multiple=True, callback=validate_server_addresses,
+              help='Address of a read replica of the MySQL server. Can be given multiple '
+                   'times. Queries are routed to replicas as per their QueryTarget. '
+                   'Ignored if any targets are configured in the query config file(s). '
+                   '(default: no replicas)')
+@click.option('--mysql-replica-max-lag', default=30, type=click.FloatRange(min=0),
+              help='Maximum replication lag, in seconds, of a read replica to route queries '
+                   'to. Replicas lagging further behind are avoided until they catch up. '
+                   '(default: 30)')
+@click.option('--mysql-read-timeout', type=click.FloatRange(min=0),
+              help='Seconds to wait for a response from MySQL before giving up on a query. '
+                   'A client-side backstop for query timeouts, in case the server is '
+                   'unresponsive, so should be longer than any of them. '
+                   '(default: no timeout)')
+@click.option('--mysql-pool-min-size', default=0, type=click.IntRange(min=0),
+              help='Minimum number of connections to keep open to each database. '
+                   '(default: 0)')
+@click.option('--mysql-pool-max-size', default=4, type=click.IntRange(min=1),
+              help='Maximum number of connections to open to each database. '
+                   'Queries wait for a free connection if this is reached. '
+                   '(default: 4)')
+@click.option('--mysql-pool-idle-timeout', default=300, type=click.FloatRange(min=0),
+              help='Seconds a pooled connection can be idle before it is closed, '
+                   'unless needed to keep the minimum pool size. (default: 300)')
 @click.option('--mysql-local-timezone', '-z',
               help='Local timezone for sql commands like NOW(). (default: use server timezone)')
+@click.option('--max-series', type=click.IntRange(min=0),
+              help='Maximum number of series to store across all queries. '
+                   'A query run that would exceed this is handled as per its QueryOnSeriesLimit. '
+                   '(default: no limit)')
+@click.option('--max-series-memory', type=click.IntRange(min=0),
+              help='Maximum estimated memory use, in bytes, of the series stored across all '
+                   'queries. A query run that would exceed this is handled as per its '
+                   'QueryOnSeriesLimit. (default: no limit)')
+@click.option('--metrics-compression', default='gzip', type=click.Choice(['gzip', 'none']),
+              help='Compression to use for the metrics endpoint, if accepted by the scraper. '
+                   'Query metrics are compressed once when they change, '
+                   'rather than on every scrape. (default: gzip)')
+@click.option('--state-dir', type=click.Path(file_okay=False),
+              help='Directory to save snapshots of query metrics in, after each run. '
+                   'Snapshots are restored at startup, so metrics are served straight away, '
+                   'and queries with recent snapshots wait until their next run is due. '
+                   'Not supported by the asyncio engine. (default: no snapshots)')
+@click.option('--remote-write-url',
+              help='URL of a Prometheus remote write endpoint to push query metrics to. '
+                   'Only changed series are pushed after each query run, with all series '
+                   'resent as per --remote-write-resend-interval. '
+                   'Requires the optional python-snappy dependency. '
+                   '(default: no remote write)')
+@click.option('--remote-write-label', multiple=True, callback=validate_labels,
+              help='Label to add to all pushed series, of the form name=value. '
+                   'Can be provided multiple times. '
+                   '(default: no labels)')
+@click.option('--remote-write-only', default=False, is_flag=True,
+              help='Only push query metrics via remote write, rather than also serving '
+                   'them on the metrics endpoint, to avoid rendering them. '
+                   'Exporter metrics are still served.')
+@click.option('--remote-write-batch-size', default=2000, type=click.IntRange(min=1),
+              help='Maximum number of samples to push per remote write request. '
+                   '(default: 2000)')
+@click.option('--remote-write-queue-size', default=100, type=click.IntRange(min=1),
+              help='Maximum number of sample batches to queue for remote write. '
+                   'When full, query runs wait up to a second for space, before their '
+                   'samples are dropped. (default: 100)')
+@click.option('--remote-write-resend-interval', default=60, type=click.FloatRange(min=0),
+              help='Seconds between resending all series of a query via remote write, '
+                   'so unchanged series are not considered stale. '
+                   'Should be well under the 5 minute Prometheus lookback period. '
+                   '(default: 60)')
 @click.option('--json-logging', '-j', default=False, is_flag=True,
               help='Turn on json logging.')
 @click.option('--log-level', default='INFO',
@@ -175,6 +1592,8 @@ def cli(**options):
 
     log_handler = logging.StreamHandler()
     log_format = '[%(asctime)s] %(name)s.%(levelname)s %(threadName)s %(message)s'
+    if options['query_processes'] > 1:
+        log_format = log_format.replace('%(threadName)s', '%(processName)s %(threadName)s')
     formatter = JogFormatter(log_format) if options['json_logging'] else logging.Formatter(log_format)
     log_handler.setFormatter(formatter)
 
@@ -191,72 +1610,272 @@ def cli(**options):
     mysql_username = options['mysql_user']
     mysql_password = options['mysql_password']
     mysql_timezone = options['mysql_local_timezone']
+    mysql_read_timeout = options['mysql_read_timeout']
 
-    config = configparser.ConfigParser(converters=CONFIGPARSER_CONVERTERS)
-    config.read_file(options['config_file'])
-
-    config_dir_file_pattern = os.path.join(options['config_dir'], '*.cfg')
-    config_dir_sorted_files = sorted(glob.glob(config_dir_file_pattern))
-    config.read(config_dir_sorted_files)
-
-    query_prefix = 'query_'
-    queries = {}
-    for section in config.sections():
-        if section.startswith(query_prefix):
-            query_name = section[len(query_prefix):]
-            interval = config.getfloat(section, 'QueryIntervalSecs',
-                                       fallback=15)
-            cron = config.get(section, 'QueryCron',
-                              fallback=None)
-            cron_tz = config.get(section, 'QueryCronTimezone',
-                                 fallback=None)
-            if cron_tz is not None:
-                cron_tz = pytz.timezone(cron_tz)
-            db_name = config.get(section, 'QueryDatabase')
-            query = config.get(section, 'QueryStatement')
-            value_columns = config.get(section, 'QueryValueColumns').split(',')
-            on_error = config.getenum(section, 'QueryOnError',
-                                      fallback='drop')
-            on_missing = config.getenum(section, 'QueryOnMissing',
-                                        fallback='drop')
-
-            queries[query_name] = (interval, cron, cron_tz,
-                                   db_name, query, value_columns,
-                                   on_error, on_missing)
+    config_file_path = options['config_file']
+    config_dir = options['config_dir']
+    default_target = (mysql_host, mysql_port, mysql_username, mysql_password,
+                      options['mysql_replica'])
+    queries, targets = load_config(config_file_path, config_dir, default_target,
+                                   options['query_timeout'])
+    if mysql_read_timeout and any(query_config.timeout
+                                  and query_config.timeout >= mysql_read_timeout
+                                  for query_config in queries.values()):
+        log.warning('Some query timeouts are longer than --mysql-read-timeout, so those '
+                    'queries will be abandoned before they can be killed.')
 
     scheduler = sched.scheduler()
 
-    mysql_kwargs = dict(host=mysql_host,
-                        port=mysql_port,
-                        user=mysql_username,
-                        password=mysql_password,
-                        # Use autocommit mode to avoid keeping the same transaction across query
-                        # runs when the connection is reused. Using the same transaction would
-                        # prevent changes from being reflected in results, and therefore metrics.
-                        # Note: Queries could theoretically change data...
-                        autocommit=True)
+    # Use autocommit mode to avoid keeping the same transaction across query
+    # runs when the connection is reused. Using the same transaction would
+    # prevent changes from being reflected in results, and therefore metrics.
+    # Note: Queries could theoretically change data...
+    mysql_kwargs = dict(autocommit=True)
     if mysql_timezone:
         mysql_kwargs['init_command'] = "SET time_zone = '{}'".format(mysql_timezone)
 
-    mysql_client = PersistentDB(creator=pymysql, **mysql_kwargs)
+    EXPOSITION_CACHE.compress = options['metrics_compression'] == 'gzip'
+    SERIES_BUDGET.max_series = options['max_series']
+    SERIES_BUDGET.max_bytes = options['max_series_memory']
+
+    if options['remote_write_url']:
+        try:
+            from .remote_write import RemoteWriter
+        except ImportError as e:
+            raise click.UsageError('Remote write requires python-snappy, which could not be '
+                                   'imported ({}). Install it with '
+                                   '`pip install prometheus-mysql-exporter[remote-write]`.'.format(e))
+
+        global REMOTE_WRITER
+        # The asyncio engine writes from its event loop, which mustn't block
+        # waiting for the queue.
+        REMOTE_WRITER = RemoteWriter(options['remote_write_url'],
+                                     labels=options['remote_write_label'],
+                                     batch_size=options['remote_write_batch_size'],
+                                     queue_size=options['remote_write_queue_size'],
+                                     block_timeout=0 if options['engine'] == 'asyncio' else 1,
+                                     resend_interval=options['remote_write_resend_interval'])
+        REMOTE_WRITER.start()
+        EXPOSITION_CACHE.enabled = not options['remote_write_only']
 
-    if queries:
-        for query_name, (interval, cron, cron_tz,
-                         db_name, query, value_columns,
-                         on_error, on_missing) in queries.items():
-            schedule_job(scheduler, interval, cron, cron_tz,
-                         run_query, mysql_client, query_name,
-                         db_name, query, value_columns, on_error, on_missing)
+    elif options['remote_write_only']:
+        raise click.UsageError('--remote-write-only requires --remote-write-url.')
+
+    query_workers = options['query_workers']
+    executor = ThreadPoolExecutor(max_workers=query_workers) if query_workers else None
+
+    query_stagger = options['query_stagger']
+    if query_stagger == 'hash':
+        planner = StaggerPlanner()
+    elif query_stagger == 'plan':
+        planner = StaggerPlanner(replan_interval=300)
     else:
+        planner = None
+
+    governor = None
+    if options['query_governor']:
+        governor = QueryGovernor(slow_threshold=options['query_slow_threshold'],
+                                 max_backoff=options['query_max_backoff'],
+                                 breaker_failures=options['query_breaker_failures'],
+                                 breaker_timeout=options['query_breaker_timeout'])
+
+    if not queries:
         log.warning('No queries found in config file(s)')
 
-    REGISTRY.register(QueryMetricCollector())
+    if options['engine'] == 'asyncio':
+        try:
+            from .aio import run_engine
+        except ImportError as e:
+            raise click.UsageError('The asyncio engine requires aiomysql, which could not be '
+                                   'imported ({}). Install it with '
+                                   '`pip install prometheus-mysql-exporter[asyncio]`.'.format(e))
+
+        if options['watch_config']:
+            log.warning('The asyncio engine does not support reloading config. '
+                        'Ignoring --watch-config.')
+        if options['query_batch_size'] > 1:
+            log.warning('The asyncio engine does not support batching queries. '
+                        'Ignoring --query-batch-size.')
+        if options['query_processes'] > 1:
+            log.warning('The asyncio engine does not support worker processes. '
+                        'Ignoring --query-processes.')
+        if options['state_dir']:
+            log.warning('The asyncio engine does not support saving snapshots. '
+                        'Ignoring --state-dir.')
+        if any(target[4] for target in targets.values()):
+            log.warning('The asyncio engine does not support read replicas. '
+                        'Running all queries on the primary.')
+        if options['debug_port'] is not None:
+            log.warning('The asyncio engine does not support the debug endpoints. '
+                        'Ignoring --debug-port.')
+
+        # In multi-target mode, the metrics for each target are also available
+        # separately, via /probe?target=<target name>.
+        probe_target_names = [target_name for target_name in targets if target_name is not None]
+
+        log.info('Starting server...')
+        app = make_exporter_app(REGISTRY, EXPOSITION_CACHE, probe_target_names)
+        asyncio.run(run_engine(targets, queries, port, app, mysql_kwargs,
+                               pool_min_size=options['mysql_pool_min_size'],
+                               pool_max_size=options['mysql_pool_max_size'],
+                               pool_idle_timeout=options['mysql_pool_idle_timeout'],
+                               read_timeout=mysql_read_timeout,
+                               planner=planner,
+                               governor=governor,
+                               jitter=options['query_jitter'],
+                               scrape_deadline=options['scrape_deadline']))
+        return
+
+    if mysql_read_timeout:
+        mysql_kwargs['read_timeout'] = mysql_read_timeout
+    # Batched queries are sent as multi-statement queries, which MySQL only
+    # accepts if enabled when connecting.
+    query_batch_size = options['query_batch_size']
+    if query_batch_size > 1:
+        mysql_kwargs['client_flag'] = pymysql.constants.CLIENT.MULTI_STATEMENTS
+
+    if options['state_dir']:
+        global STATE_STORE
+        STATE_STORE = StateStore(options['state_dir'])
+        STATE_STORE.start()
+
+    scrape_trigger = ScrapeTrigger(deadline=options['scrape_deadline'])
+
+    # Worker processes don't serve the debug endpoints, so only queries run by
+    # the main process can be profiled.
+    debug_port = options['debug_port'] if QUERY_SHARD is None else None
+    if debug_port is not None:
+        global PROFILE_REQUESTS
+        PROFILE_REQUESTS = ProfileRequests()
+        if options['query_processes'] > 1:
+            log.warning('The debug endpoints only profile the main process, which only runs '
+                        'on-scrape queries when using worker processes.')
+
+    # Scheduled queries can be split between worker processes, each running
+    # this function for its shard of the queries, and sending their rendered
+    # metrics to the main process to be served.
+    query_processes = options['query_processes']
+    query_shards = None
+    if query_processes > 1 and QUERY_SHARD is None:
+        query_shards = QueryShards(run_query_shard, (options,), query_processes,
+                                   EXPOSITION_CACHE, REGISTRY)
+
+    # Each target gets its own connection pools and jobs, but they all share
+    # the same scheduler, worker threads, and metrics server.
+    query_jobs = QueryJobs(scheduler, scrape_trigger, mysql_kwargs,
+                           pool_kwargs=dict(min_size=options['mysql_pool_min_size'],
+                                            max_size=options['mysql_pool_max_size'],
+                                            idle_timeout=options['mysql_pool_idle_timeout']),
+                           executor=executor,
+                           planner=planner,
+                           governor=governor,
+                           jitter=options['query_jitter'],
+                           batch_size=query_batch_size,
+                           replica_max_lag=options['mysql_replica_max_lag'])
+    query_jobs.update(targets, shard_queries(queries, QUERY_SHARD, query_processes))
+
+    # In multi-target mode, the metrics for each target are also available
+    # separately, via /probe?target=<target name>. The target names are
+    # updated when config is reloaded.
+    app = make_exporter_app(REGISTRY if query_shards is None else query_shards,
+                            EXPOSITION_CACHE, query_jobs.target_names,
+                            on_scrape=scrape_trigger.trigger)
+
+    # Config is reloaded on SIGHUP, or when the config files change if watched.
+    # The signal handler only flags the reload, which is done by a scheduled
+    # job, as jobs can only be changed from the scheduler's thread.
+    watch_config = options['watch_config']
+    signature = config_signature(config_files(config_file_path, config_dir))
+    reload_requested = False
+
+    def request_reload(signum, _):
+        nonlocal reload_requested
+        log.info('Received signal %(signal)s. Reloading config.',
+                 {'signal': signal.Signals(signum).name})
+        reload_requested = True
+        if query_shards is not None:
+            query_shards.signal(signum)
+
+    def check_config():
+        nonlocal reload_requested, signature
+        if watch_config and not reload_requested:
+            if config_signature(config_files(config_file_path, config_dir)) != signature:
+                log.info('Config files changed. Reloading config.')
+                reload_requested = True
+
+        if not reload_requested:
+            return
+        reload_requested = False
+        signature = config_signature(config_files(config_file_path, config_dir))
+
+        try:
+            queries, targets = load_config(config_file_path, config_dir, default_target,
+                                           options['query_timeout'])
+        except Exception:
+            log.exception('Error while reloading config. Keeping the current config.')
+            return
+
+        started, stopped = query_jobs.update(targets,
+                                             shard_queries(queries, QUERY_SHARD, query_processes))
+        log.info('Config reloaded. Stopped %(stopped)s jobs, and started %(started)s jobs.',
+                 {'stopped': stopped, 'started': started})
+
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, request_reload)
+    schedule_job(scheduler, 1, None, None, check_config, name='config-reload')
+
+    if QUERY_SHARD is not None:
+        # Worker processes only run queries, and report their own metrics to
+        # the main process, which serves them.
+        schedule_job(scheduler, 5, None, None, EXPOSITION_CACHE.report_metrics, REGISTRY,
+                     name='report-metrics')
+        scheduler.run()
+        return
 
     log.info('Starting server...')
-    start_http_server(port)
+    start_http_server(port, app)
     log.info('Server started on port %(port)s', {'port': port})
 
-    scheduler.run()
+    if debug_port is not None:
+        start_http_server(debug_port, make_debug_app(PROFILE_REQUESTS, app, series_counts),
+                          addr=options['debug_address'], name='debug-server')
+        log.info('Debug server started on %(address)s port %(port)s',
+                 {'address': options['debug_address'], 'port': debug_port})
+
+    if query_shards is not None:
+        log.info('Starting %(count)s worker processes...', {'count': query_processes})
+        query_shards.start()
+
+    try:
+        scheduler.run()
+    finally:
+        if query_shards is not None:
+            query_shards.stop()
+
+
+@log_exceptions(exit_on_exception=True)
+def run_query_shard(options, shard_index, conn):
+    """
+    Run a shard of the scheduled queries, in a worker process started by
+    QueryShards, with the same options as the main process.
+
+    Metrics are rendered here, and sent to the main process via conn, to be
+    served. The worker exits along with the main process.
+    """
+
+    global EXPOSITION_CACHE, QUERY_SHARD
+    QUERY_SHARD = shard_index
+    EXPOSITION_CACHE = ShardExpositionCache(conn)
+
+    thread = threading.Thread(target=exit_with_main_process, args=(conn,),
+                              name='main-process-watcher')
+    thread.daemon = True
+    thread.start()
+
+    # The main process stops its workers when it's interrupted, so they only
+    # need to handle being terminated.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    nice_shutdown(shutdown_signals=(signal.SIGTERM,))(cli.callback)(**options)
 
 
 @log_exceptions(exit_on_exception=True)
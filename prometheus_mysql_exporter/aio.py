@@ -0,0 +1,395 @@
+"""
+An asyncio based engine for running queries and serving metrics.
+
+Runs every query's schedule as a task on a single event loop, using aiomysql
+connection pools, and serves the metrics endpoints from the same event loop.
+Many mostly I/O bound queries can then be in flight at once, without a thread
+per query.
+
+Requires the optional aiomysql dependency, e.g. via
+`pip install prometheus-mysql-exporter[asyncio]`.
+"""
+
+import aiomysql
+import asyncio
+import functools
+import io
+import logging
+import random
+import sys
+import time
+
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from . import find_shared_queries, handle_query_response, store_query_error
+from .instrumentation import QUERY_PHASE_SECONDS, SCHEDULER_LAG_SECONDS
+from .scheduler import next_phase_time, next_run_time
+from .scrape import ScrapeTrigger
+from .timeout import QueryTimeoutError
+
+log = logging.getLogger(__name__)
+
+
+async def schedule_job(interval, cron, cron_tz, func, *args,
+                       name=None, group=None, planner=None, governor=None, jitter=0,
+                       **kwargs):
+    """
+    Run a coroutine function at a fixed interval, or based on a cron
+    expression, forever. The asyncio counterpart of scheduler.schedule_job().
+
+    Each run is started as a separate task, so a slow run doesn't delay the
+    schedule. A run is skipped if the previous run is still in progress.
+
+    If a StaggerPlanner is provided, interval based runs are offset within the
+    interval as planned for the job name (and group), and the run times of the
+    function are recorded with the planner. If a QueryGovernor is provided
+    (with the job already added to it), runs are skipped and spaced out as per
+    the governor, and the run times and outcomes of the function are recorded
+    with it. If jitter is set, each run is delayed by a random amount of up to
+    that many seconds.
+    """
+
+    running = None
+
+    # Cron based runs are at fixed times, so can't be staggered.
+    if cron:
+        planner = None
+    if planner is not None:
+        planner.add(name, interval, group=group)
+
+    async def run_job(run_time):
+        start_time = time.monotonic()
+        SCHEDULER_LAG_SECONDS.observe(start_time - run_time)
+        ok = False
+        try:
+            ok = await func(*args, **kwargs) is not False
+        except Exception:
+            log.exception('Error while running scheduled job %(name)s.', {'name': name})
+        finally:
+            duration = time.monotonic() - start_time
+            if planner is not None:
+                planner.record(name, duration)
+            if governor is not None:
+                governor.record(name, duration, ok)
+
+    scheduled_time = time.monotonic()
+    if planner is not None:
+        scheduled_time = next_phase_time(scheduled_time, interval, planner.offset(name))
+
+    while True:
+        # Jitter only delays the run itself, so it doesn't accumulate in the
+        # scheduled times of later runs.
+        run_time = scheduled_time + random.uniform(0, jitter) if jitter else scheduled_time
+        await asyncio.sleep(max(run_time - time.monotonic(), 0))
+
+        if running is not None and not running.done():
+            log.warning('Previous run of scheduled job %(name)s still in progress. Skipping run.',
+                        {'name': name})
+        elif governor is not None and not governor.allow(name):
+            log.debug('Skipping run of scheduled job %(name)s, as per the load governor.',
+                      {'name': name})
+        else:
+            running = asyncio.ensure_future(run_job(run_time))
+
+        scheduled_time = next_run_time(scheduled_time, interval, cron, cron_tz,
+                                       name=name, planner=planner, governor=governor)
+
+
+async def kill_query(connect, thread_id):
+    """
+    Cancel a query server-side, by running KILL QUERY on a new connection.
+    """
+
+    try:
+        conn = await connect()
+        try:
+            async with conn.cursor() as cursor:
+                await cursor.execute('KILL QUERY %s', (thread_id,))
+        finally:
+            conn.close()
+
+    except Exception:
+        log.exception('Error while killing query on connection %(thread_id)s.',
+                      {'thread_id': thread_id})
+
+
+async def run_query(mysql_pool, connect, target_name, db_name, query, timeout, read_timeout,
+                    dependents):
+    """
+    Run a query statement on a connection from an aiomysql pool, and update
+    the stored metrics of each query using it. The asyncio counterpart of
+    run_query() and run_shared_query().
+
+    Dependents are (query name, value columns, on_error, on_missing, max_rows,
+    max_series, on_series_limit) tuples. Usually there's only one, but queries
+    with the same statement and schedule share a single run.
+
+    If the query hasn't finished within the timeout, it's cancelled server-side
+    via KILL QUERY on a new connection made by connect. If only read_timeout is
+    set, the query is abandoned client-side when it's exceeded.
+
+    Results are always buffered, so parsing and merging can reuse the same
+    (synchronous) code as the threaded engine. They run on the event loop.
+
+    Returns False if the query failed.
+    """
+
+    log.debug('Running query %(query_names)s.',
+              {'query_names': ', '.join(query_name for query_name, *_ in dependents)})
+
+    try:
+        async with mysql_pool.acquire() as conn:
+            cursor = await conn.cursor()
+            start_time = time.perf_counter()
+            try:
+                await asyncio.wait_for(cursor.execute(query), timeout or read_timeout)
+
+            except asyncio.TimeoutError:
+                # The connection is mid-response, so is unusable. Close it, so
+                # it's dropped from the pool on release.
+                thread_id = conn.thread_id()
+                conn.close()
+                if timeout:
+                    log.warning('Query on connection %(thread_id)s exceeded timeout of '
+                                '%(timeout)ss. Killing query.',
+                                {'thread_id': thread_id, 'timeout': timeout})
+                    await kill_query(connect, thread_id)
+                    raise QueryTimeoutError('Query exceeded timeout of {}s.'.format(timeout))
+                raise
+
+            # Buffered cursors read the whole result when executing.
+            execute_time = time.perf_counter()
+            raw_response = await cursor.fetchall()
+            fetch_time = time.perf_counter()
+            description = cursor.description
+            await cursor.close()
+
+    except Exception:
+        log.exception('Error while querying db %(db_name)s, query %(query)s.',
+                      {'db_name': db_name, 'query': query})
+        for query_name, _, on_error, *_ in dependents:
+            store_query_error((target_name, query_name), on_error)
+        return False
+
+    for (query_name, value_columns, on_error, on_missing,
+         max_rows, max_series, on_series_limit) in dependents:
+        QUERY_PHASE_SECONDS.labels(query_name, 'execute').observe(execute_time - start_time)
+        QUERY_PHASE_SECONDS.labels(query_name, 'fetch').observe(fetch_time - execute_time)
+        handle_query_response((target_name, query_name), db_name, value_columns,
+                              description, raw_response, on_error, on_missing,
+                              max_rows, max_series, on_series_limit)
+
+
+class AsyncScrapeTrigger(ScrapeTrigger):
+    """
+    A ScrapeTrigger running on-scrape jobs (coroutine functions) as tasks on
+    the event loop.
+    """
+
+    async def _run_job(self, job):
+        try:
+            await job.func(*job.args, **job.kwargs)
+        except Exception:
+            log.exception('Error while running on-scrape job.')
+        finally:
+            self._finish_job(job)
+
+    async def trigger(self, target_name=None):
+        tasks = self._start_due_jobs(target_name,
+                                     lambda job: asyncio.ensure_future(self._run_job(job)))
+        if not tasks:
+            return
+
+        # Unlike asyncio.wait_for(), asyncio.wait() doesn't cancel the tasks
+        # on timeout, so they carry on in the background.
+        _, pending = await asyncio.wait(tasks, timeout=self.deadline)
+        if pending:
+            log.warning('%(count)s on-scrape queries did not finish within the scrape deadline '
+                        'of %(deadline)ss. Serving their cached results.',
+                        {'count': len(pending), 'deadline': self.deadline})
+
+
+async def handle_http_request(app, reader, writer, scrape_trigger=None, probe_targets=False):
+    """
+    Serve a single HTTP request with a WSGI app, then close the connection.
+
+    Only handles what the metrics endpoints need: the request line, and the
+    Accept-Encoding header. The app must not block, as it's run on the event
+    loop.
+
+    If a scrape trigger is provided, it's awaited before the app is called,
+    for the target of /probe requests if probe_targets is set, otherwise for
+    all targets.
+    """
+
+    try:
+        request_line = await reader.readline()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if not line or line in (b'\r\n', b'\n'):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+
+        try:
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+        except ValueError:
+            writer.write(b'HTTP/1.0 400 Bad Request\r\nContent-Length: 0\r\n\r\n')
+            return
+
+        url = urlsplit(target)
+        environ = {
+            'REQUEST_METHOD': method,
+            'PATH_INFO': unquote(url.path),
+            'QUERY_STRING': url.query,
+            'HTTP_ACCEPT_ENCODING': headers.get('accept-encoding', ''),
+            'SERVER_PROTOCOL': 'HTTP/1.0',
+            'wsgi.input': io.BytesIO(),
+            'wsgi.errors': sys.stderr,
+            'wsgi.url_scheme': 'http',
+        }
+
+        if scrape_trigger:
+            target_name = None
+            if probe_targets and environ['PATH_INFO'] == '/probe':
+                target_name = parse_qs(environ['QUERY_STRING']).get('target', [None])[0]
+                # Let the app respond to a missing target.
+                if not target_name:
+                    target_name = ''
+            await scrape_trigger.trigger(target_name)
+
+        response = []
+
+        def start_response(status, response_headers, exc_info=None):
+            response.append(status)
+            response.append(response_headers)
+
+        chunks = app(environ, start_response)
+        status, response_headers = response
+        head = ['HTTP/1.0 {}'.format(status)]
+        head.extend('{}: {}'.format(key, value) for key, value in response_headers)
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+        if method != 'HEAD':
+            writer.writelines(chunks)
+        await writer.drain()
+
+        log.debug('%(client)s - "%(request)s" %(status)s',
+                  {'client': writer.get_extra_info('peername'),
+                   'request': request_line.decode('latin-1').strip(),
+                   'status': status.split(' ', 1)[0]})
+
+    except Exception:
+        log.exception('Error while serving HTTP request.')
+
+    finally:
+        writer.close()
+
+
+async def run_engine(targets, queries, port, app, mysql_kwargs,
+                     pool_min_size=0, pool_max_size=4, pool_idle_timeout=300,
+                     read_timeout=None, planner=None, governor=None, jitter=0,
+                     scrape_deadline=None):
+    """
+    Create a connection pool per target and database, schedule every query
+    on every target, and serve the metrics endpoints, all on the running event
+    loop. Runs until cancelled.
+
+    Takes targets and queries in the form built by cli().
+    """
+
+    incremental_query_names = [query_name for query_name, query_config in queries.items()
+                               if query_config.mode == 'incremental']
+    for query_name in incremental_query_names:
+        log.error('Query %(query_name)s has QueryMode = incremental, which the asyncio '
+                  'engine does not support. Not running it.',
+                  {'query_name': query_name})
+    queries = {query_name: query_config for query_name, query_config in queries.items()
+               if query_name not in incremental_query_names}
+
+    scrape_trigger = AsyncScrapeTrigger(deadline=scrape_deadline)
+    probe_targets = any(target_name is not None for target_name in targets)
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_http_request(app, reader, writer,
+                                                   scrape_trigger, probe_targets),
+        port=port)
+    log.info('Server started on port %(port)s', {'port': port})
+
+    pools = []
+    jobs = []
+    for target_name, (target_host, target_port,
+                      target_username, target_password, _) in targets.items():
+        connect_kwargs = dict(host=target_host,
+                              port=target_port,
+                              user=target_username,
+                              password=target_password,
+                              **mysql_kwargs)
+
+        mysql_pools = {}
+        for query_config in queries.values():
+            db_name = query_config.db_name
+            if db_name not in mysql_pools:
+                # aiomysql recycles connections based on time since last use,
+                # so pool_recycle works as an idle timeout.
+                mysql_pool = await aiomysql.create_pool(minsize=pool_min_size,
+                                                        maxsize=pool_max_size,
+                                                        pool_recycle=pool_idle_timeout,
+                                                        db=db_name,
+                                                        **connect_kwargs)
+                mysql_pools[db_name] = mysql_pool
+                pools.append(mysql_pool)
+
+        # For KILL QUERY connections, which don't need a database.
+        connect = functools.partial(aiomysql.connect, **connect_kwargs)
+
+        for query_names in find_shared_queries(queries):
+            if len(query_names) > 1:
+                log.info('Queries %(query_names)s have the same statement and schedule. '
+                         'Running them as a single shared query.',
+                         {'query_names': ', '.join(query_names)})
+
+            dependents = []
+            for query_name in query_names:
+                query_config = queries[query_name]
+                if query_config.stream:
+                    log.warning('Query %(query_name)s has QueryStreamResults set, which the '
+                                'asyncio engine does not support. Its results will be buffered.',
+                                {'query_name': query_name})
+                dependents.append((query_name, query_config.value_columns,
+                                   query_config.on_error, query_config.on_missing,
+                                   query_config.max_rows, query_config.max_series,
+                                   query_config.on_series_limit))
+
+            # Grouped queries share the same statement, schedule, and timeout,
+            # so those of the last query apply to all.
+            job_args = (run_query, mysql_pools[query_config.db_name], connect,
+                        target_name, query_config.db_name, query_config.query,
+                        query_config.timeout, read_timeout, dependents)
+            if query_config.mode == 'on_scrape':
+                scrape_trigger.add(target_name, query_config.cache_ttl, *job_args)
+                continue
+
+            job_name = ','.join(query_names)
+            if target_name is not None:
+                job_name = '{}/{}'.format(target_name, job_name)
+            if governor is not None:
+                # A job shared by several queries is only low priority if they
+                # all are.
+                job_priority = ('low' if all(queries[query_name].priority == 'low'
+                                             for query_name in query_names)
+                                else 'normal')
+                governor.add(job_name, None if query_config.cron else query_config.interval,
+                             group=target_name, priority=job_priority, queries=query_names)
+            jobs.append(schedule_job(query_config.interval, query_config.cron,
+                                     query_config.cron_tz, *job_args,
+                                     name=job_name, group=target_name,
+                                     planner=planner, governor=governor, jitter=jitter))
+
+    try:
+        await asyncio.gather(server.serve_forever(), *jobs)
+
+    finally:
+        server.close()
+        for mysql_pool in pools:
+            mysql_pool.close()
+            await mysql_pool.wait_closed()
@@ -0,0 +1,160 @@
+import gzip
+import threading
+
+from prometheus_client.utils import floatToGoString
+
+
+def escape_doc(doc):
+    return doc.replace('\\', r'\\').replace('\n', r'\n')
+
+
+def escape_label_value(label_value):
+    return label_value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def render_metric_dict(metric_dict, metric_type='gauge'):
+    """
+    Render a metric dict in the Prometheus text exposition format.
+
+    Takes metrics as a dict keyed by metric name. Each metric name maps to a
+    tuple containing:
+    * metric documentation
+    * label keys tuple,
+    * dict of label values tuple -> metric value.
+
+    Returns a list of tuples, one for each metric name, containing:
+    * metric name,
+    * HELP and TYPE header lines, as bytes,
+    * sample lines, as bytes.
+
+    Metrics are rendered as gauges, unless another metric type is provided
+    (e.g. counter). The output matches that of prometheus_client for a
+    GaugeMetricFamily per metric, with its samples added in sorted order, i.e.
+    labels and samples are sorted.
+    """
+
+    rendered = []
+    for metric_name, (metric_doc, label_keys, value_dict) in metric_dict.items():
+        header = '# HELP {0} {1}\n# TYPE {0} {2}\n'.format(
+            metric_name, escape_doc(metric_doc), metric_type)
+
+        if label_keys:
+            # Label keys are output in sorted order, so work out which label
+            # value belongs in each position.
+            key_order = sorted(range(len(label_keys)), key=label_keys.__getitem__)
+            label_prefixes = [('{' if i == 0 else ',') + label_keys[k] + '="'
+                              for i, k in enumerate(key_order)]
+            lines = []
+            for label_values, value in sorted(value_dict.items()):
+                parts = [metric_name]
+                for label_prefix, k in zip(label_prefixes, key_order):
+                    parts.append(label_prefix)
+                    parts.append(escape_label_value(label_values[k]))
+                    parts.append('"')
+                parts.append('} ')
+                parts.append(floatToGoString(value))
+                parts.append('\n')
+                lines.append(''.join(parts))
+            samples = ''.join(lines)
+
+        # No label keys, so we must have only a single value.
+        else:
+            samples = '{} {}\n'.format(metric_name,
+                                       floatToGoString(list(value_dict.values())[0]))
+
+        rendered.append((metric_name, header.encode('utf-8'), samples.encode('utf-8')))
+
+    return rendered
+
+
+class ExpositionCache(object):
+    """
+    Cache of the rendered exposition text for each query.
+
+    Entries are keyed by (target name, query name) tuples, and are rendered when
+    updated (i.e. when a query's results change), rather than on every scrape.
+    If compress is set, a gzip-compressed copy is also made at update time.
+    Gzip members can be concatenated, so compressed entries can be joined into
+    a valid gzip-compressed response without further compression.
+
+    If enabled isn't set (e.g. as query metrics are only pushed via remote
+    write), updates are ignored, so nothing is rendered.
+    """
+
+    def __init__(self, compress=False, enabled=True):
+        self.compress = compress
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        # (target name, query name) -> (rendered metrics, text, gzipped text)
+        self._entries = {}
+
+    def update(self, key, metric_dict, metric_type='gauge'):
+        if not self.enabled:
+            return
+
+        rendered = render_metric_dict(metric_dict, metric_type)
+        text = b''.join(header + samples for _, header, samples in rendered)
+        gzipped = gzip.compress(text) if self.compress and text else None
+        self.store(key, rendered, text, gzipped)
+
+    def store(self, key, rendered, text=None, gzipped=None):
+        """
+        Store already rendered metrics, as returned by render_metric_dict(),
+        along with their text and gzipped text, if available.
+        """
+
+        if text is None:
+            text = b''.join(header + samples for _, header, samples in rendered)
+
+        with self._lock:
+            self._entries[key] = (rendered, text, gzipped)
+
+    def remove(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def render(self, target_name=None, compress=False):
+        """
+        Return the cached exposition text, as a list of bytes chunks.
+
+        If a target name is provided, only the metrics for that target are
+        returned. If compress is set, the chunks are gzip-compressed.
+
+        Metrics for the same query on different targets are combined, so their
+        samples are grouped under a single set of HELP and TYPE lines. That
+        requires joining the samples of each metric, so the text is compressed
+        at render time if there are multiple targets.
+        """
+
+        with self._lock:
+            entries = [(key, entry) for key, entry in self._entries.items()
+                       if target_name is None or key[0] == target_name]
+
+        entries_by_query = {}
+        for (_, query_name), entry in entries:
+            entries_by_query.setdefault(query_name, []).append(entry)
+
+        chunks = []
+        for query_entries in entries_by_query.values():
+            if len(query_entries) == 1:
+                _, text, gzipped = query_entries[0]
+                if not text:
+                    continue
+                if compress:
+                    chunks.append(gzipped if gzipped is not None else gzip.compress(text))
+                else:
+                    chunks.append(text)
+
+            else:
+                headers = {}
+                samples_by_metric = {}
+                for rendered, _, _ in query_entries:
+                    for metric_name, header, samples in rendered:
+                        headers.setdefault(metric_name, header)
+                        samples_by_metric.setdefault(metric_name, []).append(samples)
+
+                text = b''.join(headers[metric_name] + b''.join(samples_list)
+                                for metric_name, samples_list in samples_by_metric.items())
+                chunks.append(gzip.compress(text) if compress else text)
+
+        return chunks
@@ -0,0 +1,172 @@
+import logging
+import threading
+import time
+
+from .instrumentation import (QUERY_BREAKER_STATE, QUERY_EFFECTIVE_INTERVAL_SECONDS,
+                              QUERY_RUNS_SKIPPED)
+
+log = logging.getLogger(__name__)
+
+# Values of the breaker state metric.
+BREAKER_STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+
+class QueryGovernor(object):
+    """
+    Adapts how often jobs run to the health of the database, backing off when
+    runs are slow or failing, to avoid adding load when it's least welcome.
+
+    Each job has a backoff multiplier, applied to its interval. A run that
+    fails, or takes longer than slow_threshold seconds (by default, half the
+    job's interval), doubles the multiplier, up to max_backoff. A healthy run
+    halves it, so jobs return to their normal interval gradually as the
+    database recovers.
+
+    After breaker_failures failed runs in a row, a job's circuit breaker opens,
+    and its runs are skipped for breaker_timeout seconds. The next run is then
+    a trial: the breaker closes if it succeeds, or opens again if it fails.
+
+    Low priority jobs are shed first. They back off at least as much as the
+    most backed off job in the same group (e.g. on the same MySQL server), and
+    are skipped altogether while the breaker of any job in the group is open.
+
+    Cron based jobs have no interval to stretch, so are only affected by the
+    circuit breaker and shedding.
+    """
+
+    def __init__(self, slow_threshold=None, max_backoff=16, breaker_failures=5,
+                 breaker_timeout=300):
+        self.slow_threshold = slow_threshold
+        self.max_backoff = max_backoff
+        self.breaker_failures = breaker_failures
+        self.breaker_timeout = breaker_timeout
+        self._lock = threading.Lock()
+        # Job name -> [group, interval, priority, metric labels, backoff multiplier,
+        #              consecutive failures, breaker state, breaker open until]
+        self._jobs = {}
+
+    def add(self, name, interval=None, group=None, priority='normal', queries=()):
+        """
+        Add a job. The interval is None for cron based jobs. Metrics are
+        reported for each of the job's queries, labelled with the group as the
+        target.
+        """
+
+        labels = [(group or '', query_name) for query_name in queries]
+        with self._lock:
+            self._jobs[name] = [group, interval, priority, labels, 1, 0, 'closed', None]
+        for label_values in labels:
+            QUERY_BREAKER_STATE.labels(*label_values).set(BREAKER_STATES['closed'])
+            if interval is not None:
+                QUERY_EFFECTIVE_INTERVAL_SECONDS.labels(*label_values).set(interval)
+
+    def remove(self, name):
+        with self._lock:
+            job = self._jobs.pop(name, None)
+        if job is None:
+            return
+
+        for label_values in job[3]:
+            for metric in (QUERY_BREAKER_STATE, QUERY_EFFECTIVE_INTERVAL_SECONDS):
+                try:
+                    metric.remove(*label_values)
+                except KeyError:
+                    pass
+
+    def record(self, name, duration, ok):
+        """
+        Record the run time of a job, and whether the run succeeded, updating
+        its backoff multiplier and circuit breaker.
+        """
+
+        with self._lock:
+            job = self._jobs.get(name)
+            if job is None:
+                # Removed while running.
+                return
+            _, interval, _, labels, multiplier, failures, state, _ = job
+
+            slow_threshold = self.slow_threshold
+            if slow_threshold is None and interval is not None:
+                slow_threshold = interval / 2
+            healthy = ok and (slow_threshold is None or duration <= slow_threshold)
+            new_multiplier = (max(multiplier // 2, 1) if healthy
+                              else min(multiplier * 2, self.max_backoff))
+
+            failures = 0 if ok else failures + 1
+            new_state = state
+            if state == 'half_open':
+                new_state = 'closed' if ok else 'open'
+            elif state == 'closed' and failures >= self.breaker_failures:
+                new_state = 'open'
+            if new_state == 'open' and state != 'open':
+                job[7] = time.monotonic() + self.breaker_timeout
+            job[4:7] = [new_multiplier, failures, new_state]
+
+        if new_multiplier != multiplier:
+            log.debug('Backoff multiplier of scheduled job %(name)s is now %(multiplier)s.',
+                      {'name': name, 'multiplier': new_multiplier})
+
+        if new_state != state:
+            if new_state == 'open':
+                log.warning('Scheduled job %(name)s failed %(failures)s times in a row. '
+                            'Skipping its runs for %(timeout)ss.',
+                            {'name': name, 'failures': failures,
+                             'timeout': self.breaker_timeout})
+            else:
+                log.info('Scheduled job %(name)s recovered. Resuming its runs.', {'name': name})
+            for label_values in labels:
+                QUERY_BREAKER_STATE.labels(*label_values).set(BREAKER_STATES[new_state])
+
+    def allow(self, name):
+        """
+        Return whether a job should run now. If its breaker is open, but has
+        timed out, the run is allowed as a trial.
+        """
+
+        with self._lock:
+            job = self._jobs[name]
+            group, _, priority, labels, _, _, state, open_until = job
+            trial = False
+            if priority == 'low' and self._group_breaker_open(group, exclude=name):
+                reason = 'shed'
+            elif state == 'open' and time.monotonic() >= open_until:
+                job[6] = 'half_open'
+                trial = True
+                reason = None
+            elif state != 'closed':
+                # The breaker is open, or a trial run is still in progress.
+                reason = 'breaker_open'
+            else:
+                reason = None
+
+        if trial:
+            for label_values in labels:
+                QUERY_BREAKER_STATE.labels(*label_values).set(BREAKER_STATES['half_open'])
+
+        if reason is not None:
+            for label_values in labels:
+                QUERY_RUNS_SKIPPED.labels(*label_values, reason).inc()
+            return False
+        return True
+
+    def interval(self, name):
+        """
+        Return the effective interval of a job, i.e. its interval stretched by
+        its backoff multiplier (and that of its group, if low priority).
+        """
+
+        with self._lock:
+            group, interval, priority, labels, multiplier = self._jobs[name][:5]
+            if priority == 'low':
+                multiplier = max([multiplier] + [job[4] for job in self._jobs.values()
+                                                 if job[0] == group])
+
+        effective_interval = interval * multiplier
+        for label_values in labels:
+            QUERY_EFFECTIVE_INTERVAL_SECONDS.labels(*label_values).set(effective_interval)
+        return effective_interval
+
+    def _group_breaker_open(self, group, exclude=None):
+        return any(job[0] == group and job[6] != 'closed'
+                   for name, job in self._jobs.items() if name != exclude)
@@ -0,0 +1,97 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+# Metrics about the exporter itself, registered in the default registry.
+
+DURATION_BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300,
+                    float('inf'))
+
+# Phase timings are recorded for every query, so use few buckets, and don't
+# split them by target, to keep the number of series small with many queries
+# and targets.
+PHASE_BUCKETS = (.01, .1, 1, 10, 60, float('inf'))
+
+QUERY_PHASE_SECONDS = Histogram(
+    'mysql_exporter_query_phase_seconds',
+    'Time spent in each phase of running a query, across all targets. Phases are '
+    'execute, fetch, parse (including fetch for streamed queries), merge, and render.',
+    ['query', 'phase'],
+    buckets=PHASE_BUCKETS)
+
+QUERY_ROWS = Gauge(
+    'mysql_exporter_query_rows',
+    'Number of rows returned by the last successful run of a query.',
+    ['target', 'query'])
+
+QUERY_SERIES = Gauge(
+    'mysql_exporter_query_series',
+    'Number of series currently stored for a query.',
+    ['target', 'query'])
+
+QUERY_LAST_SUCCESS = Gauge(
+    'mysql_exporter_query_last_success_timestamp_seconds',
+    'Time of the last successful run of a query, in seconds since the epoch.',
+    ['target', 'query'])
+
+SERIES_LIMIT_HITS = Counter(
+    'mysql_exporter_series_limit_hits',
+    'Number of query runs that exceeded their series or memory limit.',
+    ['target', 'query', 'action'])
+
+SCHEDULER_LAG_SECONDS = Histogram(
+    'mysql_exporter_scheduler_lag_seconds',
+    'Delay between when a scheduled job was meant to start, and when it started.',
+    buckets=DURATION_BUCKETS)
+
+SCRAPE_RENDER_SECONDS = Histogram(
+    'mysql_exporter_scrape_render_seconds',
+    'Time spent collecting and rendering metrics for a scrape.',
+    ['endpoint'],
+    buckets=DURATION_BUCKETS)
+
+REMOTE_WRITE_SAMPLES = Counter(
+    'mysql_exporter_remote_write_samples',
+    'Number of samples pushed to the remote write endpoint, by result. Results are '
+    'sent, rejected (by the endpoint), failed (after retrying), and dropped (as the '
+    'queue was full).',
+    ['result'])
+
+REMOTE_WRITE_RETRIES = Counter(
+    'mysql_exporter_remote_write_retries',
+    'Number of remote write requests retried after failing.')
+
+REMOTE_WRITE_QUEUE_BATCHES = Gauge(
+    'mysql_exporter_remote_write_queue_batches',
+    'Number of sample batches queued to be pushed to the remote write endpoint.')
+
+REMOTE_WRITE_SEND_SECONDS = Histogram(
+    'mysql_exporter_remote_write_send_seconds',
+    'Time spent sending each remote write request, including failed attempts.',
+    buckets=DURATION_BUCKETS)
+
+QUERY_EFFECTIVE_INTERVAL_SECONDS = Gauge(
+    'mysql_exporter_query_effective_interval_seconds',
+    'Interval a query is currently run at, after backing off due to slow or failed runs.',
+    ['target', 'query'])
+
+QUERY_BREAKER_STATE = Gauge(
+    'mysql_exporter_query_breaker_state',
+    'State of the circuit breaker of a query. 0 is closed (running normally), '
+    '1 is half-open (running a trial after failures), and 2 is open (skipping runs).',
+    ['target', 'query'])
+
+QUERY_RUNS_SKIPPED = Counter(
+    'mysql_exporter_query_runs_skipped',
+    'Number of scheduled query runs skipped by the load governor. Reasons are '
+    'breaker_open, and shed (for low priority queries).',
+    ['target', 'query', 'reason'])
+
+REPLICA_LAG_SECONDS = Gauge(
+    'mysql_exporter_replica_lag_seconds',
+    'Replication lag of a read replica of a target, as of its last check. NaN if it '
+    'is not replicating, or could not be checked.',
+    ['target', 'server'])
+
+QUERY_FAILOVERS = Counter(
+    'mysql_exporter_query_failovers',
+    'Number of times a query failed over from a server to another due to a connection error.',
+    ['target', 'server'])
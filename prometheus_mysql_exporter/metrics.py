@@ -1,7 +1,6 @@
 import re
 
-from collections import OrderedDict
-from prometheus_client.core import GaugeMetricFamily
+from .store import CompactValueDict
 
 
 METRIC_INVALID_CHARS = re.compile(r'[^a-zA-Z0-9_:]')
@@ -23,41 +22,6 @@ def format_label_key(label_key):
     return label_key
 
 
-def format_label_value(*values):
-    """
-    Construct a label value.
-
-    If multiple value components are provided, they are joined by underscores.
-    """
-    return '_'.join(values)
-
-
-def format_labels(label_dict):
-    """
-    Formats metric label dictionaries.
-
-    Takes metric labels as a dictionary of label key -> label value.
-
-    Label values can be list of strings. These will be joined together with
-    underscores.
-
-    Disallowed characters in label keys and values will be replaced with
-    underscores.
-    """
-    formatted_label_dict = OrderedDict()
-    for label_key, label_value in label_dict.items():
-        formatted_label_key = format_label_key(label_key)
-
-        if isinstance(label_value, str):
-            formatted_label_value = format_label_value(label_value)
-        else:
-            formatted_label_value = format_label_value(*label_value)
-
-        formatted_label_dict[formatted_label_key] = formatted_label_value
-
-    return formatted_label_dict
-
-
 def format_metric_name(*names):
     """
     Construct a metric name.
@@ -71,69 +35,68 @@ def format_metric_name(*names):
     return metric
 
 
-def group_metrics(metrics):
+def update_value_dict(value_dict, new_value_dict, on_missing='drop', changes=None):
     """
-    Groups metrics with the same name but different label values.
+    Update a value dict in place with the values from a new value dict.
 
-    Takes metrics as a list of tuples containing:
-    * metric name,
-    * metric documentation,
-    * dict of label key -> label value,
-    * metric value.
+    Value dicts map from label values tuple -> metric value.
 
-    The metrics are grouped by metric name. All metrics with the same metric
-    name must have the same set of label keys.
+    Values from the new value dict have precidence. Any label values tuples
+    from the value dict that are not present in the new value dict are handled
+    according to on_missing. One of:
+    * preserve - keep the old value.
+    * drop - remove the label values tuple.
+    * zero - reset the value to zero.
 
-    A dict keyed by metric name is returned. Each metric name maps to a tuple
-    containing:
-    * metric documentation
-    * label keys tuple,
-    * dict of label values tuple -> metric value.
-    """
+    Only added, changed, and missing label values tuples are touched, and no
+    copies are made, so the cost is proportional to the size of the change (and
+    the number of old label values tuples, if not preserving missing values).
 
-    metric_dict = {}
-    for (metric_name, metric_doc, label_dict, value) in metrics:
-        curr_label_keys = tuple(label_dict.keys())
+    If a changes list is provided, a (label values tuple, new value) tuple is
+    appended to it for each added, changed, or removed label values tuple. The
+    new value of removed label values tuples is None.
 
-        if metric_name in metric_dict:
-            label_keys = metric_dict[metric_name][1]
-            assert set(curr_label_keys) == set(label_keys), \
-                'Not all values for metric {} have the same keys. {} vs. {}.'.format(
-                    metric_name, curr_label_keys, label_keys)
-        else:
-            label_keys = curr_label_keys
-            metric_dict[metric_name] = (metric_doc, label_keys, {})
+    Returns the number of label values tuples added, changed, or removed.
+    """
 
-        label_values = tuple([label_dict[k] for k in label_keys])
+    changed = 0
 
-        metric_dict[metric_name][2][label_values] = value
+    if on_missing != 'preserve':
+        missing = [label_values
+                   for label_values in value_dict
+                   if label_values not in new_value_dict]
 
-    return metric_dict
+        if on_missing == 'drop':
+            for label_values in missing:
+                del value_dict[label_values]
+            changed += len(missing)
+            if changes is not None:
+                changes.extend((label_values, None) for label_values in missing)
 
+        elif on_missing == 'zero':
+            for label_values in missing:
+                if value_dict[label_values] != 0:
+                    value_dict[label_values] = 0
+                    changed += 1
+                    if changes is not None:
+                        changes.append((label_values, 0))
 
-def merge_value_dicts(old_value_dict, new_value_dict, zero_missing=False):
-    """
-    Merge an old and new value dict together, returning the merged value dict.
+    if isinstance(value_dict, CompactValueDict):
+        return changed + value_dict.update_changed(new_value_dict, changes=changes)
 
-    Value dicts map from label values tuple -> metric value.
+    for label_values, value in new_value_dict.items():
+        if value_dict.get(label_values) != value:
+            value_dict[label_values] = value
+            changed += 1
+            if changes is not None:
+                changes.append((label_values, value))
 
-    Values from the new value dict have precidence. If any label values tuples
-    from the old value dict are not present in the new value dict and
-    zero_missing is set, their values are reset to zero.
-    """
-    value_dict = new_value_dict.copy()
-    value_dict.update({
-        label_values: 0 if zero_missing else old_value
-        for label_values, old_value
-        in old_value_dict.items()
-        if label_values not in new_value_dict
-    })
-    return value_dict
+    return changed
 
 
-def merge_metric_dicts(old_metric_dict, new_metric_dict, zero_missing=False):
+def update_metric_dict(metric_dict, new_metric_dict, on_missing='drop', changes=None):
     """
-    Merge an old and new metric dict together, returning the merged metric dict.
+    Update a metric dict in place with the metrics from a new metric dict.
 
     Metric dicts are keyed by metric name. Each metric name maps to a tuple
     containing:
@@ -141,58 +104,117 @@ def merge_metric_dicts(old_metric_dict, new_metric_dict, zero_missing=False):
     * label keys tuple,
     * dict of label values tuple -> metric value.
 
-    Values from the new metric dict have precidence. If any metric names from
-    the old metric dict are not present in the new metric dict and zero_missing
-    is set, their values are reset to zero.
+    Values from the new metric dict have precidence. Missing metrics and label
+    values tuples are handled according to on_missing, as per
+    update_value_dict(). If the label keys for a metric have changed, the
+    metric is replaced wholesale.
 
-    Merging (and missing value zeroing, if set) is performed on the value dicts
-    for each metric, not just on the top level metrics themselves.
-    """
-    metric_dict = new_metric_dict.copy()
-    metric_dict.update({
-        metric_name: (
-            metric_doc,
-            label_keys,
-            merge_value_dicts(
-                old_value_dict,
-                new_value_dict=new_metric_dict[metric_name][2]
-                if metric_name in new_metric_dict else {},
-                zero_missing=zero_missing
-            )
-        )
-        for metric_name, (metric_doc, label_keys, old_value_dict)
-        in old_metric_dict.items()
-    })
-    return metric_dict
-
-
-def gauge_generator(metric_dict):
+    Value dicts from the new metric dict may be added to the metric dict, so
+    the new metric dict shouldn't be used afterwards.
+
+    If a changes list is provided, a tuple is appended to it for each series
+    added, changed, or removed, containing:
+    * metric name,
+    * label keys tuple,
+    * label values tuple,
+    * new metric value, or None if the series was removed.
+
+    Returns the number of series (label values tuples) added, changed, or
+    removed.
     """
-    Generates GaugeMetricFamily instances for a list of metrics.
 
-    Takes metrics as a dict keyed by metric name. Each metric name maps to a
-    tuple containing:
+    changed = 0
+    value_changes = [] if changes is not None else None
+
+    def collect_changes(metric_name, label_keys):
+        if changes is not None:
+            changes.extend((metric_name, label_keys, label_values, value)
+                           for label_values, value in value_changes)
+            value_changes.clear()
+
+    for metric_name, (metric_doc, label_keys, new_value_dict) in new_metric_dict.items():
+        if metric_name in metric_dict and metric_dict[metric_name][1] == label_keys:
+            changed += update_value_dict(metric_dict[metric_name][2], new_value_dict,
+                                         on_missing=on_missing, changes=value_changes)
+            collect_changes(metric_name, label_keys)
+
+        else:
+            if metric_name in metric_dict:
+                _, old_label_keys, old_value_dict = metric_dict[metric_name]
+                changed += len(old_value_dict)
+                if changes is not None:
+                    value_changes.extend((label_values, None) for label_values in old_value_dict)
+                    collect_changes(metric_name, old_label_keys)
+                # Clear the old value dict, in case it shares its series with
+                # other value dicts (see store.CompactValueDict).
+                old_value_dict.clear()
+            metric_dict[metric_name] = (metric_doc, label_keys, new_value_dict)
+            changed += len(new_value_dict)
+            if changes is not None:
+                value_changes.extend(new_value_dict.items())
+                collect_changes(metric_name, label_keys)
+
+    if on_missing != 'preserve':
+        missing = [metric_name
+                   for metric_name in metric_dict
+                   if metric_name not in new_metric_dict]
+
+        for metric_name in missing:
+            changed += update_value_dict(metric_dict[metric_name][2], {},
+                                         on_missing=on_missing, changes=value_changes)
+            collect_changes(metric_name, metric_dict[metric_name][1])
+            if on_missing == 'drop':
+                del metric_dict[metric_name]
+
+    return changed
+
+
+def accumulate_metric_dict(metric_dict, delta_metric_dict, changes=None):
+    """
+    Add the values from a metric dict of deltas to a metric dict, in place.
+
+    Metric dicts are keyed by metric name. Each metric name maps to a tuple
+    containing:
     * metric documentation
     * label keys tuple,
     * dict of label values tuple -> metric value.
 
-    Yields a GaugeMetricFamily instance for each unique metric name, containing
-    children for the various label combinations. Suitable for use in a collect()
-    method of a Prometheus collector.
+    Series (label values tuples) only present in the metric dict are left as
+    is, and series only present in the delta metric dict are added. If the
+    label keys for a metric have changed, the metric is replaced wholesale, as
+    per update_metric_dict().
+
+    Value dicts from the delta metric dict may be added to the metric dict, so
+    the delta metric dict shouldn't be used afterwards.
+
+    If a changes list is provided, a tuple is appended to it for each series
+    changed, as per update_metric_dict().
+
+    Returns the number of series (label values tuples) added, changed, or
+    removed.
     """
 
-    for metric_name, (metric_doc, label_keys, value_dict) in metric_dict.items():
-        # If we have label keys we may have multiple different values,
-        # each with their own label values.
-        if label_keys:
-            gauge = GaugeMetricFamily(metric_name, metric_doc, labels=label_keys)
+    changed = 0
 
-            for label_values in sorted(value_dict.keys()):
-                value = value_dict[label_values]
-                gauge.add_metric(label_values, value)
+    for metric_name, (metric_doc, label_keys, delta_value_dict) in delta_metric_dict.items():
+        if metric_name in metric_dict and metric_dict[metric_name][1] == label_keys:
+            value_dict = metric_dict[metric_name][2]
+            for label_values, delta in delta_value_dict.items():
+                if delta:
+                    value = value_dict.get(label_values, 0) + delta
+                elif label_values not in value_dict:
+                    value = 0
+                else:
+                    continue
+                value_dict[label_values] = value
+                changed += 1
+                if changes is not None:
+                    changes.append((metric_name, label_keys, label_values, value))
 
-        # No label keys, so we must have only a single value.
         else:
-            gauge = GaugeMetricFamily(metric_name, metric_doc, value=list(value_dict.values())[0])
+            # Same as update_metric_dict(), as nothing is being accumulated.
+            changed += update_metric_dict(metric_dict,
+                                          {metric_name: (metric_doc, label_keys, delta_value_dict)},
+                                          on_missing='preserve', changes=changes)
 
-        yield gauge
+    return changed
@@ -1,43 +1,260 @@
 from collections import OrderedDict
 from numbers import Number
+from operator import itemgetter
+from pymysql.constants import FIELD_TYPE
+from sys import intern
 
-from .metrics import format_metric_name, format_labels
+from .metrics import format_label_key, format_metric_name
 
+DECIMAL_TYPE_CODES = (FIELD_TYPE.DECIMAL, FIELD_TYPE.NEWDECIMAL)
+# Rough estimate of the memory used by a stored series, excluding the
+# characters of its label values.
+SERIES_OVERHEAD_BYTES = 150
 
-def parse_response(query_name, db_name, value_columns, response):
+
+class RowLimitError(Exception):
+    """Raised when a query response has more rows than allowed."""
+
+
+class SeriesLimitError(Exception):
+    """
+    Raised when parsing a query response produces more series, or more
+    estimated memory use, than allowed.
+
+    The metric dict parsed up to that point, without the row that exceeded the
+    limit, is available as metric_dict.
+    """
+
+    def __init__(self, message, metric_dict):
+        super().__init__(message)
+        self.metric_dict = metric_dict
+
+
+def estimate_series_bytes(label_values):
     """
-    Parse a SQL query response into a list of metric tuples.
+    Roughly estimate the memory used by a stored series with the given label
+    values.
+    """
+    return SERIES_OVERHEAD_BYTES + sum(map(len, label_values))
 
-    Each value column in each row of the response results in a metric, so long
-    it is numeric. Other columns are converted to labels. The db name is also
-    included in the labels, as 'db'.
 
-    Metric tuples contain:
-    * metric name,
-    * metric documentation,
-    * dict of label key -> label value,
-    * metric value.
+def limit_rows(rows, max_rows):
+    """
+    Pass through rows from an iterable of rows, raising a RowLimitError if there
+    are more than max_rows of them. If max_rows is None, rows aren't limited.
     """
-    result = []
 
-    for row in response:
-        # NOTE: This db label isn't strictly necessary, since a single query can
-        #       only be run on a single database. It's retained for backwards
-        #       compatibility with previous versions that allowed queries to be
-        #       run on multiple databases.
-        labels = OrderedDict({'db': db_name})
-        labels.update((column, str(row[column]))
-                      for column in row
-                      if column not in value_columns)
+    if max_rows is None:
+        yield from rows
+        return
+
+    for i, row in enumerate(rows):
+        if i >= max_rows:
+            raise RowLimitError('Query response has more than {} rows.'.format(max_rows))
+        yield row
 
+
+class ParsePlan(object):
+    """
+    A plan for parsing the rows of a query response into a metric dict.
+
+    Compiled from the response's column descriptions (as per DB-API
+    cursor.description), so that metric names, documentation, and label keys
+    are derived once per response, rather than for every row. Parsing a row is
+    then reduced to picking out its label values and numeric values.
+
+    Each value column of each row results in a series, so long as its value is
+    numeric. Other columns are converted to labels. The db name is also
+    included in the labels, as 'db', and the target name, if provided, as
+    'target'. Decimal values are converted to floats. Label values are
+    interned, so repeated values (within and across responses) share a single
+    string.
+    """
+
+    def __init__(self, query_name, db_name, value_columns, description, target_name=None):
+        columns = [column[0] for column in description]
+        # If a column name is repeated, the last column with the name is used.
+        column_indexes = {column: i for i, column in enumerate(columns)}
+
+        # Label values are either constant for the response, or taken from a
+        # column. Where label keys clash (either directly, or after being
+        # formatted), the last value takes the first position.
+        label_sources = OrderedDict({'db': (db_name, None)})
+        if target_name is not None:
+            label_sources['target'] = (target_name, None)
+        label_sources.update((column, (None, column_indexes[column]))
+                             for column in columns
+                             if column not in value_columns)
+
+        formatted_label_sources = OrderedDict()
+        for label_key, label_source in label_sources.items():
+            formatted_label_sources[format_label_key(label_key)] = label_source
+
+        self.label_keys = tuple(formatted_label_sources.keys())
+        self.label_sources = tuple(formatted_label_sources.values())
+
+        self.values = []
         for value_column in value_columns:
-            value = row[value_column]
-            if isinstance(value, Number):
-                result.append((
-                    format_metric_name(query_name, value_column),
-                    "Value column '{}' for query '{}'.".format(value_column, query_name),
-                    format_labels(labels),
-                    value,
-                ))
-
-    return result
+            if value_column not in column_indexes:
+                raise KeyError('Value column {} not found in query {} response.'.format(
+                    value_column, query_name))
+
+            i = column_indexes[value_column]
+            convert = float if description[i][1] in DECIMAL_TYPE_CODES else None
+            self.values.append((
+                format_metric_name(query_name, value_column),
+                "Value column '{}' for query '{}'.".format(value_column, query_name),
+                i,
+                convert,
+            ))
+
+    def parse_rows(self, rows, max_series=None, max_bytes=None, stored_metric_dict=None,
+                   stored_bytes=0):
+        """
+        Parse an iterable of rows (as sequences of column values) into a metric
+        dict.
+
+        A dict keyed by metric name is returned. Each metric name maps to a tuple
+        containing:
+        * metric documentation
+        * label keys tuple,
+        * dict of label values tuple -> metric value.
+
+        If max_series or max_bytes are provided, a SeriesLimitError is raised
+        as soon as the number of series, or their estimated memory use (see
+        estimate_series_bytes()), exceeds them. The number of series parsed,
+        and their estimated memory use, are available afterwards as self.series
+        and self.estimated_bytes. Memory use is only estimated if limits are
+        provided, and is otherwise None.
+
+        If the result is going to be merged into a stored metric dict that
+        keeps series missing from the result (i.e. they're preserved, zeroed,
+        or accumulated), the stored metric dict, keyed by the same metric
+        names, and the estimated memory use of its series, should be provided.
+        The stored series then count towards the limits, and self.series and
+        self.estimated_bytes, as they would after merging.
+        """
+
+        label_sources = self.label_sources
+        constant_count = 0
+        while constant_count < len(label_sources) and label_sources[constant_count][1] is None:
+            constant_count += 1
+        label_indexes = [i for _, i in label_sources[constant_count:]]
+
+        # Normally, constant label values (db, target) come first, followed by
+        # those from columns, in which case the column label values can be
+        # picked out of each row in one go.
+        if None not in label_indexes:
+            constant_label_values = tuple(value for value, _ in label_sources[:constant_count])
+            if not label_indexes:
+                def get_label_values(row):
+                    return constant_label_values
+            elif len(label_indexes) == 1:
+                label_index = label_indexes[0]
+
+                def get_label_values(row):
+                    return constant_label_values + (intern(str(row[label_index])),)
+            else:
+                label_getter = itemgetter(*label_indexes)
+
+                def get_label_values(row):
+                    return constant_label_values + tuple(map(intern, map(str, label_getter(row))))
+        else:
+            def get_label_values(row):
+                return tuple(value if i is None else intern(str(row[i]))
+                             for value, i in label_sources)
+
+        value_dicts = [(i, convert, {}) for _, _, i, convert in self.values]
+        self.series = 0
+        self.estimated_bytes = 0
+
+        if max_series is None and max_bytes is None:
+            for row in rows:
+                label_values = get_label_values(row)
+                for i, convert, value_dict in value_dicts:
+                    value = row[i]
+                    if isinstance(value, Number):
+                        value_dict[label_values] = value if convert is None else convert(value)
+
+            self.series = sum(len(value_dict) for _, _, value_dict in value_dicts)
+            self.estimated_bytes = None
+
+        else:
+            stored_value_dicts = self._count_stored(stored_metric_dict or {}, stored_bytes)
+            if stored_metric_dict:
+                limit_message = 'Query response, with the series kept from previous runs, has '
+            else:
+                limit_message = 'Query response has '
+
+            # Keep track of the number of series as rows are parsed, so
+            # oversized responses are cut off early, rather than once they've
+            # been parsed in full.
+            for row in rows:
+                label_values = get_label_values(row)
+                added_to = []
+                added_series = 0
+                for (i, convert, value_dict), stored_value_dict in zip(value_dicts,
+                                                                       stored_value_dicts):
+                    value = row[i]
+                    if isinstance(value, Number):
+                        if label_values not in value_dict:
+                            added_to.append(value_dict)
+                            if label_values not in stored_value_dict:
+                                added_series += 1
+                        value_dict[label_values] = value if convert is None else convert(value)
+
+                if added_series:
+                    series = self.series + added_series
+                    estimated_bytes = (self.estimated_bytes
+                                       + added_series * estimate_series_bytes(label_values))
+
+                    if max_series is not None and series > max_series:
+                        message = limit_message + 'more than {} series.'.format(max_series)
+                    elif max_bytes is not None and estimated_bytes > max_bytes:
+                        message = limit_message + (
+                            'series using more than an estimated {} bytes.'.format(max_bytes))
+                    else:
+                        message = None
+
+                    if message is not None:
+                        for value_dict in added_to:
+                            del value_dict[label_values]
+                        raise SeriesLimitError(message, self._metric_dict(value_dicts))
+
+                    self.series = series
+                    self.estimated_bytes = estimated_bytes
+
+        return self._metric_dict(value_dicts)
+
+    def _count_stored(self, stored_metric_dict, stored_bytes):
+        """
+        Count the series of a stored metric dict in self.series and
+        self.estimated_bytes, and return the stored value dict (or an empty
+        one) for each value column.
+        """
+
+        metric_names = {metric_name for metric_name, *_ in self.values}
+        total_series = sum(len(value_dict) for _, _, value_dict in stored_metric_dict.values())
+        for metric_name, (_, label_keys, value_dict) in stored_metric_dict.items():
+            # Stored metrics whose label keys have changed are replaced by
+            # those in the response.
+            if metric_name not in metric_names or label_keys == self.label_keys:
+                self.series += len(value_dict)
+        if total_series:
+            self.estimated_bytes = stored_bytes * self.series // total_series
+
+        stored_value_dicts = []
+        for metric_name, *_ in self.values:
+            metric = stored_metric_dict.get(metric_name)
+            if metric is not None and metric[1] == self.label_keys:
+                stored_value_dicts.append(metric[2])
+            else:
+                stored_value_dicts.append({})
+        return stored_value_dicts
+
+    def _metric_dict(self, value_dicts):
+        # Metrics without any numeric values are omitted.
+        return {metric_name: (metric_doc, self.label_keys, value_dict)
+                for (metric_name, metric_doc, _, _), (_, _, value_dict)
+                in zip(self.values, value_dicts)
+                if value_dict}
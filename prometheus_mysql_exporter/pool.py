@@ -0,0 +1,249 @@
+import logging
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+
+class ConnectionBackoffError(Exception):
+    """Raised when a connection isn't attempted due to reconnect backoff."""
+
+
+class ConnectionPool(object):
+    """
+    A bounded pool of connections to a single MySQL database.
+
+    Connections are made via the provided connect function, which is passed the
+    database name as the `database` keyword argument, so connections are
+    already using the pool's database and no `USE` statement is needed.
+
+    At most max_size connections are open at once. Checking out a connection
+    when they are all in use blocks until one is returned. Connections idle for
+    longer than idle_timeout seconds are closed, down to min_size connections,
+    whenever a connection is checked out or in, or evict_idle() is called.
+    Connections idle for longer than check_idle seconds are pinged when checked
+    out, and replaced if the ping fails.
+
+    If making a connection fails, further attempts are backed off
+    exponentially, from backoff_initial up to backoff_max seconds. Checkouts
+    requiring a new connection during the backoff period fail immediately with
+    a ConnectionBackoffError, rather than adding load to a struggling server.
+    """
+
+    def __init__(self, connect, db_name,
+                 min_size=0, max_size=4, idle_timeout=300, check_idle=5,
+                 backoff_initial=1, backoff_max=60):
+        self._connect = connect
+        self.db_name = db_name
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_idle = check_idle
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+
+        self._cond = threading.Condition()
+        # Idle connections, as (connection, last used time) tuples.
+        # Most recently used connections are on the right.
+        self._idle = deque()
+        # Number of open (or opening) connections, idle or in use.
+        self._size = 0
+
+        self._backoff = 0
+        self._next_connect_time = 0
+        self._closed = False
+
+    def connect(self):
+        """
+        Make a new connection to the pool's database, outside of the pool.
+        """
+
+        now = time.monotonic()
+        if now < self._next_connect_time:
+            raise ConnectionBackoffError(
+                'Not connecting to db {} for another {:.2f}s after previous failure.'.format(
+                    self.db_name, self._next_connect_time - now))
+
+        try:
+            conn = self._connect(database=self.db_name)
+
+        except Exception:
+            self._backoff = min(max(self._backoff * 2, self.backoff_initial), self.backoff_max)
+            self._next_connect_time = time.monotonic() + self._backoff
+            raise
+
+        self._backoff = 0
+        return conn
+
+    def kill_connect(self, conn):
+        """
+        Return a function making a new connection to the server a checked out
+        connection is connected to, e.g. to kill its query.
+        """
+
+        return self.connect
+
+    def fill(self):
+        """
+        Open connections until the pool has at least min_size connections.
+        """
+
+        while True:
+            with self._cond:
+                if self._size >= min(self.min_size, self.max_size):
+                    return
+                self._size += 1
+
+            try:
+                conn = self.connect()
+            except Exception:
+                log.exception('Error while filling connection pool for db %(db_name)s.',
+                              {'db_name': self.db_name})
+                self._discard(None)
+                return
+
+            self._checkin(conn)
+
+    @contextmanager
+    def connection(self):
+        """
+        Check out a connection from the pool for the duration of the context.
+
+        The connection is returned to the pool afterwards, unless it has been
+        closed (e.g. due to a connection error).
+        """
+
+        conn = self._checkout()
+        try:
+            yield conn
+        finally:
+            if conn.open:
+                self._checkin(conn)
+            else:
+                self._discard(conn)
+
+    def run(self, func):
+        """
+        Run func(conn) with a connection checked out from the pool, and return
+        its result.
+        """
+
+        with self.connection() as conn:
+            return func(conn)
+
+    def close(self):
+        """
+        Close the pool's idle connections. Connections in use are closed when
+        they're returned, rather than being reused.
+        """
+
+        with self._cond:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+
+        for conn in idle:
+            self._close(conn)
+
+    def evict_idle(self):
+        """
+        Close connections idle for longer than the idle timeout. Should be run
+        periodically, as otherwise a pool that isn't being used keeps its
+        connections open until the server times them out.
+        """
+
+        with self._cond:
+            evicted = self._evict_idle(time.monotonic())
+
+        for conn in evicted:
+            self._close(conn)
+
+    def _evict_idle(self, now):
+        """
+        Remove connections idle for longer than the idle timeout from the pool,
+        returning them so they can be closed outside of the lock.
+        """
+
+        evicted = []
+        while (self._idle
+               and self._size > self.min_size
+               and now - self._idle[0][1] > self.idle_timeout):
+            conn, _ = self._idle.popleft()
+            self._size -= 1
+            evicted.append(conn)
+        return evicted
+
+    def _checkout(self):
+        evicted = []
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                evicted.extend(self._evict_idle(now))
+
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+
+                if self._size < self.max_size:
+                    self._size += 1
+                    conn, last_used = None, None
+                    break
+
+                self._cond.wait()
+
+        for evicted_conn in evicted:
+            self._close(evicted_conn)
+
+        if conn is not None and now - last_used > self.check_idle:
+            try:
+                conn.ping(reconnect=False)
+            except Exception:
+                log.warning('Pooled connection for db %(db_name)s failed health check. '
+                            'Reconnecting.',
+                            {'db_name': self.db_name})
+                self._close(conn)
+                conn = None
+
+        if conn is None:
+            try:
+                conn = self.connect()
+            except Exception:
+                self._discard(None)
+                raise
+
+        return conn
+
+    def _checkin(self, conn):
+        with self._cond:
+            closed = self._closed
+            if not closed:
+                now = time.monotonic()
+                evicted = self._evict_idle(now)
+                self._idle.append((conn, now))
+                self._cond.notify()
+
+        if closed:
+            self._discard(conn)
+            return
+
+        for evicted_conn in evicted:
+            self._close(evicted_conn)
+
+    def _discard(self, conn):
+        if conn is not None:
+            self._close(conn)
+
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            # The connection is probably broken already.
+            pass
@@ -0,0 +1,308 @@
+import cProfile
+import io
+import logging
+import marshal
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+from collections import Counter
+from contextlib import contextmanager
+from urllib.parse import parse_qs
+
+log = logging.getLogger(__name__)
+
+# The longest a single profile may run for, in seconds, so a mistyped request
+# can't leave a profiler running indefinitely.
+MAX_PROFILE_SECONDS = 300
+
+
+class ProfilerBusyError(Exception):
+    """Raised when a profile is requested while another is running."""
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return '{}:{}'.format(frame.f_globals.get('__name__', '?'),
+                          getattr(code, 'co_qualname', code.co_name))
+
+
+def sample_stacks(seconds, interval=0.005):
+    """
+    Sample the stacks of all threads (other than the calling thread) every
+    interval seconds, for the given number of seconds.
+
+    Returns a Counter of collapsed stacks, i.e. strings of the thread name and
+    the frames of a stack, outermost first, separated by semicolons.
+    """
+
+    thread_names = {}
+    current_thread_id = threading.get_ident()
+    stacks = Counter()
+    end_time = time.monotonic() + seconds
+    while time.monotonic() < end_time:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == current_thread_id:
+                continue
+
+            thread_name = thread_names.get(thread_id)
+            if thread_name is None:
+                thread_name = next((thread.name for thread in threading.enumerate()
+                                    if thread.ident == thread_id), str(thread_id))
+                thread_names[thread_id] = thread_name
+
+            labels = []
+            while frame is not None:
+                labels.append(frame_label(frame))
+                frame = frame.f_back
+            labels.append(thread_name)
+            stacks[';'.join(reversed(labels))] += 1
+
+        time.sleep(interval)
+
+    return stacks
+
+
+def render_collapsed(stacks):
+    """
+    Render sampled stacks in the collapsed stack format used by flame graph
+    tools (e.g. flamegraph.pl or speedscope), one stack and count per line.
+    """
+
+    return ''.join('{} {}\n'.format(stack, count)
+                   for stack, count in stacks.most_common()).encode('utf-8')
+
+
+def render_profile(profile, output_format, limit=50):
+    """
+    Render a cProfile profile, either as a pstats file (pstats), which can be
+    loaded with pstats.Stats() or tools like snakeviz, or as text, listing the
+    top limit functions by cumulative time.
+    """
+
+    if output_format == 'pstats':
+        profile.create_stats()
+        return marshal.dumps(profile.stats)
+
+    stream = io.StringIO()
+    pstats.Stats(profile, stream=stream).sort_stats('cumulative').print_stats(limit)
+    return stream.getvalue().encode('utf-8')
+
+
+class ProfileRequests(object):
+    """
+    Pending requests to profile the next run of a query.
+
+    Query run functions wrapped with wrap() check for requests for their
+    queries before each run, and if there are any, run under cProfile. Only
+    one profile can be taken at a time, as profilers can interfere with each
+    other.
+    """
+
+    def __init__(self):
+        self._profile_lock = threading.Lock()
+        self._lock = threading.Lock()
+        # (target name, query name) -> list of [event, profile] requests.
+        self._pending = {}
+
+    @contextmanager
+    def lock(self):
+        """
+        Hold the profiling lock. Raises a ProfilerBusyError if another profile
+        is running.
+        """
+
+        if not self._profile_lock.acquire(blocking=False):
+            raise ProfilerBusyError('Another profile is already running.')
+        try:
+            yield
+        finally:
+            self._profile_lock.release()
+
+    def wrap(self, func, metrics_keys):
+        """
+        Wrap a function running the queries with the given (target name, query
+        name) keys, so runs are profiled when requested.
+        """
+
+        def wrapper(*args, **kwargs):
+            if not self._pending:
+                return func(*args, **kwargs)
+
+            with self._lock:
+                requests = [request for metrics_key in metrics_keys
+                            for request in self._pending.pop(metrics_key, [])]
+            if not requests:
+                return func(*args, **kwargs)
+
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(func, *args, **kwargs)
+            finally:
+                for request in requests:
+                    request[1] = profile
+                    request[0].set()
+
+        return wrapper
+
+    def profile_next_run(self, metrics_key, timeout):
+        """
+        Wait for the next run of a query, and return its profile, or None if
+        it didn't run within timeout seconds. Must be called while holding
+        the profiling lock.
+        """
+
+        request = [threading.Event(), None]
+        with self._lock:
+            self._pending.setdefault(metrics_key, []).append(request)
+
+        if not request[0].wait(timeout):
+            with self._lock:
+                requests = self._pending.get(metrics_key, [])
+                if request in requests:
+                    requests.remove(request)
+                    if not requests:
+                        del self._pending[metrics_key]
+            # The run may have just finished.
+            if not request[0].is_set():
+                return None
+
+        return request[1]
+
+
+def memory_growth(seconds, series_counts, limit=25):
+    """
+    Trace memory allocations for the given number of seconds, and report the
+    lines of code whose allocations grew the most, along with how the number
+    of series stored for each query changed.
+
+    series_counts is a function returning a dict of (target name, query name)
+    -> number of series stored. Returns the report as text.
+    """
+
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        series_before = series_counts()
+        snapshot_before = tracemalloc.take_snapshot()
+        time.sleep(seconds)
+        snapshot_after = tracemalloc.take_snapshot()
+        series_after = series_counts()
+    finally:
+        if started:
+            tracemalloc.stop()
+
+    lines = ['Top {} allocation changes by line, over {}s:'.format(limit, seconds)]
+    # Allocations made by tracemalloc itself are noise.
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    stats = snapshot_after.filter_traces(filters).compare_to(
+        snapshot_before.filter_traces(filters), 'lineno')
+    lines.extend(str(stat) for stat in stats[:limit])
+
+    lines.append('')
+    lines.append('Series stored by query (before -> after):')
+    for metrics_key in sorted(set(series_before) | set(series_after),
+                              key=lambda key: (key[0] or '', key[1])):
+        target_name, query_name = metrics_key
+        lines.append('{}{}: {} -> {}'.format(
+            '' if target_name is None else target_name + '/', query_name,
+            series_before.get(metrics_key, 0), series_after.get(metrics_key, 0)))
+
+    return '\n'.join(lines).encode('utf-8') + b'\n'
+
+
+def make_debug_app(profile_requests, metrics_app, series_counts):
+    """
+    Make a WSGI app serving on-demand profiles of the exporter.
+
+    * /debug/profile samples the stacks of all threads for `seconds` seconds
+      (default 10), returning them in collapsed stack format.
+    * /debug/profile?query=<name> (and target=<name>, in multi-target mode)
+      profiles the next run of a query with cProfile, waiting up to `seconds`
+      seconds (default 60) for it to run.
+    * /debug/profile?scrape=1 profiles rendering /metrics once with cProfile.
+    * /debug/memory traces memory allocations for `seconds` seconds (default
+      10), reporting the lines allocating the most, and how the number of
+      series stored for each query changed.
+
+    cProfile profiles are returned as pstats files, or as text if format=text
+    is passed. Only one profile can be taken at a time.
+    """
+
+    def respond(start_response, status, body, content_type='text/plain; charset=utf-8',
+                filename=None):
+        headers = [('Content-Type', content_type), ('Content-Length', str(len(body)))]
+        if filename is not None:
+            headers.append(('Content-Disposition', 'attachment; filename="{}"'.format(filename)))
+        start_response(status, headers)
+        return [body]
+
+    def app(environ, start_response):
+        path = environ['PATH_INFO']
+        params = {key: values[0] for key, values in parse_qs(environ['QUERY_STRING']).items()}
+
+        if path not in ('/debug/profile', '/debug/memory'):
+            return respond(start_response, '404 Not Found',
+                           b'Available endpoints are /debug/profile and /debug/memory.\n')
+
+        query_name = params.get('query')
+        default_seconds = 60 if query_name else 10
+        try:
+            seconds = float(params.get('seconds', default_seconds))
+        except ValueError:
+            return respond(start_response, '400 Bad Request', b'Invalid seconds parameter.\n')
+        if not 0 < seconds <= MAX_PROFILE_SECONDS:
+            return respond(start_response, '400 Bad Request',
+                           'Seconds must be between 0 and {}.\n'.format(
+                               MAX_PROFILE_SECONDS).encode('utf-8'))
+
+        output_format = params.get('format', 'pstats')
+        if output_format not in ('pstats', 'text'):
+            return respond(start_response, '400 Bad Request',
+                           b'Format must be pstats or text.\n')
+
+        try:
+            with profile_requests.lock():
+                if path == '/debug/memory':
+                    log.info('Tracing memory allocations for %(seconds)ss.', {'seconds': seconds})
+                    return respond(start_response, '200 OK',
+                                   memory_growth(seconds, series_counts))
+
+                if query_name:
+                    metrics_key = (params.get('target'), query_name)
+                    log.info('Profiling next run of query %(query_name)s.',
+                             {'query_name': query_name})
+                    profile = profile_requests.profile_next_run(metrics_key, seconds)
+                    if profile is None:
+                        return respond(start_response, '504 Gateway Timeout',
+                                       'Query {} did not run within {}s.\n'.format(
+                                           query_name, seconds).encode('utf-8'))
+                    name = 'query-{}'.format(query_name)
+
+                elif params.get('scrape'):
+                    log.info('Profiling a scrape.')
+                    profile = cProfile.Profile()
+                    scrape_environ = {'PATH_INFO': '/metrics', 'QUERY_STRING': '',
+                                      'HTTP_ACCEPT_ENCODING': environ.get(
+                                          'HTTP_ACCEPT_ENCODING', '')}
+                    profile.runcall(metrics_app, scrape_environ, lambda *args: None)
+                    name = 'scrape'
+
+                else:
+                    log.info('Sampling stacks for %(seconds)ss.', {'seconds': seconds})
+                    return respond(start_response, '200 OK',
+                                   render_collapsed(sample_stacks(seconds)),
+                                   filename='exporter.collapsed')
+
+        except ProfilerBusyError as e:
+            return respond(start_response, '409 Conflict', '{}\n'.format(e).encode('utf-8'))
+
+        if output_format == 'text':
+            return respond(start_response, '200 OK', render_profile(profile, 'text'))
+        return respond(start_response, '200 OK', render_profile(profile, 'pstats'),
+                       content_type='application/octet-stream', filename=name + '.pstats')
+
+    return app
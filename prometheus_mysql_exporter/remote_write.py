@@ -0,0 +1,270 @@
+import logging
+import queue
+import snappy
+import struct
+import threading
+import time
+
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from .instrumentation import (REMOTE_WRITE_QUEUE_BATCHES, REMOTE_WRITE_RETRIES,
+                              REMOTE_WRITE_SAMPLES, REMOTE_WRITE_SEND_SECONDS)
+
+log = logging.getLogger(__name__)
+
+REMOTE_WRITE_HEADERS = {
+    'Content-Encoding': 'snappy',
+    'Content-Type': 'application/x-protobuf',
+    'User-Agent': 'prometheus-mysql-exporter',
+    'X-Prometheus-Remote-Write-Version': '0.1.0',
+}
+
+# The NaN bit pattern Prometheus uses to mark a series as stale.
+STALE_NAN_BYTES = struct.pack('<Q', 0x7ff0000000000002)
+
+
+# The remote-write protocol only needs a few simple protobuf messages, so they
+# are encoded by hand, rather than depending on protobuf:
+#
+#   message WriteRequest { repeated TimeSeries timeseries = 1; }
+#   message TimeSeries { repeated Label labels = 1; repeated Sample samples = 2; }
+#   message Label { string name = 1; string value = 2; }
+#   message Sample { double value = 1; int64 timestamp = 2; }
+
+def encode_varint(value):
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append((value & 0x7f) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def encode_bytes_field(field_number, data):
+    """
+    Encode a length-delimited (string, bytes, or message) protobuf field.
+    """
+
+    return encode_varint(field_number << 3 | 2) + encode_varint(len(data)) + data
+
+
+def encode_labels(labels):
+    """
+    Encode the Label messages of a TimeSeries message.
+
+    Takes labels as an iterable of (label name, label value) tuples, which
+    must be sorted by label name.
+    """
+
+    return b''.join(encode_bytes_field(1, encode_bytes_field(1, name.encode('utf-8'))
+                                       + encode_bytes_field(2, value.encode('utf-8')))
+                    for name, value in labels)
+
+
+def encode_write_request(series):
+    """
+    Encode a WriteRequest message.
+
+    Takes series as an iterable of tuples containing:
+    * labels, as encoded by encode_labels(),
+    * sample value, or None for a staleness marker,
+    * sample timestamp, in milliseconds since the epoch.
+    """
+
+    parts = []
+    for labels, value, timestamp in series:
+        value_bytes = STALE_NAN_BYTES if value is None else struct.pack('<d', value)
+        sample = b'\x09' + value_bytes + b'\x10' + encode_varint(timestamp)
+        parts.append(encode_bytes_field(1, labels + encode_bytes_field(2, sample)))
+    return b''.join(parts)
+
+
+class RemoteWriter(object):
+    """
+    Pushes query metrics to a Prometheus remote-write endpoint.
+
+    Query runs write the series of their metric dict via write(). Only the
+    changed series are sent, with staleness markers for removed series, so the
+    cost is proportional to the size of the change. All series are resent every
+    resend_interval seconds, so unchanged series aren't considered stale.
+
+    Series are encoded when written, and queued in batches of up to batch_size
+    samples. A sender thread combines queued batches (waiting up to
+    flush_interval seconds for more), and sends them as snappy-compressed
+    WriteRequests. Failed sends are retried with exponential backoff, up to
+    max_retries times, unless rejected by the endpoint (i.e. a 4xx response
+    other than 429 Too Many Requests).
+
+    The queue holds at most queue_size batches. When it's full, writes block
+    for up to block_timeout seconds, slowing query runs down to the rate the
+    endpoint can accept, before the series are dropped. If block_timeout is 0,
+    writes never block (e.g. as they're made from an event loop), and series
+    are dropped as soon as the queue is full.
+
+    If labels are provided, they're added to all series, unless a series has a
+    label with the same name.
+    """
+
+    def __init__(self, url, labels=None,
+                 batch_size=2000, queue_size=100, flush_interval=1, block_timeout=1,
+                 resend_interval=60, send_timeout=10, max_retries=5,
+                 min_backoff=0.5, max_backoff=30):
+        self.url = url
+        self.labels = dict(labels or {})
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block_timeout = block_timeout
+        self.resend_interval = resend_interval
+        self.send_timeout = send_timeout
+        self.max_retries = max_retries
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self._queue = queue.Queue(maxsize=queue_size)
+        # (target name, query name) -> time all series were last written.
+        # NOTE: Each entry is only accessed by the thread running its query.
+        self._last_full_write = {}
+
+    def start(self):
+        """
+        Start the sender thread.
+        """
+
+        thread = threading.Thread(target=self._run, name='remote-write')
+        thread.daemon = True
+        thread.start()
+
+    def write(self, metrics_key, metric_dict, changes=None):
+        """
+        Queue the series of a query's metric dict to be sent.
+
+        If a changes list is provided (see update_metric_dict()), only the
+        changed series are sent, with staleness markers for removed series.
+        Otherwise, or if all series haven't been sent for resend_interval
+        seconds, all series are sent.
+        """
+
+        now = time.time()
+        last_full_write = self._last_full_write.get(metrics_key)
+        if changes is None or last_full_write is None or now - last_full_write >= self.resend_interval:
+            self._last_full_write[metrics_key] = now
+            series = [(metric_name, label_keys, label_values, value)
+                      for metric_name, (_, label_keys, value_dict) in metric_dict.items()
+                      for label_values, value in value_dict.items()]
+            if changes:
+                series.extend(change for change in changes if change[3] is None)
+        else:
+            series = changes
+
+        if series:
+            self._enqueue(self._encode_series(series, int(now * 1000)))
+
+    def forget(self, metrics_key, metric_dict):
+        """
+        Send staleness markers for all series of a query that's no longer
+        configured.
+        """
+
+        self._last_full_write.pop(metrics_key, None)
+        series = [(metric_name, label_keys, label_values, None)
+                  for metric_name, (_, label_keys, value_dict) in metric_dict.items()
+                  for label_values in value_dict]
+        if series:
+            self._enqueue(self._encode_series(series, int(time.time() * 1000)))
+
+    def _encode_series(self, series, timestamp):
+        encoded = []
+        for metric_name, label_keys, label_values, value in series:
+            labels = self.labels.copy()
+            labels.update(zip(label_keys, label_values))
+            labels['__name__'] = metric_name
+            encoded.append((encode_labels(sorted(labels.items())),
+                            None if value is None else float(value),
+                            timestamp))
+        return encoded
+
+    def _enqueue(self, series):
+        for start in range(0, len(series), self.batch_size):
+            batch = series[start:start + self.batch_size]
+            try:
+                if self.block_timeout:
+                    self._queue.put(batch, timeout=self.block_timeout)
+                else:
+                    self._queue.put_nowait(batch)
+            except queue.Full:
+                dropped = len(series) - start
+                REMOTE_WRITE_SAMPLES.labels('dropped').inc(dropped)
+                log.warning('Remote write queue is full. Dropped %(dropped)s samples.',
+                            {'dropped': dropped})
+                break
+        REMOTE_WRITE_QUEUE_BATCHES.set(self._queue.qsize())
+
+    def _run(self):
+        pending = None
+        while True:
+            batch = pending if pending is not None else self._queue.get()
+            pending = None
+
+            # Combine queued batches, up to the batch size, to reduce the
+            # number of requests.
+            flush_time = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    more = self._queue.get(timeout=max(flush_time - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if len(batch) + len(more) > self.batch_size:
+                    pending = more
+                    break
+                batch = batch + more
+
+            REMOTE_WRITE_QUEUE_BATCHES.set(self._queue.qsize())
+            try:
+                self._send(batch)
+            except Exception:
+                REMOTE_WRITE_SAMPLES.labels('failed').inc(len(batch))
+                log.exception('Error while sending remote write request.')
+
+    def _send(self, batch):
+        data = snappy.compress(encode_write_request(batch))
+        request = Request(self.url, data=data, headers=REMOTE_WRITE_HEADERS, method='POST')
+
+        backoff = self.min_backoff
+        for attempt in range(self.max_retries + 1):
+            start_time = time.perf_counter()
+            try:
+                with urlopen(request, timeout=self.send_timeout):
+                    pass
+
+            except HTTPError as e:
+                REMOTE_WRITE_SEND_SECONDS.observe(time.perf_counter() - start_time)
+                # Only server errors and rate limiting are worth retrying.
+                if e.code != 429 and e.code < 500:
+                    REMOTE_WRITE_SAMPLES.labels('rejected').inc(len(batch))
+                    log.error('Remote write endpoint rejected %(count)s samples: '
+                              '%(status)s %(reason)s',
+                              {'count': len(batch), 'status': e.code, 'reason': e.reason})
+                    return
+                error = e
+
+            except OSError as e:
+                REMOTE_WRITE_SEND_SECONDS.observe(time.perf_counter() - start_time)
+                error = e
+
+            else:
+                REMOTE_WRITE_SEND_SECONDS.observe(time.perf_counter() - start_time)
+                REMOTE_WRITE_SAMPLES.labels('sent').inc(len(batch))
+                return
+
+            if attempt < self.max_retries:
+                REMOTE_WRITE_RETRIES.inc()
+                log.warning('Error while sending remote write request: %(error)s. '
+                            'Retrying in %(backoff)ss.',
+                            {'error': error, 'backoff': backoff})
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+        REMOTE_WRITE_SAMPLES.labels('failed').inc(len(batch))
+        log.error('Giving up sending %(count)s samples to the remote write endpoint '
+                  'after %(attempts)s attempts: %(error)s',
+                  {'count': len(batch), 'attempts': self.max_retries + 1, 'error': error})
@@ -0,0 +1,339 @@
+import logging
+import pymysql
+import random
+import socket
+import threading
+import time
+
+from contextlib import contextmanager, ExitStack
+from pymysql.constants import CR
+
+from .instrumentation import QUERY_FAILOVERS, REPLICA_LAG_SECONDS
+from .pool import ConnectionBackoffError
+
+log = logging.getLogger(__name__)
+
+
+class NoServerAvailableError(Exception):
+    """Raised when no server a query may be routed to is available."""
+
+
+def is_connection_error(error):
+    """
+    Return whether an error is due to the connection to a server, rather than
+    the statement run on it (e.g. a syntax error, or missing table), i.e. it's
+    worth trying another server, or connection.
+    """
+
+    if isinstance(error, (ConnectionBackoffError, OSError, pymysql.InterfaceError)):
+        return True
+    # Client errors (e.g. can't connect, or lost connection) are numbered
+    # 2000-2999. Server errors aren't.
+    return (isinstance(error, pymysql.MySQLError)
+            and bool(error.args) and isinstance(error.args[0], int)
+            and 2000 <= error.args[0] < 3000)
+
+
+def is_read_timeout(error):
+    """
+    Return whether an error is due to a query exceeding the client's read
+    timeout (--mysql-read-timeout). pymysql reports these as a lost
+    connection, but the server is likely fine, and just slow to run the query.
+    """
+
+    if isinstance(error, (socket.timeout, TimeoutError)):
+        return True
+    return (isinstance(error, pymysql.OperationalError)
+            and bool(error.args) and error.args[0] == CR.CR_SERVER_LOST
+            and isinstance(error.__context__, (socket.timeout, TimeoutError)))
+
+
+def is_failover_error(error):
+    """
+    Return whether an error is worth failing over to another server for, and
+    avoiding the server it happened on. Read timeouts aren't, as running the
+    query on another server would likely time out too.
+    """
+
+    return is_connection_error(error) and not is_read_timeout(error)
+
+
+class ReplicaSet(object):
+    """
+    Tracks the health, replication lag, and recent latency of the primary
+    server and read replicas of a target, to route queries between them.
+
+    Servers are identified by name (e.g. 'host:port'). The first is the
+    primary. The replication lag of each replica is checked by check(), which
+    should be run every few seconds. Replicas that aren't replicating, or lag
+    by more than max_lag seconds, aren't used until they catch up.
+
+    A server is also avoided for down_time seconds after a connection error,
+    or until its next successful check, if sooner.
+    """
+
+    def __init__(self, target_name, server_names, max_lag=30, down_time=30,
+                 latency_decay=0.3):
+        self.target_name = target_name
+        self.server_names = server_names
+        self.max_lag = max_lag
+        self.down_time = down_time
+        self.latency_decay = latency_decay
+        self._lock = threading.Lock()
+        # Server name -> [replication lag, latency, in-use connections, down until]
+        self._servers = {server_name: [0, None, 0, 0] for server_name in server_names}
+
+    @property
+    def primary(self):
+        return self.server_names[0]
+
+    @property
+    def replicas(self):
+        return self.server_names[1:]
+
+    def describe(self, server_name):
+        """
+        Return a description of a server for log messages, including the
+        target name, if any.
+        """
+
+        if self.target_name is None:
+            return server_name
+        return '{} of target {}'.format(server_name, self.target_name)
+
+    def candidates(self, routing):
+        """
+        Return the names of the servers a query with the given routing policy
+        (primary, replica, or any) may currently use, best first.
+
+        Servers are ranked by their recent latency, weighted by how many
+        connections are in use on them, so load is spread between servers with
+        similar latencies. Servers without a recorded latency are tried first.
+        """
+
+        if routing == 'primary':
+            server_names = [self.primary]
+        elif routing == 'replica':
+            server_names = list(self.replicas)
+        else:
+            server_names = list(self.server_names)
+        # Break ties randomly.
+        random.shuffle(server_names)
+
+        now = time.monotonic()
+        with self._lock:
+            ranked = []
+            for server_name in server_names:
+                lag, latency, in_use, down_until = self._servers[server_name]
+                if now < down_until or lag > self.max_lag:
+                    continue
+                ranked.append(((latency or 0) * (in_use + 1), server_name))
+
+        ranked.sort(key=lambda score_and_name: score_and_name[0])
+        return [server_name for _, server_name in ranked]
+
+    def acquire(self, server_name):
+        with self._lock:
+            self._servers[server_name][2] += 1
+
+    def release(self, server_name, duration=None):
+        """
+        Record that a connection to a server is no longer in use, along with
+        how long it was used for, if it was used successfully.
+        """
+
+        with self._lock:
+            server = self._servers[server_name]
+            server[2] -= 1
+            if duration is not None:
+                latency = server[1]
+                server[1] = (duration if latency is None
+                             else latency + self.latency_decay * (duration - latency))
+
+    def record_failure(self, server_name, error):
+        log.warning('Connection error on server %(server)s. Avoiding it for %(down_time)ss. '
+                    'Error: %(error)s',
+                    {'server': self.describe(server_name), 'error': error,
+                     'down_time': self.down_time})
+        with self._lock:
+            self._servers[server_name][3] = time.monotonic() + self.down_time
+
+    def record_lag(self, server_name, lag):
+        """
+        Record the replication lag of a replica, or None if it's not
+        replicating (or couldn't be checked).
+        """
+
+        REPLICA_LAG_SECONDS.labels(self.target_name or '', server_name).set(
+            float('nan') if lag is None else lag)
+        with self._lock:
+            server = self._servers[server_name]
+            was_usable = server[0] <= self.max_lag
+            server[0] = float('inf') if lag is None else lag
+            if lag is not None:
+                # The replica is reachable again.
+                server[3] = 0
+            usable = server[0] <= self.max_lag
+
+        if usable != was_usable:
+            if usable:
+                log.info('Replica %(server)s caught up. Routing queries to it.',
+                         {'server': self.describe(server_name)})
+            elif lag is None:
+                log.warning('Replica %(server)s is not replicating, or could not be checked. '
+                            'Not routing queries to it.',
+                            {'server': self.describe(server_name)})
+            else:
+                log.warning('Replica %(server)s is lagging by %(lag)ss. '
+                            'Not routing queries to it.',
+                            {'server': self.describe(server_name), 'lag': lag})
+
+    def check(self, check_pools):
+        """
+        Check the replication lag of each replica, using the connection pools
+        in check_pools, keyed by server name.
+        """
+
+        for server_name in self.replicas:
+            try:
+                with check_pools[server_name].connection() as conn:
+                    with conn.cursor(pymysql.cursors.DictCursor) as cursor:
+                        try:
+                            cursor.execute('SHOW REPLICA STATUS')
+                        except pymysql.ProgrammingError:
+                            # Older than MySQL 8.0.22 or MariaDB 10.5.1.
+                            cursor.execute('SHOW SLAVE STATUS')
+                        status = cursor.fetchone()
+            except Exception as e:
+                # Only changes in the replica's state are logged above debug
+                # level, as this is logged on every check.
+                log.debug('Error while checking replica %(server)s: %(error)s',
+                          {'server': self.describe(server_name), 'error': e})
+                self.record_lag(server_name, None)
+                continue
+
+            lag = None
+            if status:
+                lag = status.get('Seconds_Behind_Source', status.get('Seconds_Behind_Master'))
+            self.record_lag(server_name, lag)
+
+    def remove_metrics(self):
+        for server_name in self.replicas:
+            try:
+                REPLICA_LAG_SECONDS.remove(self.target_name or '', server_name)
+            except KeyError:
+                pass
+
+
+class RoutedPool(object):
+    """
+    Routes connection checkouts for a database to the servers of a
+    ReplicaSet, as per a routing policy (primary, replica, or any).
+
+    Can be used in place of a ConnectionPool by query runs. Takes a dict of
+    server name -> ConnectionPool, for the database.
+
+    If checking out a connection from the best server fails, the next best is
+    tried, so queries fail over to another server on connection errors, rather
+    than failing. Query runs using run() also fail over if the connection is
+    lost while running the query, unless it was due to the read timeout.
+    """
+
+    def __init__(self, replica_set, pools, routing):
+        self.replica_set = replica_set
+        self.pools = pools
+        self.routing = routing
+        self._lock = threading.Lock()
+        # Connection -> server name, for connections checked out.
+        self._servers = {}
+
+    @contextmanager
+    def connection(self):
+        with self._connection(self._candidates()) as (conn, _):
+            yield conn
+
+    def run(self, func):
+        """
+        Run func(conn) with a connection checked out as per connection(), and
+        return its result.
+
+        If func fails due to the connection (e.g. the server went away while
+        running the query), it's run again with a connection to the next best
+        server. func should start afresh each time it's run, and not have any
+        side effects until it's done with the connection.
+        """
+
+        server_names = self._candidates()
+        while True:
+            server_name = None
+            try:
+                with self._connection(server_names) as (conn, server_name):
+                    return func(conn)
+            except Exception as e:
+                # Checkout errors have already failed over to every server.
+                if (server_name is None or not is_failover_error(e)
+                        or server_name == server_names[-1]):
+                    raise
+                log.warning('Lost connection to server %(server)s while running a query. '
+                            'Retrying on the next server. %(error)s',
+                            {'server': self.replica_set.describe(server_name), 'error': e})
+                QUERY_FAILOVERS.labels(self.replica_set.target_name or '', server_name).inc()
+                server_names = server_names[server_names.index(server_name) + 1:]
+
+    def _candidates(self):
+        server_names = self.replica_set.candidates(self.routing)
+        if not server_names:
+            raise NoServerAvailableError('No healthy {} server available{}.'.format(
+                self.routing, '' if self.replica_set.target_name is None
+                else ' on target {}'.format(self.replica_set.target_name)))
+        return server_names
+
+    @contextmanager
+    def _connection(self, server_names):
+        """
+        Check out a connection from the best of the given servers, failing over
+        to the next on connection errors. Yields a (connection, server name)
+        tuple.
+        """
+
+        with ExitStack() as stack:
+            for i, server_name in enumerate(server_names):
+                try:
+                    conn = stack.enter_context(self.pools[server_name].connection())
+                except Exception as e:
+                    if not is_failover_error(e):
+                        raise
+                    self.replica_set.record_failure(server_name, e)
+                    if i == len(server_names) - 1:
+                        raise
+                    QUERY_FAILOVERS.labels(self.replica_set.target_name or '',
+                                           server_name).inc()
+                    continue
+                break
+
+            with self._lock:
+                self._servers[conn] = server_name
+            self.replica_set.acquire(server_name)
+            start_time = time.monotonic()
+            duration = None
+            try:
+                yield conn, server_name
+                duration = time.monotonic() - start_time
+            except Exception as e:
+                if is_failover_error(e):
+                    self.replica_set.record_failure(server_name, e)
+                raise
+            finally:
+                self.replica_set.release(server_name, duration)
+                with self._lock:
+                    del self._servers[conn]
+
+    def kill_connect(self, conn):
+        """
+        Return a function making a new connection to the server a checked out
+        connection is connected to, e.g. to kill its query.
+        """
+
+        with self._lock:
+            server_name = self._servers[conn]
+        return self.pools[server_name].connect
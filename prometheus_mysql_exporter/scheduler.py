@@ -1,53 +1,308 @@
-import time
 import logging
+import math
+import random
+import threading
+import time
+import zlib
 
 from croniter import croniter
 from datetime import datetime, timezone
 
+from .instrumentation import SCHEDULER_LAG_SECONDS
+
 log = logging.getLogger(__name__)
 
 
-def schedule_job(scheduler, interval, cron, cron_tz, func, *args, **kwargs):
+def stagger_offset(name, interval):
+    """
+    Return a stable offset, in seconds, within an interval for a job name.
+
+    Derived from a CRC32 hash of the name, rather than hash(), which is
+    randomised per process, so a job keeps the same offset across restarts.
+    """
+
+    return zlib.crc32(name.encode('utf-8')) / 2**32 * interval
+
+
+def next_phase_time(after, interval, offset):
+    """
+    Return the first monotonic time at or after `after` which is offset seconds
+    into an interval, with intervals aligned to the wall clock.
+
+    Aligning to the wall clock rather than the monotonic clock (which has an
+    arbitrary reference point) keeps the phase of a job the same across
+    restarts.
+    """
+
+    wall_after = after + (time.time() - time.monotonic())
+    return after + (offset - wall_after) % interval
+
+
+class StaggerPlanner(object):
+    """
+    Plans offsets for interval based jobs within their intervals, to spread
+    their load on the database evenly over time.
+
+    Each job is initially offset by a stable hash of its name (see
+    stagger_offset()), so restarts keep the same phases. If replan_interval is
+    set, offsets are re-planned that often, using the recent run times of the
+    jobs as their expected cost.
+
+    Jobs are planned together with other jobs in the same group (e.g. on the
+    same MySQL server) with the same interval. The interval is divided into
+    slots, and jobs are placed greedily, most expensive first, in the slots
+    with the least expected load. Ties are broken in favour of the slot
+    nearest a job's hash offset, so jobs with similar costs keep similar
+    phases.
+    """
+
+    def __init__(self, slots=60, replan_interval=None, cost_decay=0.3):
+        self.slots = slots
+        self.replan_interval = replan_interval
+        self.cost_decay = cost_decay
+        self._lock = threading.Lock()
+        # Job name -> [group, interval, expected cost, hash offset, planned offset]
+        self._jobs = {}
+        self._next_plan_time = 0
+
+    def add(self, name, interval, group=None):
+        offset = stagger_offset(name, interval)
+        with self._lock:
+            self._jobs[name] = [group, interval, None, offset, offset]
+
+    def remove(self, name):
+        with self._lock:
+            self._jobs.pop(name, None)
+
+    def record(self, name, duration):
+        """
+        Record the run time of a job, updating its expected cost (an
+        exponentially weighted moving average of its run times).
+        """
+
+        with self._lock:
+            job = self._jobs.get(name)
+            if job is None:
+                # Removed while running.
+                return
+            if job[2] is None:
+                job[2] = duration
+            else:
+                job[2] += self.cost_decay * (duration - job[2])
+
+    def offset(self, name):
+        """
+        Return the planned offset of a job within its interval, re-planning
+        first if due.
+        """
+
+        with self._lock:
+            if self.replan_interval is not None:
+                now = time.monotonic()
+                if now >= self._next_plan_time:
+                    self._plan()
+                    self._next_plan_time = now + self.replan_interval
+            return self._jobs[name][4]
+
+    def _plan(self):
+        jobs_by_interval = {}
+        for name, job in self._jobs.items():
+            group, interval = job[:2]
+            jobs_by_interval.setdefault((group, interval), []).append((name, job))
+
+        for (_, interval), jobs in jobs_by_interval.items():
+            known_costs = [job[2] for _, job in jobs if job[2] is not None]
+            if not known_costs:
+                # Nothing to plan with, so keep the hash offsets.
+                continue
+            # Assume jobs that haven't run yet have the average cost.
+            default_cost = sum(known_costs) / len(known_costs)
+
+            slot_width = interval / self.slots
+            load = [0.0] * self.slots
+            jobs.sort(key=lambda item: (-(item[1][2] if item[1][2] is not None else default_cost),
+                                        item[0]))
+            for _, job in jobs:
+                cost = job[2] if job[2] is not None else default_cost
+                span = min(max(math.ceil(cost / slot_width), 1), self.slots)
+                home_slot, home_fraction = divmod(job[3] / slot_width, 1)
+
+                def slot_key(slot):
+                    slot_load = sum(load[(slot + i) % self.slots] for i in range(span))
+                    distance = abs(slot - home_slot)
+                    return slot_load, min(distance, self.slots - distance)
+
+                slot = min(range(self.slots), key=slot_key)
+                for i in range(span):
+                    load[(slot + i) % self.slots] += cost / span
+                # Keep the fraction of the hash offset within the slot, so
+                # jobs sharing a slot don't start at exactly the same time.
+                job[4] = (slot + home_fraction) * slot_width
+
+
+def schedule_job(scheduler, interval, cron, cron_tz, func, *args,
+                 executor=None, name=None, group=None, planner=None, governor=None,
+                 jitter=0, delay=0, **kwargs):
     """
     Schedule a function to be run at a fixed interval, or based on a
     cron expression. Uses the croniter module for cron handling.
 
     Works with schedulers from the stdlib sched module.
+
+    If an executor (e.g. a concurrent.futures.ThreadPoolExecutor) is provided,
+    the scheduler only dispatches runs of the function to it, rather than
+    running it inline. A run is skipped if the previous run of the function is
+    still in progress.
+
+    If a StaggerPlanner is provided, interval based runs are offset within the
+    interval as planned for the job name (and group), rather than starting
+    immediately. The run times of the function are recorded with the planner.
+
+    If a QueryGovernor is provided, the job must already have been added to it
+    under its name. Runs are skipped if the governor doesn't allow them, and
+    interval based runs are spaced by the governor's effective interval for the
+    job. The run times of the function, and whether it succeeded (didn't raise
+    or return False), are recorded with the governor.
+
+    If jitter is set, each run is delayed by a random amount of up to that
+    many seconds.
+
+    If delay is set, the first run is delayed by that many seconds (e.g. as
+    recent results are already available), rather than starting immediately.
+
+    Returns a function that cancels the job, which must be called from the
+    scheduler's thread (e.g. by another job). It returns the future of the
+    in-progress run, if any, as that isn't cancelled.
     """
 
-    def scheduled_run(scheduled_time, *args, **kwargs):
+    running = None
+    next_event = None
+    cancelled = False
+
+    # Cron based runs are at fixed times, so can't be staggered.
+    if cron:
+        planner = None
+    if planner is not None:
+        planner.add(name, interval, group=group)
+
+    def run_job(run_time, *args, **kwargs):
+        start_time = time.monotonic()
+        SCHEDULER_LAG_SECONDS.observe(start_time - run_time)
+        ok = False
         try:
-            func(*args, **kwargs)
-        except Exception:
-            log.exception('Error while running scheduled job.')
-
-        current_time = time.monotonic()
-        if cron:
-            delay = calc_cron_delay(cron, cron_tz)
-            # Assume the current_dt used by calc_cron_delay() represents the
-            # same instant as current_time. Should be approximately true.
-            next_scheduled_time = current_time + delay
-            log.debug('Next cron based run in %(delay_s).2fs.',
-                      {'delay_s': delay})
+            ok = func(*args, **kwargs) is not False
+        finally:
+            duration = time.monotonic() - start_time
+            if planner is not None:
+                planner.record(name, duration)
+            if governor is not None:
+                governor.record(name, duration, ok)
+
+    def log_job_exception(future):
+        exception = future.exception()
+        if exception is not None:
+            log.error('Error while running scheduled job %(name)s.', {'name': name},
+                      exc_info=(type(exception), exception, exception.__traceback__))
+
+    def enter_run(scheduled_time, *args, **kwargs):
+        nonlocal next_event
+        # Jitter only delays the run itself, so it doesn't accumulate in the
+        # scheduled times of later runs.
+        run_time = scheduled_time + random.uniform(0, jitter) if jitter else scheduled_time
+        next_event = scheduler.enterabs(time=run_time,
+                                        priority=1,
+                                        action=scheduled_run,
+                                        argument=(scheduled_time, run_time, *args),
+                                        kwargs=kwargs)
+
+    def scheduled_run(scheduled_time, run_time, *args, **kwargs):
+        nonlocal running
+
+        if cancelled:
+            return
+
+        if executor is not None and running is not None and not running.done():
+            log.warning('Previous run of scheduled job %(name)s still in progress. Skipping run.',
+                        {'name': name})
+
+        elif governor is not None and not governor.allow(name):
+            log.debug('Skipping run of scheduled job %(name)s, as per the load governor.',
+                      {'name': name})
+
+        elif executor is None:
+            try:
+                run_job(run_time, *args, **kwargs)
+            except Exception:
+                log.exception('Error while running scheduled job %(name)s.', {'name': name})
+
         else:
-            next_scheduled_time = scheduled_time + interval
-            while next_scheduled_time < current_time:
-                next_scheduled_time += interval
-            log.debug('Next interval based run in %(delay_s).2fs.',
-                      {'delay_s': next_scheduled_time - current_time})
-
-        scheduler.enterabs(time=next_scheduled_time,
-                           priority=1,
-                           action=scheduled_run,
-                           argument=(next_scheduled_time, *args),
-                           kwargs=kwargs)
-
-    next_scheduled_time = time.monotonic()
-    scheduler.enterabs(time=next_scheduled_time,
-                       priority=1,
-                       action=scheduled_run,
-                       argument=(next_scheduled_time, *args),
-                       kwargs=kwargs)
+            running = executor.submit(run_job, run_time, *args, **kwargs)
+            running.add_done_callback(log_job_exception)
+
+        next_scheduled_time = next_run_time(scheduled_time, interval, cron, cron_tz,
+                                            name=name, planner=planner, governor=governor)
+        enter_run(next_scheduled_time, *args, **kwargs)
+
+    def cancel():
+        nonlocal cancelled
+        cancelled = True
+        try:
+            scheduler.cancel(next_event)
+        except ValueError:
+            # The event has already run.
+            pass
+        if planner is not None:
+            planner.remove(name)
+        if governor is not None:
+            governor.remove(name)
+        return running if running is not None and not running.done() else None
+
+    next_scheduled_time = time.monotonic() + delay
+    if planner is not None:
+        next_scheduled_time = next_phase_time(next_scheduled_time, interval, planner.offset(name))
+    enter_run(next_scheduled_time, *args, **kwargs)
+
+    return cancel
+
+
+def next_run_time(scheduled_time, interval, cron, cron_tz, name=None, planner=None,
+                  governor=None):
+    """
+    Return the monotonic time of the next run of a job, after a run scheduled
+    for scheduled_time, as per schedule_job().
+
+    Shared by the scheduler engines, so they schedule jobs the same way.
+    """
+
+    current_time = time.monotonic()
+    # The governor may stretch the interval, e.g. if runs are failing.
+    effective_interval = interval
+    if governor is not None and not cron:
+        effective_interval = governor.interval(name)
+
+    if cron:
+        delay = calc_cron_delay(cron, cron_tz)
+        # Assume the current_dt used by calc_cron_delay() represents the
+        # same instant as current_time. Should be approximately true.
+        next_scheduled_time = current_time + delay
+        log.debug('Next cron based run in %(delay_s).2fs.',
+                  {'delay_s': delay})
+    elif planner is not None:
+        # The planned offset may have changed since the last run, but don't
+        # let that bring the next run forward by more than half an interval.
+        next_scheduled_time = next_phase_time(
+            max(scheduled_time + effective_interval - interval / 2, current_time),
+            interval, planner.offset(name))
+        log.debug('Next interval based run in %(delay_s).2fs.',
+                  {'delay_s': next_scheduled_time - current_time})
+    else:
+        next_scheduled_time = scheduled_time + effective_interval
+        while next_scheduled_time < current_time:
+            next_scheduled_time += interval
+        log.debug('Next interval based run in %(delay_s).2fs.',
+                  {'delay_s': next_scheduled_time - current_time})
+
+    return next_scheduled_time
 
 
 def calc_cron_delay(cron, cron_tz):
@@ -66,3 +321,18 @@ def calc_cron_delay(cron, cron_tz):
     assert delay > 0, 'Cron delay should be positive.'
 
     return delay
+
+
+def calc_cron_elapsed(cron, cron_tz):
+    """
+    Return seconds since the previous cron run time by parsing a cron
+    expression. Uses the croniter module for cron handling.
+    """
+
+    current_dt = datetime.now(timezone.utc)
+    if cron_tz:
+        current_dt = current_dt.astimezone(cron_tz)
+
+    prev_dt = croniter(cron, current_dt).get_prev(datetime)
+
+    return (current_dt - prev_dt).total_seconds()
@@ -0,0 +1,121 @@
+import logging
+import threading
+import time
+
+from concurrent.futures import wait
+
+log = logging.getLogger(__name__)
+
+
+class OnScrapeJob(object):
+    """
+    A job run when metrics are scraped, rather than on a schedule.
+    """
+
+    __slots__ = ('target_name', 'cache_ttl', 'func', 'args', 'kwargs', 'running', 'last_run_time')
+
+    def __init__(self, target_name, cache_ttl, func, args, kwargs):
+        self.target_name = target_name
+        self.cache_ttl = cache_ttl
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        # Future (or task) of the in-progress run, if any.
+        self.running = None
+        # When the last run finished, or None if it hasn't run yet.
+        self.last_run_time = None
+
+
+class ScrapeTrigger(object):
+    """
+    Runs on-scrape jobs (e.g. query runs) when metrics are scraped.
+
+    A job is only run if its last run finished more than cache_ttl seconds
+    ago, so its stored results are served otherwise. If a job is already
+    running (e.g. due to a concurrent scrape from another Prometheus replica),
+    the scrape waits for that run, rather than starting another
+    (singleflight). Due jobs are run in parallel, on the provided executor.
+
+    Scrapes wait at most deadline seconds for jobs to finish, after which the
+    results of their previous runs are served. Jobs still running carry on in
+    the background, and their results are served by later scrapes.
+    """
+
+    def __init__(self, executor=None, deadline=None):
+        self.executor = executor
+        self.deadline = deadline
+        self._lock = threading.Lock()
+        self._jobs = []
+
+    def add(self, target_name, cache_ttl, func, *args, **kwargs):
+        job = OnScrapeJob(target_name, cache_ttl, func, args, kwargs)
+        with self._lock:
+            self._jobs.append(job)
+        return job
+
+    def remove(self, job):
+        """
+        Remove a job. Returns the future of its in-progress run, if any, as
+        that isn't cancelled.
+        """
+
+        with self._lock:
+            self._jobs.remove(job)
+            return job.running
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def _start_due_jobs(self, target_name, start):
+        """
+        Start the due jobs for a target (or all targets if target_name is
+        None) using the provided start function, which must return a future
+        for the run. Returns the futures of all due or running jobs.
+        """
+
+        now = time.monotonic()
+        futures = []
+        with self._lock:
+            for job in self._jobs:
+                if target_name is not None and job.target_name != target_name:
+                    continue
+
+                if job.running is not None:
+                    futures.append(job.running)
+                elif job.last_run_time is None or now - job.last_run_time >= job.cache_ttl:
+                    job.running = start(job)
+                    futures.append(job.running)
+
+        return futures
+
+    def _finish_job(self, job):
+        with self._lock:
+            job.running = None
+            # Failed runs count too, so a failing query isn't retried on
+            # every scrape.
+            job.last_run_time = time.monotonic()
+
+    def _run_job(self, job):
+        try:
+            job.func(*job.args, **job.kwargs)
+        except Exception:
+            log.exception('Error while running on-scrape job.')
+        finally:
+            self._finish_job(job)
+
+    def trigger(self, target_name=None):
+        """
+        Run the due jobs for a target (or all targets if target_name is None),
+        and wait for them to finish, up to the deadline.
+        """
+
+        futures = self._start_due_jobs(target_name,
+                                       lambda job: self.executor.submit(self._run_job, job))
+        if not futures:
+            return
+
+        _, not_done = wait(futures, timeout=self.deadline)
+        if not_done:
+            log.warning('%(count)s on-scrape queries did not finish within the scrape deadline '
+                        'of %(deadline)ss. Serving their cached results.',
+                        {'count': len(not_done), 'deadline': self.deadline})
@@ -0,0 +1,107 @@
+import gzip
+import logging
+import threading
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+from wsgiref.simple_server import make_server, WSGIRequestHandler, WSGIServer
+
+from .instrumentation import SCRAPE_RENDER_SECONDS
+
+log = logging.getLogger(__name__)
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """Thread per request HTTP server."""
+    # Make worker threads "fire and forget". Beginning with Python 3.7 this
+    # prevents a memory leak because ``ThreadingMixIn`` starts to gather all
+    # non-daemon threads in a list in order to join on them at server close.
+    daemon_threads = True
+
+
+class LoggingWSGIRequestHandler(WSGIRequestHandler):
+    """WSGI request handler that logs requests via the logging module."""
+
+    def log_message(self, format, *args):
+        log.debug('%(client)s - %(message)s',
+                  {'client': self.address_string(), 'message': format % args})
+
+
+def make_exporter_app(registry, exposition_cache, target_names=(), on_scrape=None):
+    """
+    Make a WSGI app serving the metrics in a registry, followed by the cached
+    query metrics in an exposition cache.
+
+    If target names are provided, the cached query metrics for a target are also
+    served at /probe?target=<name>. All other paths serve all metrics. Target
+    names can be any container (e.g. a set), and can be updated after the app
+    is made.
+
+    If provided, on_scrape is called before the metrics are rendered, with the
+    name of the target being scraped, or None if all metrics are being scraped.
+
+    Responses are gzip-compressed if the client accepts it, and the exposition
+    cache has compression enabled.
+    """
+
+    def app(environ, start_response):
+        start_time = time.perf_counter()
+        compress = (exposition_cache.compress
+                    and 'gzip' in environ.get('HTTP_ACCEPT_ENCODING', ''))
+
+        if target_names and environ['PATH_INFO'] == '/probe':
+            params = parse_qs(environ['QUERY_STRING'])
+            target_name = params.get('target', [None])[0]
+            if not target_name:
+                start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+                return [b'Missing target parameter.\n']
+
+            if target_name not in target_names:
+                start_response('404 Not Found', [('Content-Type', 'text/plain')])
+                return ['Unknown target {}.\n'.format(target_name).encode('utf-8')]
+
+            if on_scrape is not None:
+                on_scrape(target_name)
+                # Only time the rendering, not the queries run on scrape.
+                start_time = time.perf_counter()
+            chunks = exposition_cache.render(target_name, compress=compress)
+            if compress and not chunks:
+                chunks = [gzip.compress(b'')]
+            endpoint = 'probe'
+
+        else:
+            if on_scrape is not None:
+                on_scrape(None)
+                start_time = time.perf_counter()
+            registry_output = generate_latest(registry)
+            chunks = [gzip.compress(registry_output) if compress else registry_output]
+            chunks.extend(exposition_cache.render(compress=compress))
+            endpoint = 'metrics'
+
+        SCRAPE_RENDER_SECONDS.labels(endpoint).observe(time.perf_counter() - start_time)
+
+        headers = [('Content-Type', CONTENT_TYPE_LATEST),
+                   ('Content-Length', str(sum(len(chunk) for chunk in chunks)))]
+        if compress:
+            headers.append(('Content-Encoding', 'gzip'))
+
+        start_response('200 OK', headers)
+        return chunks
+
+    return app
+
+
+def start_http_server(port, app, addr='', name='http-server'):
+    """
+    Start a HTTP server serving a WSGI app in a daemon thread.
+    """
+
+    httpd = make_server(addr, port, app,
+                        ThreadingWSGIServer,
+                        handler_class=LoggingWSGIRequestHandler)
+    thread = threading.Thread(target=httpd.serve_forever, name=name)
+    thread.daemon = True
+    thread.start()
+    return httpd
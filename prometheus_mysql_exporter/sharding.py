@@ -0,0 +1,267 @@
+import logging
+import math
+import multiprocessing
+import os
+import threading
+import time
+import zlib
+
+from prometheus_client.core import Metric
+
+from .exposition import ExpositionCache
+
+log = logging.getLogger(__name__)
+
+# Prefix of the exporter's own metrics, which worker processes report to the
+# main process.
+EXPORTER_METRIC_PREFIX = 'mysql_exporter_'
+
+
+def query_shard(query_name, shard_count):
+    """
+    Return the shard a query belongs to, out of shard_count shards.
+
+    Derived from a CRC32 hash of the query name, rather than hash(), which is
+    randomised per process, so all processes agree on the shard of a query,
+    and it stays the same across restarts.
+    """
+
+    return zlib.crc32(query_name.encode('utf-8')) % shard_count
+
+
+def merge_metric_families(families):
+    """
+    Merge metric families with the same name, collected from different
+    processes, into one.
+
+    Values of counter, histogram, and summary samples with the same name and
+    labels are summed, except for _created samples, where the earliest is
+    kept. Gauges (and other types) aren't additive, and series reported by
+    several processes describe the same thing (e.g. the lag of a replica
+    checked by each process), so the largest value is kept, ignoring NaNs
+    unless all the values are NaN.
+    """
+
+    first = families[0]
+    summed = first.type in ('counter', 'histogram', 'summary')
+    values = {}
+    for family in families:
+        for sample in family.samples:
+            key = (sample.name, tuple(sorted(sample.labels.items())))
+            if key not in values:
+                values[key] = sample.value
+            elif sample.name.endswith('_created'):
+                values[key] = min(values[key], sample.value)
+            elif summed:
+                values[key] += sample.value
+            elif math.isnan(values[key]) or sample.value > values[key]:
+                values[key] = sample.value
+
+    merged = Metric(first.name, first.documentation, first.type, first.unit)
+    for (sample_name, labels), value in values.items():
+        merged.add_sample(sample_name, dict(labels), value)
+    return merged
+
+
+def exit_with_main_process(conn):
+    """
+    Exit a worker process once the main process has exited, i.e. its end of
+    the connection to the worker is closed. Blocks until then, so should be
+    run in a daemon thread.
+    """
+
+    try:
+        while True:
+            conn.recv()
+    except (EOFError, OSError):
+        pass
+
+    log.error('Main process exited. Exiting.')
+    os._exit(1)
+
+
+class ShardExpositionCache(ExpositionCache):
+    """
+    Exposition cache for a worker process, which sends rendered metrics to the
+    main process via a connection, rather than keeping them to be served.
+
+    Metrics are rendered (and compressed) by the worker, so the main process
+    only has to store them.
+    """
+
+    def __init__(self, conn, compress=False, enabled=True):
+        super().__init__(compress, enabled)
+        self._conn = conn
+        # Connections aren't thread safe, and queries may be run on multiple
+        # worker threads.
+        self._send_lock = threading.Lock()
+
+    def store(self, key, rendered, text=None, gzipped=None):
+        # The text is just the joined rendered metrics, so isn't worth sending.
+        self._send(('update', key, rendered, gzipped))
+
+    def remove(self, key):
+        self._send(('remove', key))
+
+    def render(self, target_name=None, compress=False):
+        raise NotImplementedError('Metrics are served by the main process.')
+
+    def report_metrics(self, registry):
+        """
+        Send the exporter's own metrics in a registry to the main process, so
+        they can be served along with its own.
+        """
+
+        self._send(('metrics', [metric for metric in registry.collect()
+                                if metric.name.startswith(EXPORTER_METRIC_PREFIX)]))
+
+    def _send(self, message):
+        with self._send_lock:
+            self._conn.send(message)
+
+
+class QueryShards(object):
+    """
+    Worker processes each running a shard of the queries, so parsing and
+    rendering results can use more than one CPU core.
+
+    Each worker runs target(*args, shard_index, conn) in a process of its own,
+    which should send its rendered metrics via a ShardExpositionCache wrapping
+    conn. They're stored in the main process' exposition cache to be served.
+    Workers that exit are restarted, after at least restart_delay seconds since
+    they were last started, and their metrics are removed until then.
+
+    QueryShards can be used as the registry of the metrics server, as collect()
+    returns the metrics in registry merged with those reported by the workers.
+    """
+
+    def __init__(self, target, args, shard_count, exposition_cache, registry,
+                 restart_delay=5):
+        self.target = target
+        self.args = args
+        self.shard_count = shard_count
+        self.exposition_cache = exposition_cache
+        self.registry = registry
+        self.restart_delay = restart_delay
+        # Workers are started fresh, rather than forked, as the main process
+        # has threads running (e.g. the metrics server), which forking doesn't
+        # copy, and may hold locks.
+        self._context = multiprocessing.get_context('spawn')
+        self._lock = threading.Lock()
+        self._processes = [None] * shard_count
+        # Shard index -> metric families last reported by the worker.
+        self._metrics = {}
+        self._stopping = False
+
+    def start(self):
+        for shard_index in range(self.shard_count):
+            thread = threading.Thread(target=self._supervise, args=(shard_index,),
+                                      name='query-shard-{}'.format(shard_index))
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """
+        Stop the worker processes, without restarting them.
+        """
+
+        with self._lock:
+            self._stopping = True
+            processes = [process for process in self._processes if process is not None]
+
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(timeout=5)
+
+    def signal(self, signum):
+        """
+        Send a signal to the worker processes (e.g. SIGHUP, to reload config).
+        """
+
+        with self._lock:
+            processes = [process for process in self._processes if process is not None]
+
+        for process in processes:
+            try:
+                os.kill(process.pid, signum)
+            except OSError:
+                # The process has exited, and will be restarted.
+                pass
+
+    def collect(self):
+        with self._lock:
+            shard_metrics = list(self._metrics.values())
+
+        families_by_name = {}
+        for metrics in shard_metrics:
+            for metric in metrics:
+                families_by_name.setdefault(metric.name, []).append(metric)
+
+        for metric in self.registry.collect():
+            families = families_by_name.pop(metric.name, None)
+            yield merge_metric_families([metric] + families) if families else metric
+
+        for families in families_by_name.values():
+            yield merge_metric_families(families)
+
+    def _supervise(self, shard_index):
+        while True:
+            conn, child_conn = self._context.Pipe()
+            process = self._context.Process(target=self.target,
+                                            args=self.args + (shard_index, child_conn),
+                                            name='query-shard-{}'.format(shard_index))
+            process.daemon = True
+            with self._lock:
+                if self._stopping:
+                    return
+                start_time = time.monotonic()
+                process.start()
+                self._processes[shard_index] = process
+            # Only the worker should hold its end, so the connection is closed
+            # when it exits.
+            child_conn.close()
+
+            log.info('Started worker process %(pid)s for query shard %(shard_index)s.',
+                     {'pid': process.pid, 'shard_index': shard_index})
+            keys = self._receive(shard_index, conn)
+
+            process.join()
+            conn.close()
+            with self._lock:
+                self._metrics.pop(shard_index, None)
+                if self._stopping:
+                    return
+            for key in keys:
+                self.exposition_cache.remove(key)
+
+            log.error('Worker process for query shard %(shard_index)s exited with code '
+                      '%(exit_code)s. Restarting it.',
+                      {'shard_index': shard_index, 'exit_code': process.exitcode})
+            time.sleep(max(start_time + self.restart_delay - time.monotonic(), 0))
+
+    def _receive(self, shard_index, conn):
+        """
+        Store the metrics sent by a worker, until it exits. Returns the keys of
+        the exposition cache entries stored.
+        """
+
+        keys = set()
+        try:
+            while True:
+                message = conn.recv()
+                if message[0] == 'update':
+                    _, key, rendered, gzipped = message
+                    keys.add(key)
+                    self.exposition_cache.store(key, rendered, gzipped=gzipped)
+                elif message[0] == 'remove':
+                    _, key = message
+                    keys.discard(key)
+                    self.exposition_cache.remove(key)
+                else:
+                    _, metrics = message
+                    with self._lock:
+                        self._metrics[shard_index] = metrics
+        except (EOFError, OSError):
+            pass
+        return keys
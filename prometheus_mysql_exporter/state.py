@@ -0,0 +1,202 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+def state_file_name(key):
+    """
+    Return the name of the state file for a (target name, query name) key.
+
+    Names are hashed, as they may contain characters that aren't valid in file
+    names. The key is stored in the file itself.
+    """
+
+    return hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest() + '.json.gz'
+
+
+def dump_state(key, metric_dict, watermark=None):
+    """
+    Serialise the metric dict of a query, and its watermark (if incremental),
+    as JSON. The watermark is stored as a string, as it may be of any type
+    MySQL returns (e.g. a datetime), and is only ever substituted into the
+    query as a string.
+    """
+
+    if watermark is not None:
+        watermark = str(watermark)
+
+    metrics = [[metric_name, metric_doc, list(label_keys),
+                [[*label_values, value] for label_values, value in value_dict.items()]]
+               for metric_name, (metric_doc, label_keys, value_dict) in metric_dict.items()]
+    return json.dumps({'key': list(key), 'watermark': watermark, 'metrics': metrics},
+                      separators=(',', ':')).encode('utf-8')
+
+
+def load_state(data):
+    """
+    Deserialise a query's state, as serialised by dump_state(). Returns a
+    (key, metric dict, watermark) tuple.
+    """
+
+    state = json.loads(data.decode('utf-8'))
+    metric_dict = {}
+    for metric_name, metric_doc, label_keys, series in state['metrics']:
+        metric_dict[metric_name] = (metric_doc, tuple(label_keys),
+                                    {tuple(values[:-1]): values[-1] for values in series})
+    return tuple(state['key']), metric_dict, state['watermark']
+
+
+class StateStore(object):
+    """
+    Snapshots of the stored metrics of each query on disk, so they can be
+    served as soon as the exporter restarts, rather than after each query's
+    next run.
+
+    Each query's snapshot is a gzipped JSON file in the directory, replaced
+    atomically (written to a temporary file, then renamed). The file's
+    modification time is the time of the query's last run, so snapshots of
+    queries whose metrics didn't change are just touched, rather than
+    rewritten.
+
+    The thread running the query only copies its metric dict, as that's
+    updated in place by later runs. Snapshots are serialised, compressed, and
+    written by a writer thread, so query runs don't wait on them. If a query
+    runs again before its snapshot is written, only the latest is written.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._condition = threading.Condition()
+        # (target name, query name) -> (metric dict, watermark) state to write,
+        # b'' to touch the snapshot, or None to remove it.
+        self._pending = {}
+        # Keys with a snapshot on disk, or pending.
+        self._saved = set()
+
+    def start(self):
+        """
+        Create the directory if needed, and start the writer thread.
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        thread = threading.Thread(target=self._run, name='state-writer')
+        thread.daemon = True
+        thread.start()
+
+    def save(self, key, metric_dict, changed, watermark=None):
+        """
+        Save a snapshot of the metric dict of a query after a run, in which
+        changed series changed.
+        """
+
+        with self._condition:
+            # Only touch the snapshot if nothing changed, unless a new snapshot
+            # is pending anyway.
+            touch = not changed and key in self._saved and self._pending.get(key, b'') == b''
+
+        if touch:
+            state = b''
+        else:
+            # Copying the value dicts is much cheaper than serialising them.
+            state = ({metric_name: (metric_doc, label_keys, dict(value_dict))
+                      for metric_name, (metric_doc, label_keys, value_dict)
+                      in metric_dict.items()},
+                     watermark)
+        with self._condition:
+            self._pending[key] = state
+            self._saved.add(key)
+            self._condition.notify()
+
+    def remove(self, key):
+        """
+        Remove the snapshot of a query that's no longer configured.
+        """
+
+        with self._condition:
+            if key not in self._saved:
+                return
+            self._pending[key] = None
+            self._saved.discard(key)
+            self._condition.notify()
+
+    def load(self, key, max_age=None):
+        """
+        Load the snapshot of a query, if it's no older than max_age seconds.
+        Returns a (metric dict, watermark, age) tuple, or None if there's no
+        usable snapshot.
+        """
+
+        with self._condition:
+            if key in self._pending and self._pending[key] is None:
+                # Removed, but not from disk yet.
+                return None
+
+        path = os.path.join(self.directory, state_file_name(key))
+        try:
+            age = time.time() - os.stat(path).st_mtime
+            if max_age is not None and age > max_age:
+                log.info('Snapshot of query %(query_name)s is too old (%(age).0fs). '
+                         'Ignoring it.', {'query_name': key[1], 'age': age})
+                return None
+
+            with gzip.open(path, 'rb') as state_file:
+                loaded_key, metric_dict, watermark = load_state(state_file.read())
+        except FileNotFoundError:
+            return None
+        except Exception:
+            log.exception('Error while loading snapshot of query %(query_name)s. Ignoring it.',
+                          {'query_name': key[1]})
+            return None
+
+        if loaded_key != key:
+            # A hash collision, however unlikely.
+            return None
+
+        with self._condition:
+            self._saved.add(key)
+        return metric_dict, watermark, age
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                pending = self._pending
+                self._pending = {}
+
+            for key, state in pending.items():
+                try:
+                    self._write(key, state)
+                except Exception:
+                    log.exception('Error while saving snapshot of query %(query_name)s.',
+                                  {'query_name': key[1]})
+
+    def _write(self, key, state):
+        path = os.path.join(self.directory, state_file_name(key))
+        if state is None:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+        elif not state:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                # Removed from under us, so save the next snapshot in full.
+                with self._condition:
+                    self._saved.discard(key)
+
+        else:
+            metric_dict, watermark = state
+            data = dump_state(key, metric_dict, watermark)
+            temp_path = path + '.tmp'
+            with gzip.open(temp_path, 'wb', compresslevel=1) as state_file:
+                state_file.write(data)
+            os.replace(temp_path, path)
@@ -0,0 +1,270 @@
+import threading
+
+from array import array
+from collections.abc import MutableMapping
+
+
+class SeriesIndex(object):
+    """
+    A stable mapping of label values tuples -> series ids.
+
+    Shared by the value dicts of metrics with the same label keys (e.g. the
+    metrics for each value column of a query), so each label values tuple is
+    only stored once. A series keeps its id for as long as it's present in any
+    of the value dicts, and the ids of removed series are reused.
+    """
+
+    __slots__ = ('ids', 'refs', 'free')
+
+    def __init__(self):
+        self.ids = {}
+        # Number of value dicts each series is present in, indexed by series id.
+        self.refs = array('L')
+        self.free = []
+
+    def acquire(self, label_values):
+        series_id = self.ids.get(label_values)
+        if series_id is None:
+            if self.free:
+                series_id = self.free.pop()
+            else:
+                series_id = len(self.refs)
+                self.refs.append(0)
+            self.ids[label_values] = series_id
+
+        self.refs[series_id] += 1
+        return series_id
+
+    def release(self, label_values):
+        series_id = self.ids[label_values]
+        self.refs[series_id] -= 1
+        if not self.refs[series_id]:
+            del self.ids[label_values]
+            self.free.append(series_id)
+
+
+class CompactValueDict(MutableMapping):
+    """
+    A value dict (label values tuple -> metric value) storing values compactly.
+
+    Label values tuples are stored in a (possibly shared) SeriesIndex, and
+    values are stored as doubles in an array indexed by series id, rather than
+    as individual float objects. Each series id costs about as much as a float
+    object, so this only saves memory when the index is shared by several
+    value dicts (see compact_metric_dict()).
+    """
+
+    __slots__ = ('_index', '_values', '_present', '_len')
+
+    def __init__(self, index=None, value_dict=None):
+        self._index = index if index is not None else SeriesIndex()
+        self._values = array('d')
+        self._present = bytearray()
+        self._len = 0
+        if value_dict:
+            self.update(value_dict)
+
+    @property
+    def index(self):
+        return self._index
+
+    def _series_id(self, label_values):
+        series_id = self._index.ids.get(label_values)
+        if series_id is None or series_id >= len(self._present) or not self._present[series_id]:
+            return None
+        return series_id
+
+    def __getitem__(self, label_values):
+        series_id = self._series_id(label_values)
+        if series_id is None:
+            raise KeyError(label_values)
+        return self._values[series_id]
+
+    def get(self, label_values, default=None):
+        # Faster than the MutableMapping default, which relies on KeyError.
+        series_id = self._index.ids.get(label_values)
+        if series_id is None or series_id >= len(self._present) or not self._present[series_id]:
+            return default
+        return self._values[series_id]
+
+    def __contains__(self, label_values):
+        return self.get(label_values) is not None
+
+    def __setitem__(self, label_values, value):
+        series_id = self._series_id(label_values)
+        if series_id is not None:
+            self._values[series_id] = value
+            return
+
+        series_id = self._index.acquire(label_values)
+        if series_id >= len(self._present):
+            grow_by = series_id + 1 - len(self._present)
+            self._values.frombytes(bytes(8 * grow_by))
+            self._present.extend(bytes(grow_by))
+        self._present[series_id] = 1
+        self._len += 1
+        self._values[series_id] = value
+
+    def update_changed(self, new_value_dict, changes=None):
+        """
+        Set the values from a new value dict, as per dict.update(), but only
+        where they've changed, looking up each series only once.
+
+        If a changes list is provided, a (label values tuple, new value) tuple
+        is appended to it for each added or changed label values tuple.
+
+        Returns the number of label values tuples added or changed.
+        """
+
+        ids = self._index.ids
+        values = self._values
+        present = self._present
+        size = len(present)
+        changed = 0
+        for label_values, value in new_value_dict.items():
+            series_id = ids.get(label_values)
+            if series_id is not None and series_id < size and present[series_id]:
+                if values[series_id] == value:
+                    continue
+                values[series_id] = value
+            else:
+                self[label_values] = value
+                # Adding a series may have grown the arrays.
+                values = self._values
+                present = self._present
+                size = len(present)
+            changed += 1
+            if changes is not None:
+                changes.append((label_values, value))
+        return changed
+
+    def __delitem__(self, label_values):
+        series_id = self._series_id(label_values)
+        if series_id is None:
+            raise KeyError(label_values)
+        self._present[series_id] = 0
+        self._len -= 1
+        self._index.release(label_values)
+
+    def __iter__(self):
+        present = self._present
+        size = len(present)
+        for label_values, series_id in self._index.ids.items():
+            if series_id < size and present[series_id]:
+                yield label_values
+
+    def __len__(self):
+        return self._len
+
+    def clear(self):
+        # Faster than the MutableMapping default, which removes items one by
+        # one, restarting iteration each time.
+        for label_values in list(self):
+            self._index.release(label_values)
+        self._values = array('d')
+        self._present = bytearray()
+        self._len = 0
+
+    def items(self):
+        # Faster than the MutableMapping default, which looks up each value.
+        values = self._values
+        present = self._present
+        size = len(present)
+        return [(label_values, values[series_id])
+                for label_values, series_id in self._index.ids.items()
+                if series_id < size and present[series_id]]
+
+
+def compact_metric_dict(metric_dict):
+    """
+    Convert the value dicts of a metric dict to CompactValueDicts, in place,
+    where that saves memory.
+
+    Metric dicts are keyed by metric name. Each metric name maps to a tuple
+    containing:
+    * metric documentation
+    * label keys tuple,
+    * dict of label values tuple -> metric value.
+
+    Metrics with the same label keys (e.g. the metrics for each value column
+    of a query) are converted, and share a SeriesIndex. Other metrics are left
+    as plain dicts, as a series index per value dict uses more memory than it
+    saves. Value dicts that are already compact are left as is.
+    """
+
+    value_dicts = {}
+    for metric_name, (_, label_keys, value_dict) in metric_dict.items():
+        value_dicts.setdefault(label_keys, []).append((metric_name, value_dict))
+
+    for label_keys, named_value_dicts in value_dicts.items():
+        if len(named_value_dicts) < 2:
+            continue
+
+        index = next((value_dict.index
+                      for _, value_dict in named_value_dicts
+                      if isinstance(value_dict, CompactValueDict)),
+                     None) or SeriesIndex()
+        for metric_name, value_dict in named_value_dicts:
+            if not isinstance(value_dict, CompactValueDict):
+                metric_doc = metric_dict[metric_name][0]
+                metric_dict[metric_name] = (metric_doc, label_keys,
+                                            CompactValueDict(index, value_dict))
+
+    return metric_dict
+
+
+class SeriesBudget(object):
+    """
+    A global budget for the number of series stored, and their estimated
+    memory use, shared by all queries.
+
+    Usage is tracked per key (e.g. (target name, query name) tuples). The
+    budget available to a key is whatever isn't used by other keys, so a query
+    can always replace its own series. A limit of None means unlimited.
+    """
+
+    def __init__(self, max_series=None, max_bytes=None):
+        self.max_series = max_series
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # key -> (series, estimated bytes)
+        self._usage = {}
+        self._total_series = 0
+        self._total_bytes = 0
+
+    def available(self, key):
+        """
+        Return a (max series, max bytes) tuple of the budget available to a key.
+        """
+
+        with self._lock:
+            series, estimated_bytes = self._usage.get(key, (0, 0))
+            max_series = (None if self.max_series is None
+                          else max(self.max_series - (self._total_series - series), 0))
+            max_bytes = (None if self.max_bytes is None
+                         else max(self.max_bytes - (self._total_bytes - estimated_bytes), 0))
+        return max_series, max_bytes
+
+    def usage(self, key):
+        """
+        Return a (series, estimated bytes) tuple of the budget used by a key.
+        """
+
+        with self._lock:
+            return self._usage.get(key, (0, 0))
+
+    def update(self, key, series, bytes_per_series=None):
+        """
+        Record the number of series stored for a key, and their estimated
+        memory use per series. If bytes_per_series isn't provided, the previous
+        estimate for the key is used.
+        """
+
+        with self._lock:
+            old_series, old_estimated_bytes = self._usage.get(key, (0, 0))
+            if bytes_per_series is None:
+                bytes_per_series = old_estimated_bytes / old_series if old_series else 0
+            estimated_bytes = int(series * bytes_per_series)
+            self._usage[key] = (series, estimated_bytes)
+            self._total_series += series - old_series
+            self._total_bytes += estimated_bytes - old_estimated_bytes
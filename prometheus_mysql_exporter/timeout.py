@@ -0,0 +1,82 @@
+import logging
+import threading
+
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+
+class QueryTimeoutError(Exception):
+    """Raised when a query is killed for exceeding its timeout."""
+
+
+@contextmanager
+def query_timeout(kill_connection, thread_id, timeout):
+    """
+    Enforce a timeout on a query running on a MySQL connection.
+
+    Takes a function returning a new connection to the same server, the
+    thread id of the connection the query is running on, and the timeout in
+    seconds. If the timeout is None or 0, no timeout is enforced.
+
+    If the query hasn't finished within the timeout, it's cancelled server-side
+    by running KILL QUERY on a separate connection. MySQL then aborts the query,
+    and the resulting error is re-raised as a QueryTimeoutError.
+
+    KILL QUERY is used rather than the MAX_EXECUTION_TIME optimizer hint, as it
+    works on any statement, and on MariaDB as well as MySQL.
+    """
+
+    if not timeout:
+        yield
+        return
+
+    lock = threading.Lock()
+    finished = False
+    killed = False
+
+    def kill():
+        nonlocal killed
+        # Hold the lock while killing, so the query's connection can't be
+        # reused for another query until the kill is complete.
+        with lock:
+            if finished:
+                return
+
+            log.warning('Query on connection %(thread_id)s exceeded timeout of '
+                        '%(timeout)ss. Killing query.',
+                        {'thread_id': thread_id, 'timeout': timeout})
+            # Set before the KILL is sent, as the query fails as soon as the
+            # server processes it, possibly before execute() returns here.
+            killed = True
+            try:
+                conn = kill_connection()
+                try:
+                    with conn.cursor() as cursor:
+                        cursor.execute('KILL QUERY %s', (thread_id,))
+                finally:
+                    conn.close()
+
+            except Exception:
+                log.exception('Error while killing query on connection %(thread_id)s.',
+                              {'thread_id': thread_id})
+
+    timer = threading.Timer(timeout, kill)
+    timer.daemon = True
+    timer.start()
+
+    try:
+        yield
+
+    except Exception as e:
+        # Wait for any kill in progress, so its error is recognised.
+        with lock:
+            timed_out = killed
+        if timed_out:
+            raise QueryTimeoutError('Query exceeded timeout of {}s.'.format(timeout)) from e
+        raise
+
+    finally:
+        timer.cancel()
+        with lock:
+            finished = True
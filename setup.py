@@ -23,24 +23,25 @@ setup(
         'Topic :: System :: Monitoring',
         'License :: OSI Approved :: MIT License',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
     ],
     keywords='monitoring prometheus exporter mysql',
     packages=find_packages(exclude=['tests']),
-    python_requires='>=3.5',
+    python_requires='>=3.7',
     install_requires=[
         'click',
         'click-config-file',
         'croniter',
-        'DBUtils ~= 2.0',
         'jog',
         'PyMySQL',
         'prometheus-client >= 0.6.0',
         'pytz',
     ],
+    extras_require={
+        'asyncio': ['aiomysql'],
+        'remote-write': ['python-snappy'],
+    },
     entry_points={
         'console_scripts': [
             'prometheus-mysql-exporter=prometheus_mysql_exporter:main',
@@ -0,0 +1,158 @@
+import pymysql
+import unittest
+
+from prometheus_mysql_exporter import forget_query, METRICS_BY_QUERY, run_batched_queries
+from prometheus_mysql_exporter.timeout import QueryTimeoutError
+
+DESCRIPTION = (('bar', 253), ('value', 3))
+
+
+class FakeBatchCursor(object):
+    """
+    Enough of a pymysql cursor for run_batched_queries(). Runs the statements
+    of a multi-statement query one result set at a time, as MySQL does, so a
+    failing statement raises when its result set is reached.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.description = None
+        self._statements = None
+        self._rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, query):
+        self.conn.batches.append(query.split('\n;\n'))
+        self._statements = list(self.conn.batches[-1])
+        self._next_result()
+
+    def fetchall(self):
+        return self._rows
+
+    def nextset(self):
+        if not self._statements:
+            return None
+        self._next_result()
+        return True
+
+    def _next_result(self):
+        result = self.conn.results[self._statements.pop(0)]
+        if isinstance(result, Exception):
+            self._statements = None
+            raise result
+        self.description = DESCRIPTION
+        self._rows = result
+
+
+class FakeBatchConnection(object):
+
+    def __init__(self, results):
+        # Statement -> rows, or the error running it raises.
+        self.results = results
+        self.batches = []
+
+    def cursor(self):
+        return FakeBatchCursor(self)
+
+    def thread_id(self):
+        return 1
+
+
+class FakePool(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def run(self, func):
+        return func(self.conn)
+
+    def kill_connect(self, conn):
+        def connect():
+            raise AssertionError('No queries should be killed.')
+        return connect
+
+
+class RunBatchedQueriesTests(unittest.TestCase):
+
+    statements = ['SELECT 1', 'SELECT 2', 'SELECT 3']
+
+    def tearDown(self):
+        for query_name in ('a', 'b', 'c'):
+            forget_query((None, query_name))
+
+    def run_batch(self, results):
+        conn = FakeBatchConnection(results)
+        statements = [(statement, [(query_name, ['value'], 'zero', 'drop', None, None, 'reject')])
+                      for statement, query_name in zip(self.statements, 'abc')]
+        ok = run_batched_queries(FakePool(conn), None, 'test', statements, None)
+        return ok, conn.batches
+
+    def stored_values(self):
+        return {metrics_key[1]: dict(metric_dict['{}_value'.format(metrics_key[1])][2])
+                for metrics_key, metric_dict in METRICS_BY_QUERY.items()
+                if metrics_key[0] is None and metrics_key[1] in ('a', 'b', 'c')}
+
+    def test_batch(self):
+        ok, batches = self.run_batch({'SELECT 1': [('x', 1)],
+                                      'SELECT 2': [('x', 2)],
+                                      'SELECT 3': [('x', 3)]})
+
+        self.assertIsNone(ok)
+        self.assertEqual(batches, [self.statements])
+        self.assertEqual(self.stored_values(), {
+            'a': {('test', 'x'): 1}, 'b': {('test', 'x'): 2}, 'c': {('test', 'x'): 3},
+        })
+
+    def test_statement_error_isolated(self):
+        self.run_batch({'SELECT 1': [('x', 1)], 'SELECT 2': [('x', 2)], 'SELECT 3': [('x', 3)]})
+        with self.assertLogs('prometheus_mysql_exporter', 'ERROR'):
+            ok, batches = self.run_batch({
+                'SELECT 1': [('x', 4)],
+                'SELECT 2': pymysql.ProgrammingError(1146, "Table 'test.foo' doesn't exist"),
+                'SELECT 3': [('x', 6)],
+            })
+
+        # Only the failed statement's queries are handled as per on_error,
+        # and the statements after it are resent as a new batch.
+        self.assertIsNone(ok)
+        self.assertEqual(batches, [self.statements, ['SELECT 3']])
+        self.assertEqual(self.stored_values(), {
+            'a': {('test', 'x'): 4}, 'b': {('test', 'x'): 0}, 'c': {('test', 'x'): 6},
+        })
+
+    def test_connection_error_fails_rest_of_batch(self):
+        self.run_batch({'SELECT 1': [('x', 1)], 'SELECT 2': [('x', 2)], 'SELECT 3': [('x', 3)]})
+        with self.assertLogs('prometheus_mysql_exporter', 'ERROR'):
+            ok, batches = self.run_batch({
+                'SELECT 1': [('x', 4)],
+                'SELECT 2': pymysql.OperationalError(2013, 'Lost connection'),
+                'SELECT 3': [('x', 6)],
+            })
+
+        self.assertIs(ok, False)
+        self.assertEqual(batches, [self.statements])
+        self.assertEqual(self.stored_values(), {
+            'a': {('test', 'x'): 4}, 'b': {('test', 'x'): 0}, 'c': {('test', 'x'): 0},
+        })
+
+    def test_timeout_fails_rest_of_batch(self):
+        with self.assertLogs('prometheus_mysql_exporter', 'ERROR'):
+            ok, batches = self.run_batch({
+                'SELECT 1': [('x', 1)],
+                'SELECT 2': QueryTimeoutError('Query exceeded timeout of 5s.'),
+                'SELECT 3': [('x', 3)],
+            })
+
+        # The timeout applies to the whole batch, so the rest isn't resent.
+        self.assertIs(ok, False)
+        self.assertEqual(batches, [self.statements])
+        self.assertEqual(self.stored_values(), {'a': {('test', 'x'): 1}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+
+from prometheus_client import CollectorRegistry, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from prometheus_mysql_exporter.exposition import render_metric_dict
+
+
+class Collector(object):
+
+    def __init__(self, families):
+        self.families = families
+
+    def collect(self):
+        return self.families
+
+
+def render_with_client(metric_dict, metric_type='gauge'):
+    families = []
+    for metric_name, (metric_doc, label_keys, value_dict) in metric_dict.items():
+        if metric_type == 'counter':
+            family = CounterMetricFamily(metric_name, metric_doc, labels=label_keys)
+        else:
+            family = GaugeMetricFamily(metric_name, metric_doc, labels=label_keys)
+        for label_values, value in sorted(value_dict.items()):
+            family.add_metric(label_values, value)
+        families.append(family)
+
+    registry = CollectorRegistry()
+    registry.register(Collector(families))
+    return generate_latest(registry)
+
+
+def render(metric_dict, metric_type='gauge'):
+    return b''.join(header + samples for _, header, samples
+                    in render_metric_dict(metric_dict, metric_type))
+
+
+class RenderMetricDictTests(unittest.TestCase):
+
+    def test_matches_prometheus_client(self):
+        metric_dict = {
+            'foo_ni': ("Value column 'ni' for query 'foo'.", ('db', 'zed', 'bar'), {
+                ('test', 'z1', 'b2'): 1,
+                ('test', 'z1', 'b1'): 2.5,
+                ('test', 'z"2', 'b\\1\n'): -3e-9,
+                ('test', 'z3', ''): float('inf'),
+                ('test', 'z4', 'b4'): float('-inf'),
+                ('test', 'z5', 'b5'): 123456789012345678,
+            }),
+            'foo_no_labels': ('Doc with a backslash \\ and a\nnewline.', (), {(): 0}),
+        }
+
+        self.assertEqual(render(metric_dict), render_with_client(metric_dict))
+
+    def test_nan(self):
+        metric_dict = {'foo': ('Foo.', ('bar',), {('a',): float('nan')})}
+
+        self.assertEqual(render(metric_dict), render_with_client(metric_dict))
+
+    def test_counter(self):
+        metric_dict = {'foo_total': ('Foo.', ('bar',), {('a',): 1, ('b',): 2})}
+
+        self.assertEqual(render(metric_dict, 'counter'),
+                         render_with_client(metric_dict, 'counter'))
+
+
+if __name__ == '__main__':
+    unittest.main()
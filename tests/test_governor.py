@@ -0,0 +1,81 @@
+import time
+import unittest
+
+from prometheus_mysql_exporter.governor import QueryGovernor
+
+
+class QueryGovernorTests(unittest.TestCase):
+
+    def test_backoff(self):
+        governor = QueryGovernor(max_backoff=4)
+        governor.add('a', 10)
+
+        # Runs slower than half the interval are unhealthy by default.
+        governor.record('a', 6, True)
+        self.assertEqual(governor.interval('a'), 20)
+        governor.record('a', 1, False)
+        self.assertEqual(governor.interval('a'), 40)
+        governor.record('a', 1, False)
+        self.assertEqual(governor.interval('a'), 40)
+
+        governor.record('a', 1, True)
+        self.assertEqual(governor.interval('a'), 20)
+        governor.record('a', 1, True)
+        governor.record('a', 1, True)
+        self.assertEqual(governor.interval('a'), 10)
+
+    def test_slow_threshold(self):
+        governor = QueryGovernor(slow_threshold=2)
+        governor.add('a', 10)
+        governor.record('a', 3, True)
+
+        self.assertEqual(governor.interval('a'), 20)
+
+    def test_breaker(self):
+        governor = QueryGovernor(breaker_failures=2, breaker_timeout=0.05)
+        governor.add('a', 10)
+
+        governor.record('a', 1, False)
+        self.assertTrue(governor.allow('a'))
+        governor.record('a', 1, False)
+        self.assertFalse(governor.allow('a'))
+
+        # Once the breaker times out, a single trial run is allowed.
+        time.sleep(0.06)
+        self.assertTrue(governor.allow('a'))
+        self.assertFalse(governor.allow('a'))
+        governor.record('a', 1, False)
+        self.assertFalse(governor.allow('a'))
+
+        time.sleep(0.06)
+        self.assertTrue(governor.allow('a'))
+        governor.record('a', 1, True)
+        self.assertTrue(governor.allow('a'))
+        self.assertTrue(governor.allow('a'))
+
+    def test_low_priority_shed(self):
+        governor = QueryGovernor(breaker_failures=1, breaker_timeout=60)
+        governor.add('normal', 10, group='server')
+        governor.add('low', 10, group='server', priority='low')
+        governor.add('other', 10, group='other_server', priority='low')
+
+        governor.record('normal', 1, False)
+
+        # Low priority jobs back off with, and pause for, the rest of their
+        # group.
+        self.assertEqual(governor.interval('low'), 20)
+        self.assertFalse(governor.allow('low'))
+        self.assertEqual(governor.interval('other'), 10)
+        self.assertTrue(governor.allow('other'))
+
+    def test_cron_jobs(self):
+        governor = QueryGovernor(breaker_failures=1, breaker_timeout=60)
+        governor.add('a')
+        governor.record('a', 100, True)
+        self.assertTrue(governor.allow('a'))
+        governor.record('a', 1, False)
+        self.assertFalse(governor.allow('a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
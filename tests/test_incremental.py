@@ -0,0 +1,155 @@
+import os
+import tempfile
+import unittest
+
+from prometheus_mysql_exporter import (forget_query, load_config, METRICS_BY_QUERY,
+                                       run_incremental_query, WATERMARKS)
+
+DESCRIPTION = (('bar', 253), ('value', 3), ('watermark', 3))
+
+
+class FakeCursor(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.description = None
+        self._rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, query):
+        self.conn.statements.append(query)
+        result = self.conn.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        self.description = DESCRIPTION
+        self._rows = result
+
+    def fetchall(self):
+        return self._rows
+
+
+class FakeConnection(object):
+    """
+    Enough of a pymysql connection for run_incremental_query(), returning the
+    queued results (rows, or an error to raise) in turn.
+    """
+
+    def __init__(self):
+        self.results = []
+        self.statements = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def escape(self, value):
+        return "'{}'".format(value)
+
+    def thread_id(self):
+        return 1
+
+
+class FakePool(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def run(self, func):
+        return func(self.conn)
+
+    def kill_connect(self, conn):
+        def connect():
+            raise AssertionError('No queries should be killed.')
+        return connect
+
+
+class RunIncrementalQueryTests(unittest.TestCase):
+
+    metrics_key = (None, 'events')
+
+    def setUp(self):
+        self.conn = FakeConnection()
+
+    def tearDown(self):
+        forget_query(self.metrics_key)
+
+    def run_query(self, rows, max_series=None):
+        self.conn.results.append(rows)
+        return run_incremental_query(FakePool(self.conn), None, 'events', 'test',
+                                     'SELECT ... WHERE id > {watermark}', ['value'],
+                                     max_series=max_series, watermark_start='0')
+
+    def counters(self):
+        return dict(METRICS_BY_QUERY[self.metrics_key]['events_value_total'][2])
+
+    def test_accumulate_and_advance_watermark(self):
+        self.run_query([('a', 1, 10), ('b', 2, 12)])
+        self.run_query([('a', 3, 15)])
+
+        self.assertEqual(self.conn.statements, ["SELECT ... WHERE id > '0'",
+                                                "SELECT ... WHERE id > '12'"])
+        self.assertEqual(WATERMARKS[self.metrics_key], 15)
+        # The watermark column isn't exported.
+        self.assertEqual(list(METRICS_BY_QUERY[self.metrics_key]), ['events_value_total'])
+        self.assertEqual(self.counters(), {('test', 'a'): 4, ('test', 'b'): 2})
+
+    def test_no_new_rows(self):
+        self.run_query([('a', 1, 10)])
+        self.run_query([])
+
+        self.assertEqual(WATERMARKS[self.metrics_key], 10)
+        self.assertEqual(self.counters(), {('test', 'a'): 1})
+
+    def test_failed_run_keeps_counters_and_watermark(self):
+        self.run_query([('a', 1, 10)])
+        with self.assertLogs('prometheus_mysql_exporter', 'ERROR'):
+            self.assertIs(self.run_query(RuntimeError('Query failed.')), False)
+
+        self.assertEqual(WATERMARKS[self.metrics_key], 10)
+        self.assertEqual(self.counters(), {('test', 'a'): 1})
+
+    def test_series_limit_keeps_counters_and_watermark(self):
+        self.run_query([('a', 1, 10)], max_series=2)
+        # Rows after the one exceeding the limit would never be counted if
+        # the watermark were advanced past them.
+        with self.assertLogs('prometheus_mysql_exporter', 'ERROR'):
+            self.assertIs(self.run_query([('b', 1, 11), ('c', 1, 12), ('a', 1, 13)],
+                                         max_series=2), True)
+
+        self.assertEqual(WATERMARKS[self.metrics_key], 10)
+        self.assertEqual(self.counters(), {('test', 'a'): 1})
+
+
+class LoadConfigTests(unittest.TestCase):
+
+    def load_config(self, config):
+        with tempfile.TemporaryDirectory() as config_dir:
+            config_file_path = os.path.join(config_dir, 'exporter.cfg')
+            with open(config_file_path, 'w') as config_file:
+                config_file.write(config)
+            return load_config(config_file_path, os.path.join(config_dir, 'config'),
+                               ('localhost', 3306, 'user', 'password', ()))
+
+    def test_incremental_truncate_rejected(self):
+        config = '\n'.join([
+            '[query_events]',
+            'QueryDatabase = test',
+            'QueryStatement = SELECT 1',
+            'QueryValueColumns = value',
+            'QueryMode = incremental',
+            'QueryWatermarkColumn = watermark',
+            'QueryOnSeriesLimit = {}',
+        ])
+
+        queries, _ = self.load_config(config.format('reject'))
+        self.assertEqual(queries['events'].on_series_limit, 'reject')
+        with self.assertRaises(ValueError):
+            self.load_config(config.format('truncate'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+
+from prometheus_mysql_exporter.metrics import accumulate_metric_dict, update_metric_dict
+
+
+def metric_dict(*metrics):
+    return {metric_name: ('Doc for {}.'.format(metric_name), label_keys, dict(value_dict))
+            for metric_name, label_keys, value_dict in metrics}
+
+
+class UpdateMetricDictTests(unittest.TestCase):
+
+    def setUp(self):
+        self.stored = metric_dict(('foo', ('bar',), {('a',): 1, ('b',): 2}),
+                                  ('baz', (), {(): 3}))
+
+    def test_drop_missing(self):
+        changes = []
+        changed = update_metric_dict(self.stored,
+                                     metric_dict(('foo', ('bar',), {('a',): 1, ('c',): 4})),
+                                     on_missing='drop', changes=changes)
+
+        self.assertEqual(self.stored, metric_dict(('foo', ('bar',), {('a',): 1, ('c',): 4})))
+        self.assertEqual(changed, 3)
+        self.assertEqual(sorted(changes, key=repr), sorted([
+            ('foo', ('bar',), ('b',), None),
+            ('foo', ('bar',), ('c',), 4),
+            ('baz', (), (), None),
+        ], key=repr))
+
+    def test_preserve_missing(self):
+        changed = update_metric_dict(self.stored,
+                                     metric_dict(('foo', ('bar',), {('a',): 5})),
+                                     on_missing='preserve')
+
+        self.assertEqual(self.stored, metric_dict(('foo', ('bar',), {('a',): 5, ('b',): 2}),
+                                                  ('baz', (), {(): 3})))
+        self.assertEqual(changed, 1)
+
+    def test_zero_missing(self):
+        changed = update_metric_dict(self.stored,
+                                     metric_dict(('foo', ('bar',), {('a',): 1})),
+                                     on_missing='zero')
+
+        self.assertEqual(self.stored, metric_dict(('foo', ('bar',), {('a',): 1, ('b',): 0}),
+                                                  ('baz', (), {(): 0})))
+        self.assertEqual(changed, 2)
+
+    def test_unchanged(self):
+        changed = update_metric_dict(self.stored,
+                                     metric_dict(('foo', ('bar',), {('a',): 1, ('b',): 2}),
+                                                 ('baz', (), {(): 3})))
+
+        self.assertEqual(changed, 0)
+
+    def test_label_keys_changed(self):
+        changes = []
+        changed = update_metric_dict(self.stored,
+                                     metric_dict(('foo', ('bar', 'ni'), {('a', 'x'): 1}),
+                                                 ('baz', (), {(): 3})),
+                                     changes=changes)
+
+        self.assertEqual(self.stored, metric_dict(('foo', ('bar', 'ni'), {('a', 'x'): 1}),
+                                                  ('baz', (), {(): 3})))
+        self.assertEqual(changed, 3)
+        self.assertEqual(changes, [
+            ('foo', ('bar',), ('a',), None),
+            ('foo', ('bar',), ('b',), None),
+            ('foo', ('bar', 'ni'), ('a', 'x'), 1),
+        ])
+
+
+class AccumulateMetricDictTests(unittest.TestCase):
+
+    def test_accumulate(self):
+        stored = metric_dict(('foo_total', ('bar',), {('a',): 1, ('b',): 2}))
+        changes = []
+        changed = accumulate_metric_dict(stored,
+                                         metric_dict(('foo_total', ('bar',),
+                                                      {('a',): 3, ('b',): 0, ('c',): 0}),
+                                                     ('baz_total', (), {(): 4})),
+                                         changes=changes)
+
+        self.assertEqual(stored, metric_dict(('foo_total', ('bar',),
+                                              {('a',): 4, ('b',): 2, ('c',): 0}),
+                                             ('baz_total', (), {(): 4})))
+        # Series with a zero delta are only touched if they're new.
+        self.assertEqual(changed, 3)
+        self.assertEqual(changes, [
+            ('foo_total', ('bar',), ('a',), 4),
+            ('foo_total', ('bar',), ('c',), 0),
+            ('baz_total', (), (), 4),
+        ])
+
+    def test_missing_series_kept(self):
+        stored = metric_dict(('foo_total', ('bar',), {('a',): 1}))
+        accumulate_metric_dict(stored, {})
+
+        self.assertEqual(stored, metric_dict(('foo_total', ('bar',), {('a',): 1})))
+
+
+if __name__ == '__main__':
+    unittest.main()
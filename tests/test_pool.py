@@ -0,0 +1,145 @@
+import threading
+import time
+import unittest
+
+from prometheus_mysql_exporter.pool import ConnectionBackoffError, ConnectionPool
+
+
+class FakeConnection(object):
+    """
+    Enough of a pymysql connection for ConnectionPool.
+    """
+
+    def __init__(self, database, healthy=True):
+        self.database = database
+        self.healthy = healthy
+        self.open = True
+
+    def ping(self, reconnect=True):
+        if not self.healthy:
+            raise ConnectionResetError('Connection reset by peer.')
+
+    def close(self):
+        self.open = False
+
+
+class ConnectionPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = []
+        self.connect_error = None
+
+    def connect(self, database):
+        if self.connect_error is not None:
+            raise self.connect_error
+        conn = FakeConnection(database)
+        self.connections.append(conn)
+        return conn
+
+    def make_pool(self, **kwargs):
+        return ConnectionPool(self.connect, 'test', **kwargs)
+
+    def test_reuses_connections(self):
+        pool = self.make_pool()
+        with pool.connection() as conn:
+            self.assertEqual(conn.database, 'test')
+        with pool.connection() as conn2:
+            self.assertIs(conn2, conn)
+
+        self.assertEqual(len(self.connections), 1)
+
+    def test_checkout_blocks_at_max_size(self):
+        pool = self.make_pool(max_size=1)
+        checked_out = []
+
+        def checkout():
+            with pool.connection() as conn:
+                checked_out.append(conn)
+
+        with pool.connection() as conn:
+            thread = threading.Thread(target=checkout)
+            thread.start()
+            thread.join(0.1)
+            # Waiting for the connection in use.
+            self.assertTrue(thread.is_alive())
+            self.assertEqual(checked_out, [])
+
+        thread.join(5)
+        self.assertEqual(checked_out, [conn])
+        self.assertEqual(len(self.connections), 1)
+
+    def test_closed_connections_discarded(self):
+        pool = self.make_pool(max_size=1)
+        with pool.connection() as conn:
+            conn.close()
+        with pool.connection() as conn2:
+            self.assertIsNot(conn2, conn)
+
+        self.assertEqual(len(self.connections), 2)
+
+    def test_unhealthy_idle_connections_replaced(self):
+        pool = self.make_pool(check_idle=0)
+        with pool.connection() as conn:
+            conn.healthy = False
+        time.sleep(0.01)
+        with pool.connection() as conn2:
+            self.assertIsNot(conn2, conn)
+
+        self.assertFalse(conn.open)
+
+    def test_evict_idle(self):
+        pool = self.make_pool(min_size=1, idle_timeout=0.01)
+        with pool.connection() as conn:
+            with pool.connection() as conn2:
+                pass
+        time.sleep(0.02)
+        pool.evict_idle()
+
+        # The least recently used connection is evicted, down to min_size.
+        self.assertFalse(conn2.open)
+        self.assertTrue(conn.open)
+        with pool.connection() as conn3:
+            self.assertIs(conn3, conn)
+
+    def test_connect_backoff(self):
+        pool = self.make_pool(backoff_initial=0.05)
+        self.connect_error = ConnectionRefusedError('Connection refused.')
+        with self.assertRaises(ConnectionRefusedError):
+            with pool.connection():
+                pass
+
+        # Checkouts fail immediately until the backoff period is over.
+        self.connect_error = None
+        with self.assertRaises(ConnectionBackoffError):
+            with pool.connection():
+                pass
+        time.sleep(0.06)
+        with pool.connection() as conn:
+            self.assertTrue(conn.open)
+
+    def test_failed_connect_frees_slot(self):
+        pool = self.make_pool(max_size=1, backoff_initial=0)
+        self.connect_error = ConnectionRefusedError('Connection refused.')
+        with self.assertRaises(ConnectionRefusedError):
+            with pool.connection():
+                pass
+
+        self.connect_error = None
+        with pool.connection() as conn:
+            self.assertTrue(conn.open)
+
+    def test_close(self):
+        pool = self.make_pool()
+        with pool.connection() as conn:
+            with pool.connection() as conn2:
+                pass
+            pool.close()
+            self.assertFalse(conn2.open)
+            self.assertTrue(conn.open)
+
+        # Connections in use are closed when they're returned.
+        self.assertFalse(conn.open)
+
+
+if __name__ == '__main__':
+    unittest.main()
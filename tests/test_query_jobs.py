@@ -0,0 +1,101 @@
+import sched
+import unittest
+
+from prometheus_mysql_exporter import forget_query, METRICS_BY_QUERY, QueryJobs, store_metrics
+from prometheus_mysql_exporter.scrape import ScrapeTrigger
+
+from .test_shared_queries import query_config
+
+TARGET = ('localhost', 3306, 'user', 'password', ())
+
+
+class QueryJobsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = sched.scheduler()
+        self.scrape_trigger = ScrapeTrigger()
+        # Queries are never run, as the scheduler isn't, so no connections
+        # are made.
+        self.jobs = QueryJobs(self.scheduler, self.scrape_trigger, {}, {})
+        self.metrics_keys = []
+
+    def tearDown(self):
+        for metrics_key in self.metrics_keys:
+            forget_query(metrics_key)
+
+    def store(self, metrics_key):
+        self.metrics_keys.append(metrics_key)
+        store_metrics(metrics_key, {'foo': ('Foo.', (), {(): 1.0})}, 1)
+
+    def job_cancels(self):
+        return {job_key: cancel for job_key, (_, cancel) in self.jobs._jobs.items()}
+
+    def test_unchanged_jobs_kept(self):
+        queries = {'a': query_config(), 'b': query_config(query='SELECT 2')}
+        self.assertEqual(self.jobs.update({None: TARGET}, queries), (2, 0))
+        cancels = self.job_cancels()
+
+        self.assertEqual(self.jobs.update({None: TARGET}, dict(queries)), (0, 0))
+        self.assertEqual(self.job_cancels(), cancels)
+
+    def test_changed_jobs_restarted(self):
+        queries = {'a': query_config(), 'b': query_config(query='SELECT 2')}
+        self.jobs.update({None: TARGET}, queries)
+        cancels = self.job_cancels()
+
+        queries['b'] = query_config(query='SELECT 3')
+        self.assertEqual(self.jobs.update({None: TARGET}, queries), (1, 1))
+        new_cancels = self.job_cancels()
+        self.assertIs(new_cancels[(None, ('a',))], cancels[(None, ('a',))])
+        self.assertIsNot(new_cancels[(None, ('b',))], cancels[(None, ('b',))])
+
+    def test_shared_jobs_regrouped(self):
+        self.jobs.update({None: TARGET},
+                         {'a': query_config(), 'b': query_config(query='SELECT 2')})
+
+        # b now shares a's statement, so both are run by a new shared job.
+        self.assertEqual(self.jobs.update({None: TARGET},
+                                          {'a': query_config(), 'b': query_config()}),
+                         (1, 2))
+        self.assertEqual(list(self.jobs._jobs), [(None, ('a', 'b'))])
+
+    def test_removed_queries_forgotten(self):
+        queries = {'a': query_config(), 'b': query_config(query='SELECT 2')}
+        self.jobs.update({None: TARGET}, queries)
+        self.store((None, 'a'))
+        self.store((None, 'b'))
+
+        # Changed queries keep their metrics, but removed ones are forgotten.
+        self.jobs.update({None: TARGET}, {'a': query_config(timeout=5)})
+        self.assertIn((None, 'a'), METRICS_BY_QUERY)
+        self.assertNotIn((None, 'b'), METRICS_BY_QUERY)
+
+    def test_mode_switch_forgets_metrics(self):
+        self.jobs.update({None: TARGET}, {'a': query_config()})
+        self.store((None, 'a'))
+
+        self.jobs.update({None: TARGET}, {'a': query_config(mode='incremental')})
+        self.assertNotIn((None, 'a'), METRICS_BY_QUERY)
+
+    def test_targets(self):
+        other_target = ('other', 3306, 'user', 'password', ())
+        queries = {'a': query_config()}
+        self.assertEqual(self.jobs.update({'one': TARGET, 'two': other_target}, queries), (2, 0))
+        self.assertEqual(self.jobs.target_names, {'one', 'two'})
+        self.assertEqual(len(self.jobs._pools), 2)
+
+        # Removing a target stops its jobs, and closes its connection pools.
+        self.assertEqual(self.jobs.update({'one': TARGET}, queries), (0, 1))
+        self.assertEqual(self.jobs.target_names, {'one'})
+        self.assertEqual(len(self.jobs._pools), 1)
+
+    def test_on_scrape_jobs(self):
+        self.jobs.update({None: TARGET}, {'a': query_config(mode='on_scrape')})
+        self.assertEqual(len(self.scrape_trigger), 1)
+
+        self.jobs.update({None: TARGET}, {'a': query_config()})
+        self.assertEqual(len(self.scrape_trigger), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+import struct
+import threading
+import unittest
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    import snappy
+    from prometheus_mysql_exporter.remote_write import (encode_labels, encode_write_request,
+                                                         RemoteWriter)
+except ImportError:
+    snappy = None
+
+
+def read_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def decode_fields(data):
+    """
+    Decode a protobuf message into a list of (field number, value) tuples.
+    Only the wire types used by remote write are supported.
+    """
+
+    fields = []
+    pos = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        field_number, wire_type = key >> 3, key & 0x7
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+        elif wire_type == 1:
+            value = data[pos:pos + 8]
+            pos += 8
+        elif wire_type == 2:
+            length, pos = read_varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        else:
+            raise ValueError('Unexpected wire type {}.'.format(wire_type))
+        fields.append((field_number, value))
+    return fields
+
+
+def decode_write_request(data):
+    """
+    Decode a WriteRequest message into a list of (labels list, sample value
+    bytes, sample timestamp) tuples.
+    """
+
+    series = []
+    for field_number, timeseries in decode_fields(data):
+        assert field_number == 1
+        labels = []
+        samples = []
+        for field_number, value in decode_fields(timeseries):
+            if field_number == 1:
+                label = dict(decode_fields(value))
+                labels.append((label[1].decode('utf-8'), label[2].decode('utf-8')))
+            else:
+                samples.append(dict(decode_fields(value)))
+        (sample,) = samples
+        series.append((labels, sample[1], sample[2]))
+    return series
+
+
+@unittest.skipIf(snappy is None, 'Remote write requires python-snappy.')
+class EncodeWriteRequestTests(unittest.TestCase):
+
+    def test_encode(self):
+        labels = [('__name__', 'foo'), ('bar', 'bäz')]
+        encoded_labels = encode_labels(labels)
+        data = encode_write_request([
+            (encoded_labels, 1.5, 1600000000000),
+            (encoded_labels, None, 1600000001000),
+        ])
+
+        self.assertEqual(decode_write_request(data), [
+            (labels, struct.pack('<d', 1.5), 1600000000000),
+            (labels, struct.pack('<Q', 0x7ff0000000000002), 1600000001000),
+        ])
+
+
+class RecordingHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((dict(self.headers), body))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@unittest.skipIf(snappy is None, 'Remote write requires python-snappy.')
+class RemoteWriterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), RecordingHandler)
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.writer = RemoteWriter('http://127.0.0.1:{}/write'.format(self.server.server_port),
+                                   labels={'instance': 'test', 'bar': 'overridden'})
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def send(self):
+        # Send the queued batch, as the sender thread would.
+        self.writer._send(self.writer._queue.get_nowait())
+        headers, body = self.server.requests.pop()
+        self.assertEqual(headers['Content-Encoding'], 'snappy')
+        self.assertEqual(headers['Content-Type'], 'application/x-protobuf')
+        # Remote write uses the snappy block format, not the framing format.
+        return sorted(decode_write_request(snappy.uncompress(body)))
+
+    def test_changes_and_staleness_markers(self):
+        metric_dict = {'foo': ('Foo.', ('bar',), {('a',): 1.0, ('b',): 2.0})}
+        self.writer.write((None, 'foo'), metric_dict)
+        series = self.send()
+
+        self.assertEqual([(labels, value) for labels, value, _ in series], [
+            ([('__name__', 'foo'), ('bar', 'a'), ('instance', 'test')], struct.pack('<d', 1.0)),
+            ([('__name__', 'foo'), ('bar', 'b'), ('instance', 'test')], struct.pack('<d', 2.0)),
+        ])
+
+        # Only changed series are sent, with staleness markers for removed
+        # series.
+        metric_dict = {'foo': ('Foo.', ('bar',), {('a',): 3.0})}
+        self.writer.write((None, 'foo'), metric_dict, changes=[
+            ('foo', ('bar',), ('a',), 3.0),
+            ('foo', ('bar',), ('b',), None),
+        ])
+        series = self.send()
+
+        self.assertEqual([(labels, value) for labels, value, _ in series], [
+            ([('__name__', 'foo'), ('bar', 'a'), ('instance', 'test')], struct.pack('<d', 3.0)),
+            ([('__name__', 'foo'), ('bar', 'b'), ('instance', 'test')],
+             struct.pack('<Q', 0x7ff0000000000002)),
+        ])
+
+    def test_forget(self):
+        metric_dict = {'foo': ('Foo.', ('bar',), {('a',): 1.0})}
+        self.writer.forget((None, 'foo'), metric_dict)
+        series = self.send()
+
+        self.assertEqual([(labels, value) for labels, value, _ in series], [
+            ([('__name__', 'foo'), ('bar', 'a'), ('instance', 'test')],
+             struct.pack('<Q', 0x7ff0000000000002)),
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import pymysql
+import socket
+import unittest
+
+from contextlib import contextmanager
+
+from prometheus_mysql_exporter.routing import (is_connection_error, is_read_timeout, ReplicaSet,
+                                               RoutedPool)
+
+
+def read_timeout_error():
+    """
+    Return the error pymysql raises when a query exceeds the read timeout.
+    """
+
+    try:
+        try:
+            raise socket.timeout('timed out')
+        except OSError as e:
+            raise pymysql.OperationalError(
+                2013, 'Lost connection to MySQL server during query ({})'.format(e))
+    except pymysql.OperationalError as e:
+        return e
+
+
+class FakePool(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    @contextmanager
+    def connection(self):
+        yield self.name
+
+
+class RoutedPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.replica_set = ReplicaSet(None, ['primary', 'replica'])
+        # Rank the primary first, by its latency.
+        for server_name, latency in (('primary', 0.1), ('replica', 1)):
+            self.replica_set.acquire(server_name)
+            self.replica_set.release(server_name, latency)
+        self.pool = RoutedPool(self.replica_set,
+                               {'primary': FakePool('primary'), 'replica': FakePool('replica')},
+                               'any')
+
+    def test_is_connection_error(self):
+        self.assertTrue(is_connection_error(pymysql.OperationalError(2013, 'Lost connection')))
+        self.assertTrue(is_connection_error(pymysql.InterfaceError(0, '')))
+        self.assertTrue(is_connection_error(ConnectionResetError()))
+        self.assertFalse(is_connection_error(pymysql.ProgrammingError(1146, 'No such table')))
+        self.assertFalse(is_connection_error(ValueError()))
+
+    def test_is_read_timeout(self):
+        self.assertTrue(is_read_timeout(read_timeout_error()))
+        self.assertTrue(is_read_timeout(socket.timeout('timed out')))
+        self.assertFalse(is_read_timeout(pymysql.OperationalError(2013, 'Lost connection')))
+        self.assertFalse(is_read_timeout(pymysql.OperationalError(2003, "Can't connect")))
+
+    def test_run_retries_on_next_server_after_lost_connection(self):
+        runs = []
+
+        def func(conn):
+            runs.append(conn)
+            if conn == 'primary':
+                raise pymysql.OperationalError(2013, 'Lost connection')
+            return 'result'
+
+        self.assertEqual(self.pool.run(func), 'result')
+        self.assertEqual(runs, ['primary', 'replica'])
+        # The lost server is avoided by later runs.
+        self.assertEqual(self.replica_set.candidates('any'), ['replica'])
+
+    def test_run_does_not_retry_statement_errors(self):
+        runs = []
+
+        def func(conn):
+            runs.append(conn)
+            raise pymysql.ProgrammingError(1146, 'No such table')
+
+        with self.assertRaises(pymysql.ProgrammingError):
+            self.pool.run(func)
+        self.assertEqual(runs, ['primary'])
+
+    def test_run_does_not_retry_read_timeouts(self):
+        runs = []
+
+        def func(conn):
+            runs.append(conn)
+            raise read_timeout_error()
+
+        with self.assertRaises(pymysql.OperationalError):
+            self.pool.run(func)
+        self.assertEqual(runs, ['primary'])
+        # The server isn't avoided, as it's likely just slow to run the query.
+        self.assertEqual(self.replica_set.candidates('any'), ['primary', 'replica'])
+
+    def test_run_raises_when_last_server_lost(self):
+        runs = []
+
+        def func(conn):
+            runs.append(conn)
+            raise pymysql.OperationalError(2013, 'Lost connection')
+
+        with self.assertRaises(pymysql.OperationalError):
+            self.pool.run(func)
+        self.assertEqual(runs, ['primary', 'replica'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+
+from prometheus_mysql_exporter.scheduler import StaggerPlanner, stagger_offset
+
+
+class StaggerPlannerTests(unittest.TestCase):
+
+    def test_hash_offsets(self):
+        planner = StaggerPlanner()
+        for name in ('a', 'b', 'target/c'):
+            planner.add(name, 60)
+
+        for name in ('a', 'b', 'target/c'):
+            offset = planner.offset(name)
+            # Offsets are stable across restarts (i.e. planners).
+            self.assertEqual(offset, stagger_offset(name, 60))
+            self.assertGreaterEqual(offset, 0)
+            self.assertLess(offset, 60)
+
+    def test_replan_spreads_costs(self):
+        planner = StaggerPlanner(slots=10, replan_interval=0)
+        # These names hash to nearly the same offset.
+        names = ['query_0', 'query_4']
+        self.assertEqual(int(stagger_offset(names[0], 10)), int(stagger_offset(names[1], 10)))
+        for name in names:
+            planner.add(name, 10, group='server')
+            planner.record(name, 4)
+
+        # Each job is expected to take 4 of the 10 one second slots, so they
+        # should be planned in slots that don't overlap.
+        slots = sorted(int(planner.offset(name)) for name in names)
+        self.assertGreaterEqual(slots[1] - slots[0], 4)
+        self.assertGreaterEqual(slots[0] + 10 - slots[1], 4)
+
+    def test_groups_planned_separately(self):
+        planner = StaggerPlanner(slots=10, replan_interval=0)
+        planner.add('a', 10, group='server1')
+        planner.add('b', 10, group='server2')
+        planner.record('a', 3)
+        planner.record('b', 3)
+
+        # Neither job shares its group, so both stay in their home slots.
+        for name in ('a', 'b'):
+            self.assertEqual(int(planner.offset(name)), int(stagger_offset(name, 10)))
+
+    def test_record_after_remove(self):
+        planner = StaggerPlanner(replan_interval=0)
+        planner.add('a', 10)
+        planner.remove('a')
+        planner.record('a', 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import threading
+import time
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+
+from prometheus_mysql_exporter.scrape import ScrapeTrigger
+
+
+class ScrapeTriggerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.runs = []
+
+    def tearDown(self):
+        self.executor.shutdown(wait=True)
+
+    def run_query(self, name, release=None):
+        self.runs.append(name)
+        if release is not None:
+            release.wait(5)
+
+    def test_cache_ttl(self):
+        trigger = ScrapeTrigger(self.executor)
+        trigger.add(None, 0.05, self.run_query, 'a')
+        trigger.add(None, 60, self.run_query, 'b')
+
+        trigger.trigger()
+        trigger.trigger()
+        self.assertEqual(sorted(self.runs), ['a', 'b'])
+
+        # Only jobs whose results have expired are run again.
+        time.sleep(0.06)
+        trigger.trigger()
+        self.assertEqual(sorted(self.runs), ['a', 'a', 'b'])
+
+    def test_targets(self):
+        trigger = ScrapeTrigger(self.executor)
+        trigger.add('target1', 60, self.run_query, 'a')
+        trigger.add('target2', 60, self.run_query, 'b')
+
+        trigger.trigger('target1')
+        self.assertEqual(self.runs, ['a'])
+        trigger.trigger()
+        self.assertEqual(sorted(self.runs), ['a', 'b'])
+
+    def test_concurrent_scrapes_share_run(self):
+        trigger = ScrapeTrigger(self.executor)
+        release = threading.Event()
+        trigger.add(None, 60, self.run_query, 'a', release=release)
+
+        scrapes = [threading.Thread(target=trigger.trigger) for _ in range(3)]
+        for scrape in scrapes:
+            scrape.start()
+        time.sleep(0.05)
+        release.set()
+        for scrape in scrapes:
+            scrape.join(5)
+
+        self.assertEqual(self.runs, ['a'])
+
+    def test_deadline(self):
+        trigger = ScrapeTrigger(self.executor, deadline=0.05)
+        release = threading.Event()
+        job = trigger.add(None, 60, self.run_query, 'a', release=release)
+
+        start_time = time.monotonic()
+        trigger.trigger()
+        self.assertLess(time.monotonic() - start_time, 1)
+        # The run carries on in the background, and isn't started again.
+        running = job.running
+        self.assertIsNotNone(running)
+        trigger.trigger()
+
+        release.set()
+        running.result(5)
+        self.assertEqual(self.runs, ['a'])
+
+    def test_failed_runs_cached(self):
+        trigger = ScrapeTrigger(self.executor)
+
+        def fail():
+            self.runs.append('fail')
+            raise RuntimeError('Query failed.')
+
+        trigger.add(None, 60, fail)
+        with self.assertLogs('prometheus_mysql_exporter.scrape', 'ERROR'):
+            trigger.trigger()
+        trigger.trigger()
+
+        self.assertEqual(self.runs, ['fail'])
+
+
+if __name__ == '__main__':
+    unittest.main()
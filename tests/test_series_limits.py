@@ -0,0 +1,99 @@
+import unittest
+
+from prometheus_mysql_exporter import (forget_query, handle_query_response, METRICS_BY_QUERY,
+                                       parse_query_rows, SERIES_BUDGET, store_metrics)
+from prometheus_mysql_exporter.parser import ParsePlan, SeriesLimitError
+from prometheus_mysql_exporter.store import SeriesBudget
+
+DESCRIPTION = (('bar', 253), ('value', 3))
+
+
+def stored_series(metrics_key):
+    return sum(len(value_dict) for _, _, value_dict in METRICS_BY_QUERY[metrics_key].values())
+
+
+class SeriesLimitTests(unittest.TestCase):
+
+    metrics_key = (None, 'series_limit_test')
+
+    def tearDown(self):
+        forget_query(self.metrics_key)
+        SERIES_BUDGET.max_series = None
+
+    def run_query(self, rows, on_missing, max_series=None, on_series_limit='reject'):
+        handle_query_response(self.metrics_key, 'test', ['value'], DESCRIPTION, rows,
+                              'preserve', on_missing, max_series=max_series,
+                              on_series_limit=on_series_limit)
+
+    def test_kept_series_count_towards_limit(self):
+        for on_missing in ('preserve', 'zero'):
+            with self.subTest(on_missing=on_missing):
+                # Each run returns different series, which would otherwise
+                # all be kept.
+                for run in range(8):
+                    rows = [('run{}_{}'.format(run, i), 1) for i in range(5)]
+                    self.run_query(rows, on_missing, max_series=10, on_series_limit='truncate')
+                    self.assertLessEqual(stored_series(self.metrics_key), 10)
+                self.assertEqual(stored_series(self.metrics_key), 10)
+                forget_query(self.metrics_key)
+
+    def test_kept_series_count_towards_budget(self):
+        SERIES_BUDGET.max_series = 10
+        for run in range(8):
+            rows = [('run{}_{}'.format(run, i), 1) for i in range(5)]
+            self.run_query(rows, 'preserve', on_series_limit='truncate')
+        self.assertEqual(stored_series(self.metrics_key), 10)
+
+    def test_rejected_run_keeps_stored_series(self):
+        self.run_query([('a', 1), ('b', 2)], 'preserve', max_series=3)
+        self.run_query([('b', 3), ('c', 4), ('d', 5)], 'preserve', max_series=3)
+
+        value_dict = METRICS_BY_QUERY[self.metrics_key]['series_limit_test_value'][2]
+        self.assertEqual(dict(value_dict), {('test', 'a'): 1, ('test', 'b'): 2})
+
+    def test_updated_series_not_counted_twice(self):
+        self.run_query([('a', 1), ('b', 2)], 'preserve', max_series=3)
+        self.run_query([('a', 3), ('b', 4), ('c', 5)], 'preserve', max_series=3)
+
+        self.assertEqual(stored_series(self.metrics_key), 3)
+
+    def test_dropped_series_not_counted(self):
+        self.run_query([('a', 1), ('b', 2)], 'drop', max_series=2)
+        self.run_query([('c', 3), ('d', 4)], 'drop', max_series=2)
+
+        value_dict = METRICS_BY_QUERY[self.metrics_key]['series_limit_test_value'][2]
+        self.assertEqual(dict(value_dict), {('test', 'c'): 3, ('test', 'd'): 4})
+
+    def test_accumulated_series_count_towards_limit(self):
+        # Incremental queries store their metrics with a _total suffix.
+        store_metrics(self.metrics_key, {
+            'series_limit_test_value_total': ('Value.', ('db', 'bar'),
+                                              {('test', 'a'): 1, ('test', 'b'): 2}),
+        }, 2)
+        parse_plan = ParsePlan('series_limit_test', 'test', ['value'], DESCRIPTION)
+
+        parse_query_rows(self.metrics_key, parse_plan, [('b', 1), ('c', 1)], max_series=3,
+                         on_missing='preserve', metric_suffix='_total')
+        self.assertEqual(parse_plan.series, 3)
+        with self.assertRaises(SeriesLimitError):
+            parse_query_rows(self.metrics_key, parse_plan, [('c', 1), ('d', 1)], max_series=3,
+                             on_missing='preserve', metric_suffix='_total')
+
+
+class SeriesBudgetTests(unittest.TestCase):
+
+    def test_available(self):
+        budget = SeriesBudget(max_series=10, max_bytes=1000)
+        budget.update('a', 4, bytes_per_series=100)
+        budget.update('b', 3, bytes_per_series=50)
+
+        # A key can always reuse its own budget.
+        self.assertEqual(budget.available('a'), (7, 850))
+        self.assertEqual(budget.available('c'), (3, 450))
+
+        budget.update('a', 0)
+        self.assertEqual(budget.available('c'), (7, 850))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import math
+import unittest
+
+from prometheus_client.core import Metric
+
+from prometheus_mysql_exporter.sharding import merge_metric_families
+
+
+def family(metric_type, samples):
+    metric = Metric('mysql_exporter_test', 'Test.', metric_type)
+    for sample_name, labels, value in samples:
+        metric.add_sample(sample_name, labels, value)
+    return metric
+
+
+def sample_values(metric):
+    return {(sample.name, tuple(sorted(sample.labels.items()))): sample.value
+            for sample in metric.samples}
+
+
+class MergeMetricFamiliesTests(unittest.TestCase):
+
+    def test_counters_summed(self):
+        merged = merge_metric_families([
+            family('counter', [('mysql_exporter_test_total', {'a': '1'}, 2),
+                               ('mysql_exporter_test_created', {'a': '1'}, 200)]),
+            family('counter', [('mysql_exporter_test_total', {'a': '1'}, 3),
+                               ('mysql_exporter_test_created', {'a': '1'}, 100),
+                               ('mysql_exporter_test_total', {'a': '2'}, 4)]),
+        ])
+
+        self.assertEqual(sample_values(merged), {
+            ('mysql_exporter_test_total', (('a', '1'),)): 5,
+            ('mysql_exporter_test_created', (('a', '1'),)): 100,
+            ('mysql_exporter_test_total', (('a', '2'),)): 4,
+        })
+
+    def test_gauges_not_summed(self):
+        merged = merge_metric_families([
+            family('gauge', [('mysql_exporter_test', {'replica': 'a'}, 2),
+                             ('mysql_exporter_test', {'replica': 'b'}, math.nan),
+                             ('mysql_exporter_test', {'replica': 'c'}, math.nan)]),
+            family('gauge', [('mysql_exporter_test', {'replica': 'a'}, 1),
+                             ('mysql_exporter_test', {'replica': 'b'}, 3),
+                             ('mysql_exporter_test', {'replica': 'c'}, math.nan)]),
+            family('gauge', [('mysql_exporter_test', {'replica': 'b'}, math.nan)]),
+        ])
+
+        values = sample_values(merged)
+        self.assertEqual(values[('mysql_exporter_test', (('replica', 'a'),))], 2)
+        self.assertEqual(values[('mysql_exporter_test', (('replica', 'b'),))], 3)
+        self.assertTrue(math.isnan(values[('mysql_exporter_test', (('replica', 'c'),))]))
+
+
+if __name__ == '__main__':
+    unittest.main()
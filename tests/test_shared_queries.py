@@ -0,0 +1,71 @@
+import unittest
+
+from prometheus_mysql_exporter import batch_statement, find_shared_queries, QueryConfig
+
+
+def query_config(db_name='test', query='SELECT 1', interval=15, cron=None, timeout=None,
+                 stream=False, mode='scheduled', cache_ttl=15, routing='primary'):
+    return QueryConfig(interval=interval, cron=cron, cron_tz=None,
+                       db_name=db_name, query=query, value_columns=['value'],
+                       on_error='drop', on_missing='drop', timeout=timeout,
+                       stream=stream, max_rows=None, max_series=None, on_series_limit='reject',
+                       mode=mode, cache_ttl=cache_ttl, priority='normal',
+                       watermark_column=None, watermark_start=None,
+                       state_max_age=None, routing=routing)
+
+
+class FindSharedQueriesTests(unittest.TestCase):
+
+    def test_shared_statements(self):
+        queries = {
+            'a': query_config(),
+            'b': query_config(query='  SELECT 1\n'),
+            'c': query_config(query='SELECT 2'),
+            'd': query_config(db_name='other'),
+            'e': query_config(interval=30),
+            'f': query_config(timeout=5),
+            'g': query_config(routing='replica'),
+            'h': query_config(stream=True),
+            'i': query_config(stream=True),
+            'j': query_config(mode='incremental'),
+        }
+
+        self.assertEqual(find_shared_queries(queries),
+                         [['a', 'b'], ['c'], ['d'], ['e'], ['f'], ['g'], ['h'], ['i'], ['j']])
+
+    def test_schedules(self):
+        queries = {
+            # Intervals are irrelevant to cron based queries.
+            'a': query_config(cron='* * * * *', interval=15),
+            'b': query_config(cron='* * * * *', interval=30),
+            'c': query_config(mode='on_scrape', cache_ttl=10),
+            'd': query_config(mode='on_scrape', cache_ttl=10, interval=30),
+            'e': query_config(mode='on_scrape', cache_ttl=20),
+        }
+
+        self.assertEqual(find_shared_queries(queries), [['a', 'b'], ['c', 'd'], ['e']])
+
+    def test_batches(self):
+        queries = {
+            'a': query_config(query='SELECT 1'),
+            'b': query_config(query='SELECT 2'),
+            'c': query_config(query='SELECT 1'),
+            'd': query_config(query='SELECT 3'),
+            'e': query_config(query='SELECT 4'),
+            'f': query_config(query='SELECT 5', db_name='other'),
+            'g': query_config(query='SELECT 6', stream=True),
+        }
+
+        self.assertEqual(find_shared_queries(queries, batch_size=2),
+                         [['a', 'c', 'b'], ['d', 'e'], ['f'], ['g']])
+
+
+class BatchStatementTests(unittest.TestCase):
+
+    def test_batch_statement(self):
+        self.assertEqual(batch_statement(['SELECT 1;', '  SELECT 2 -- comment\n']),
+                         'SELECT 1\n;\nSELECT 2 -- comment')
+
+
+if __name__ == '__main__':
+    unittest.main()
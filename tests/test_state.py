@@ -0,0 +1,50 @@
+import tempfile
+import time
+import unittest
+
+from prometheus_mysql_exporter.state import StateStore
+
+
+class StateStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.state_store = StateStore(self.directory.name)
+        self.state_store.start()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def wait_for_writes(self):
+        deadline = time.monotonic() + 5
+        while self.state_store._pending and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # The writer may still be writing the last pending snapshot.
+        time.sleep(0.05)
+
+    def test_save_and_load(self):
+        key = ('target', 'foo')
+        metric_dict = {'foo_value_total': ('Foo.', ('db', 'bar'), {('test', 'a'): 1.0})}
+        self.state_store.save(key, metric_dict, 1, watermark=5)
+        # Later runs update the metric dict in place, which mustn't affect
+        # the saved snapshot.
+        metric_dict['foo_value_total'][2][('test', 'a')] = 2.0
+        self.wait_for_writes()
+
+        loaded_metric_dict, watermark, age = self.state_store.load(key)
+        self.assertEqual(loaded_metric_dict,
+                         {'foo_value_total': ('Foo.', ('db', 'bar'), {('test', 'a'): 1.0})})
+        self.assertEqual(watermark, '5')
+
+    def test_removed(self):
+        key = (None, 'foo')
+        self.state_store.save(key, {'foo_value': ('Foo.', (), {(): 1.0})}, 1)
+        self.wait_for_writes()
+        self.state_store.remove(key)
+        self.wait_for_writes()
+
+        self.assertIsNone(self.state_store.load(key))
+
+
+if __name__ == '__main__':
+    unittest.main()
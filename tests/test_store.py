@@ -0,0 +1,88 @@
+import unittest
+
+from prometheus_mysql_exporter.metrics import update_metric_dict
+from prometheus_mysql_exporter.store import compact_metric_dict, CompactValueDict
+
+
+class CompactValueDictTests(unittest.TestCase):
+
+    def test_mapping(self):
+        value_dict = CompactValueDict(value_dict={('a',): 1.0, ('b',): 2.5})
+        value_dict[('c',)] = 3.0
+        value_dict[('a',)] = 4.0
+        del value_dict[('b',)]
+
+        self.assertEqual(dict(value_dict), {('a',): 4.0, ('c',): 3.0})
+        self.assertEqual(len(value_dict), 2)
+        self.assertIn(('a',), value_dict)
+        self.assertNotIn(('b',), value_dict)
+        self.assertEqual(value_dict.get(('b',)), None)
+        self.assertEqual(sorted(value_dict.items()), [(('a',), 4.0), (('c',), 3.0)])
+        with self.assertRaises(KeyError):
+            value_dict[('b',)]
+        with self.assertRaises(KeyError):
+            del value_dict[('b',)]
+
+    def test_clear(self):
+        value_dict = CompactValueDict(value_dict={('a',): 1.0, ('b',): 2.0})
+        value_dict.clear()
+        value_dict[('c',)] = 3.0
+
+        self.assertEqual(dict(value_dict), {('c',): 3.0})
+
+    def test_shared_series(self):
+        metric_dict = compact_metric_dict({
+            'foo': ('Foo.', ('bar',), {('a',): 1.0, ('b',): 2.0}),
+            'baz': ('Baz.', ('bar',), {('a',): 3.0}),
+        })
+        foo = metric_dict['foo'][2]
+        baz = metric_dict['baz'][2]
+        del foo[('a',)]
+
+        # Series are shared between value dicts, but removing a series from
+        # one doesn't affect the other.
+        self.assertEqual(dict(foo), {('b',): 2.0})
+        self.assertEqual(dict(baz), {('a',): 3.0})
+        foo[('c',)] = 4.0
+        self.assertEqual(dict(baz), {('a',): 3.0})
+        self.assertEqual(dict(foo), {('b',): 2.0, ('c',): 4.0})
+
+    def test_only_shared_label_keys_compacted(self):
+        metric_dict = compact_metric_dict({
+            'foo': ('Foo.', ('bar',), {('a',): 1.0}),
+            'baz': ('Baz.', ('bar',), {('a',): 2.0}),
+            'qux': ('Qux.', ('quux',), {('a',): 3.0}),
+        })
+
+        self.assertIsInstance(metric_dict['foo'][2], CompactValueDict)
+        self.assertIs(metric_dict['foo'][2].index, metric_dict['baz'][2].index)
+        self.assertIs(type(metric_dict['qux'][2]), dict)
+
+        # New metrics with the same label keys join the existing index.
+        metric_dict['corge'] = ('Corge.', ('bar',), {('b',): 4.0})
+        compact_metric_dict(metric_dict)
+        self.assertIs(metric_dict['corge'][2].index, metric_dict['foo'][2].index)
+
+    def test_update_metric_dict(self):
+        metric_dict = compact_metric_dict({
+            'foo': ('Foo.', ('bar',), {('a',): 1.0, ('b',): 2.0}),
+            'baz': ('Baz.', ('bar',), {('a',): 3.0, ('b',): 4.0}),
+        })
+        changes = []
+        changed = update_metric_dict(metric_dict, {
+            'foo': ('Foo.', ('bar',), {('b',): 5.0, ('c',): 6.0}),
+            'baz': ('Baz.', ('bar',), {('a',): 3.0, ('b',): 4.0}),
+        }, changes=changes)
+
+        self.assertEqual(dict(metric_dict['foo'][2]), {('b',): 5.0, ('c',): 6.0})
+        self.assertEqual(dict(metric_dict['baz'][2]), {('a',): 3.0, ('b',): 4.0})
+        self.assertEqual(changed, 3)
+        self.assertEqual(sorted(changes, key=repr), sorted([
+            ('foo', ('bar',), ('a',), None),
+            ('foo', ('bar',), ('b',), 5.0),
+            ('foo', ('bar',), ('c',), 6.0),
+        ], key=repr))
+
+
+if __name__ == '__main__':
+    unittest.main()
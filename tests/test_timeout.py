@@ -0,0 +1,84 @@
+import pymysql
+import threading
+import time
+import unittest
+
+from prometheus_mysql_exporter.timeout import query_timeout, QueryTimeoutError
+
+
+class FakeKillCursor(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, query, args=None):
+        self.conn.statements.append(query % args)
+        # The query's connection gets its error as soon as the server
+        # processes the KILL, before the KILL's own response is read.
+        self.conn.processed.set()
+        time.sleep(0.1)
+
+
+class FakeKillConnection(object):
+    """
+    Enough of a pymysql connection for query_timeout() to send a KILL QUERY.
+    """
+
+    def __init__(self):
+        self.statements = []
+        self.processed = threading.Event()
+        self.closed = False
+
+    def cursor(self):
+        return FakeKillCursor(self)
+
+    def close(self):
+        self.closed = True
+
+
+class QueryTimeoutTests(unittest.TestCase):
+
+    def setUp(self):
+        self.kill_conn = FakeKillConnection()
+
+    def test_killed_query_raises_timeout_error(self):
+        with self.assertRaises(QueryTimeoutError) as cm:
+            with query_timeout(lambda: self.kill_conn, 42, 0.05):
+                self.assertTrue(self.kill_conn.processed.wait(5))
+                raise pymysql.OperationalError(1317, 'Query execution was interrupted')
+
+        self.assertIsInstance(cm.exception.__cause__, pymysql.OperationalError)
+        self.assertEqual(self.kill_conn.statements, ['KILL QUERY 42'])
+        self.assertTrue(self.kill_conn.closed)
+
+    def test_query_within_timeout(self):
+        with query_timeout(lambda: self.kill_conn, 42, 5):
+            pass
+        time.sleep(0.1)
+
+        self.assertEqual(self.kill_conn.statements, [])
+
+    def test_other_errors_reraised(self):
+        with self.assertRaises(pymysql.ProgrammingError):
+            with query_timeout(lambda: self.kill_conn, 42, 5):
+                raise pymysql.ProgrammingError(1146, 'No such table')
+
+        self.assertEqual(self.kill_conn.statements, [])
+
+    def test_no_timeout(self):
+        def kill_connection():
+            raise AssertionError('No connection should be made.')
+
+        for timeout in (None, 0):
+            with query_timeout(kill_connection, 42, timeout):
+                pass
+
+
+if __name__ == '__main__':
+    unittest.main()